@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Payload codec benchmark for SiFT v1.0
+Compares the delimited text encoding of command payloads with the binary
+TLV encoding (SiFT_CMD.set_binary).
+- 'codec' builds and parses a request and its response per command, and
+  reports the payload sizes
+- 'session' runs pwd and lst commands over a socketpair with a server
+  thread, so MTP encryption and the file system are included
+Results are reported as commands per second on a single core.
+"""
+
+import os, sys, time, socket, threading, argparse, tempfile, shutil
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from Crypto.Hash import SHA256
+from Crypto.Random import get_random_bytes
+from siftprotocols.siftmtp import SiFT_MTP
+from siftprotocols.siftcmd import SiFT_CMD
+
+# Run fn repeatedly for at least min_time seconds, return the rate per second
+def measure_rate(fn, min_time):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return count / elapsed
+
+# Request and response of each command as the server would produce them
+def sample_commands(cmdp, entries):
+    file_hash = SHA256.new(b'bench').digest()
+    request_hash = SHA256.new(b'request').digest()
+    listing = '\n'.join(f'file_{i:04d}.txt' for i in range(entries))
+    samples = {}
+    samples['pwd'] = ({'command': cmdp.cmd_pwd},
+                      {'command': cmdp.cmd_pwd, 'request_hash': request_hash, 'result_1': cmdp.res_success, 'result_2': 'dir1/dir2/'})
+    samples[f'lst ({entries})'] = ({'command': cmdp.cmd_lst},
+                                   {'command': cmdp.cmd_lst, 'request_hash': request_hash, 'result_1': cmdp.res_success, 'result_2': listing})
+    samples['mkd'] = ({'command': cmdp.cmd_mkd, 'param_1': 'newdir'},
+                      {'command': cmdp.cmd_mkd, 'request_hash': request_hash, 'result_1': cmdp.res_success})
+    samples['upl'] = ({'command': cmdp.cmd_upl, 'param_1': 'file.bin', 'param_2': 65536, 'param_3': file_hash},
+                      {'command': cmdp.cmd_upl, 'request_hash': request_hash, 'result_1': cmdp.res_accept})
+    samples['dnl'] = ({'command': cmdp.cmd_dnl, 'param_1': 'file.bin'},
+                      {'command': cmdp.cmd_dnl, 'request_hash': request_hash, 'result_1': cmdp.res_accept,
+                       'result_2': 65536, 'result_3': file_hash})
+    return samples
+
+# Build and parse the request and the response of a command
+def codec_work(cmdp, req_struct, res_struct):
+    def work():
+        cmdp.parse_command_req(cmdp.build_command_req(req_struct))
+        cmdp.parse_command_res(cmdp.build_command_res(res_struct))
+    return work
+
+# Send the command repeatedly over a socketpair, the server thread answers until the socket closes
+def session_rate(binary, cmd_req_struct, rootdir, min_time):
+    server_sock, client_sock = socket.socketpair()
+    server_mtp, client_mtp = SiFT_MTP(server_sock), SiFT_MTP(client_sock)
+    key = get_random_bytes(32)
+    server_mtp.set_session_keys(key, key, is_client=False)
+    client_mtp.set_session_keys(key, key, is_client=True)
+    server_cmdp, client_cmdp = SiFT_CMD(server_mtp), SiFT_CMD(client_mtp)
+    for obj in (server_mtp, client_mtp, server_cmdp, client_cmdp):
+        obj.DEBUG = False
+    server_cmdp.set_server_rootdir(rootdir)
+    server_cmdp.set_user_rootdir('bench/')
+    client_cmdp.set_binary(binary)
+
+    def serve():
+        try:
+            while True:
+                server_cmdp.receive_command()
+        except Exception:
+            pass # client closed the connection
+
+    server = threading.Thread(target=serve)
+    server.start()
+    rate = measure_rate(lambda: client_cmdp.send_command(cmd_req_struct), min_time)
+    client_sock.close()
+    server.join()
+    server_sock.close()
+    return rate
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the text and binary encodings of command payloads')
+    parser.add_argument('--time', type=float, default=1.0, help='seconds to run each measurement')
+    parser.add_argument('--entries', type=int, default=100, help='directory entries in the lst response')
+    parser.add_argument('--skip-session', action='store_true', help='only measure building and parsing')
+    args = parser.parse_args()
+
+    print("=" * 70)
+    print("SiFT v1.0 payload codec benchmark")
+    print("=" * 70)
+
+    cmdp = SiFT_CMD(None)
+    cmdp.DEBUG = False
+    samples = sample_commands(cmdp, args.entries)
+
+    print("Build and parse of request + response (commands/sec/core), payload bytes:")
+    print("-" * 70)
+    print(f"  {'command':<12} {'text':>10} {'binary':>10} {'speedup':>8} {'text B':>8} {'binary B':>9}")
+    for name, (req_struct, res_struct) in samples.items():
+        rates, sizes = {}, {}
+        for binary in (False, True):
+            cmdp.set_binary(binary)
+            sizes[binary] = len(cmdp.build_command_req(req_struct)) + len(cmdp.build_command_res(res_struct))
+            rates[binary] = measure_rate(codec_work(cmdp, req_struct, res_struct), args.time)
+        print(f"  {name:<12} {rates[False]:10.0f} {rates[True]:10.0f} {rates[True] / rates[False]:7.2f}x " +
+              f"{sizes[False]:8d} {sizes[True]:9d}")
+
+    if not args.skip_session:
+        rootdir = tempfile.mkdtemp() + '/'
+        os.makedirs(rootdir + 'bench')
+        for i in range(args.entries):
+            open(os.path.join(rootdir, 'bench', f'file_{i:04d}.txt'), 'w').close()
+        print()
+        print("Commands over a socketpair with MTP encryption (commands/sec):")
+        print("-" * 70)
+        for name, cmd_req_struct in (('pwd', {'command': cmdp.cmd_pwd}), (f'lst ({args.entries})', {'command': cmdp.cmd_lst})):
+            text = session_rate(False, cmd_req_struct, rootdir, args.time)
+            binary = session_rate(True, cmd_req_struct, rootdir, args.time)
+            print(f"  {name:<12} text {text:10.0f}   binary {binary:10.0f}   ({binary / text:.2f}x)")
+        shutil.rmtree(rootdir)
+    print("=" * 70)
+
+if __name__ == '__main__':
+    main()
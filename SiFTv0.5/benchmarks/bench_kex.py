@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Key exchange benchmark for SiFT v1.0
+Compares the server-side cost of the temporary key transport in the login
+protocol: RSA-OAEP (2048 and 3072 bits) against the ephemeral X25519 mode.
+- 'crypto' measures only the key exchange work of the server per login
+- 'login' runs complete logins over a socketpair (RSA-2048 and X25519 only,
+  as the MTP etk field is sized for RSA-2048)
+Results are reported as logins per second on a single core.
+"""
+
+import os, sys, time, socket, threading, argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from Crypto.PublicKey import RSA, ECC
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import PBKDF2
+from Crypto.Random import get_random_bytes
+from siftprotocols.siftmtp import SiFT_MTP
+from siftprotocols.siftlogin import SiFT_LOGIN
+
+# Run fn repeatedly for at least min_time seconds, return the rate per second
+def measure_rate(fn, min_time):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return count / elapsed
+
+# Server-side RSA-OAEP work per login: decrypt the etk and derive the session key
+def rsa_server_work(rsa_key):
+    cipher = PKCS1_OAEP.new(rsa_key.publickey())
+    etk = cipher.encrypt(get_random_bytes(32))
+    loginp = SiFT_LOGIN(None)
+    def work():
+        PKCS1_OAEP.new(rsa_key).decrypt(etk)
+        loginp.derive_session_keys(get_random_bytes(16), get_random_bytes(16), get_random_bytes(32))
+    return work
+
+# Server-side X25519 work per login: static DH, ephemeral key generation, ephemeral DH and HKDFs
+def x25519_server_work(x25519_key):
+    loginp = SiFT_LOGIN(None)
+    loginp.x25519_key = x25519_key
+    client_epk = ECC.generate(curve='Curve25519').public_key().export_key(format='raw')
+    def work():
+        static_secret = loginp.x25519_shared_secret(x25519_key, client_epk)
+        loginp.derive_x25519_temp_key(static_secret, client_epk)
+        server_eph_key = ECC.generate(curve='Curve25519')
+        secret = loginp.x25519_shared_secret(server_eph_key, client_epk) + static_secret
+        server_eph_key.public_key().export_key(format='raw')
+        loginp.derive_session_keys(get_random_bytes(16), get_random_bytes(16), get_random_bytes(32), secret=secret)
+    return work
+
+# Complete login over a socketpair, the client runs in a helper thread
+def login_work(rsa_key, x25519_key, users, mode):
+    def work():
+        server_sock, client_sock = socket.socketpair()
+        server_mtp, client_mtp = SiFT_MTP(server_sock), SiFT_MTP(client_sock)
+        server_loginp, client_loginp = SiFT_LOGIN(server_mtp), SiFT_LOGIN(client_mtp)
+        for obj in (server_mtp, client_mtp, server_loginp, client_loginp):
+            obj.DEBUG = False
+        server_loginp.set_rsa_key(rsa_key)
+        server_loginp.x25519_key = x25519_key
+        server_loginp.set_server_users(users)
+        if mode == 'x25519':
+            client_loginp.x25519_key = x25519_key.public_key()
+        else:
+            client_loginp.set_rsa_key(rsa_key.publickey())
+        client = threading.Thread(target=client_loginp.handle_login_client, args=('bench', 'bench'))
+        client.start()
+        server_loginp.handle_login_server()
+        client.join()
+        server_sock.close()
+        client_sock.close()
+    return work
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare RSA-OAEP and X25519 login key exchange')
+    parser.add_argument('--time', type=float, default=2.0, help='seconds to run each measurement')
+    parser.add_argument('--icount', type=int, default=1, help='PBKDF2 iterations of the benchmark user in full logins')
+    parser.add_argument('--skip-login', action='store_true', help='only measure the key exchange crypto')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("SiFT v1.0 login key exchange benchmark")
+    print("=" * 60)
+
+    rsa_keys = {}
+    for bits in (2048, 3072):
+        print(f"Generating {bits}-bit RSA key...")
+        rsa_keys[bits] = RSA.generate(bits)
+    x25519_key = ECC.generate(curve='Curve25519')
+
+    print()
+    print("Key exchange crypto on the server (logins/sec/core):")
+    print("-" * 60)
+    results = {}
+    for bits in (2048, 3072):
+        results[f'RSA-{bits}'] = measure_rate(rsa_server_work(rsa_keys[bits]), args.time)
+    results['X25519'] = measure_rate(x25519_server_work(x25519_key), args.time)
+    for name, rate in results.items():
+        print(f"  {name:<12} {rate:10.1f}  ({rate / results['RSA-2048']:.1f}x RSA-2048)")
+
+    if not args.skip_login:
+        salt = get_random_bytes(16)
+        users = {'bench': {'pwdhash': PBKDF2('bench', salt, 32, count=args.icount, hmac_hash_module=SHA256),
+                           'icount': args.icount, 'salt': salt, 'rootdir': 'bench/'}}
+        print()
+        print(f"Complete logins over a socketpair, PBKDF2 icount={args.icount} (logins/sec):")
+        print("-" * 60)
+        for mode in ('rsa', 'x25519'):
+            rate = measure_rate(login_work(rsa_keys[2048], x25519_key, users, mode), args.time)
+            print(f"  {'RSA-2048' if mode == 'rsa' else 'X25519':<12} {rate:10.1f}")
+    print("=" * 60)
+
+if __name__ == '__main__':
+    main()
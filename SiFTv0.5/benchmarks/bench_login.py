@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Login path benchmark for SiFT v1.0
+Times each crypto step of SiFT_LOGIN.handle_login_server and
+handle_login_client in isolation, and complete logins over a socketpair.
+- PEM load, RSA-OAEP encrypt/decrypt, PBKDF2 at the icount of users.txt,
+  SHA256 of the request and HKDF session key derivation
+- Calibration mode reports the PBKDF2 iteration count that takes a target
+  verification time on this hardware, and the login capacity per core
+"""
+
+import os, sys, time, socket, threading, argparse, statistics, tempfile
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server')
+sys.path.insert(0, SERVER_DIR)
+
+from Crypto.PublicKey import RSA
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import PBKDF2
+from Crypto.Random import get_random_bytes
+from siftprotocols.siftmtp import SiFT_MTP
+from siftprotocols.siftlogin import SiFT_LOGIN
+
+# Run fn repeats times and return the timings in milliseconds
+def time_step(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+# Read the icount values of the users file (same format as Server.load_users)
+def load_icounts(usersfile):
+    icounts = []
+    with open(usersfile, 'rb') as f:
+        for r in f.read().decode('utf-8').split('\n'):
+            if r.strip():
+                icounts.append(int(r.split(':')[2]))
+    return icounts
+
+# Time a PBKDF2 password hash with the given iteration count in milliseconds
+def time_pbkdf2(icount, salt):
+    start = time.perf_counter()
+    PBKDF2('password', salt, 32, count=icount, hmac_hash_module=SHA256)
+    return (time.perf_counter() - start) * 1000
+
+# Find the iteration count for a target PBKDF2 time, scaling from measured probes
+def calibrate(target_ms, rounds=5):
+    salt = get_random_bytes(16)
+    icount = 10000
+    for _ in range(rounds):
+        elapsed = min(time_pbkdf2(icount, salt) for _ in range(3))
+        icount = max(1000, int(icount * target_ms / elapsed))
+    return icount, min(time_pbkdf2(icount, salt) for _ in range(3))
+
+# Complete login over a socketpair, the client runs in a helper thread
+def login_once(rsa_key, users):
+    server_sock, client_sock = socket.socketpair()
+    server_mtp, client_mtp = SiFT_MTP(server_sock), SiFT_MTP(client_sock)
+    server_loginp, client_loginp = SiFT_LOGIN(server_mtp), SiFT_LOGIN(client_mtp)
+    for obj in (server_mtp, client_mtp, server_loginp, client_loginp):
+        obj.DEBUG = False
+    server_loginp.set_rsa_key(rsa_key)
+    server_loginp.set_server_users(users)
+    client_loginp.set_rsa_key(rsa_key.publickey())
+    client = threading.Thread(target=client_loginp.handle_login_client, args=('bench', 'bench'))
+    client.start()
+    server_loginp.handle_login_server()
+    client.join()
+    server_sock.close()
+    client_sock.close()
+
+def print_steps(title, steps):
+    total = sum(statistics.mean(t) for t in steps.values())
+    print(title)
+    print("-" * 60)
+    print(f"  {'step':<24} {'mean ms':>10} {'median ms':>10} {'share':>8}")
+    for name, timings in steps.items():
+        mean = statistics.mean(timings)
+        print(f"  {name:<24} {mean:10.3f} {statistics.median(timings):10.3f} {100 * mean / total:7.1f}%")
+    print(f"  {'total':<24} {total:10.3f}")
+    print()
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the steps of the SiFT login and calibrate PBKDF2')
+    parser.add_argument('--repeats', type=int, default=20, help='repetitions of each step')
+    parser.add_argument('--usersfile', default=os.path.join(SERVER_DIR, 'users.txt'), help='users file to take the icount from')
+    parser.add_argument('--keyfile', default=os.path.join(SERVER_DIR, 'server_key.pem'), help='server RSA private key (generated if missing)')
+    parser.add_argument('--calibrate', action='store_true', help='report the PBKDF2 icount for a target verification time')
+    parser.add_argument('--target-ms', type=float, default=100.0, help='target PBKDF2 verification time for calibration')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("SiFT v1.0 login path benchmark")
+    print("=" * 60)
+
+    if args.calibrate:
+        icount, elapsed = calibrate(args.target_ms)
+        print(f"PBKDF2-SHA256 iterations for {args.target_ms:.0f} ms: {icount} (measured {elapsed:.1f} ms)")
+        print(f"Password verifications per core: {1000 / elapsed:.1f}/sec")
+        print("=" * 60)
+        return
+
+    # PEM file of the server key, a temporary one is generated if the server has none yet
+    if os.path.exists(args.keyfile):
+        keyfile, tmp_keyfile = args.keyfile, None
+    else:
+        print("No server key found, generating a 2048-bit RSA key...")
+        fd, tmp_keyfile = tempfile.mkstemp(suffix='.pem')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(RSA.generate(2048).export_key(format='PEM'))
+        keyfile = tmp_keyfile
+
+    icounts = load_icounts(args.usersfile) if os.path.exists(args.usersfile) else [100000]
+    icount = max(icounts)
+    salt = get_random_bytes(16)
+    users = {'bench': {'pwdhash': PBKDF2('bench', salt, 32, count=icount, hmac_hash_module=SHA256),
+                       'icount': icount, 'salt': salt, 'rootdir': 'bench/'}}
+
+    loginp = SiFT_LOGIN(None)
+    loginp.DEBUG = False
+    loginp.load_rsa_private_key(keyfile)
+    rsa_key = loginp.rsa_key
+    temp_key = get_random_bytes(32)
+    etk = PKCS1_OAEP.new(rsa_key.publickey()).encrypt(temp_key)
+    login_req = loginp.build_login_req({'timestamp': time.time_ns(), 'username': 'bench',
+                                        'password': 'bench', 'client_random': get_random_bytes(16)})
+    request_hash = SHA256.new(login_req).digest()
+
+    server_steps = {}
+    server_steps['PEM load'] = time_step(lambda: loginp.load_rsa_private_key(keyfile), args.repeats)
+    server_steps['RSA-OAEP decrypt'] = time_step(lambda: PKCS1_OAEP.new(rsa_key).decrypt(etk), args.repeats)
+    server_steps['parse login_req'] = time_step(lambda: loginp.parse_login_req(login_req), args.repeats)
+    server_steps['SHA256 of request'] = time_step(lambda: SHA256.new(login_req).digest(), args.repeats)
+    server_steps[f'PBKDF2 (icount={icount})'] = time_step(lambda: loginp.check_password('bench', users['bench']), args.repeats)
+    server_steps['HKDF session keys'] = time_step(
+        lambda: loginp.derive_session_keys(get_random_bytes(16), get_random_bytes(16), request_hash), args.repeats)
+    print_steps("Server steps (handle_login_server):", server_steps)
+
+    client_steps = {}
+    client_steps['RSA-OAEP encrypt'] = time_step(lambda: PKCS1_OAEP.new(rsa_key.publickey()).encrypt(temp_key), args.repeats)
+    client_steps['build login_req'] = time_step(lambda: loginp.build_login_req(
+        {'timestamp': time.time_ns(), 'username': 'bench', 'password': 'bench', 'client_random': get_random_bytes(16)}), args.repeats)
+    client_steps['SHA256 of request'] = time_step(lambda: SHA256.new(login_req).digest(), args.repeats)
+    client_steps['HKDF session keys'] = time_step(
+        lambda: loginp.derive_session_keys(get_random_bytes(16), get_random_bytes(16), request_hash), args.repeats)
+    print_steps("Client steps (handle_login_client):", client_steps)
+
+    # the key is loaded once here, server.py also pays the PEM load per connection
+    e2e = time_step(lambda: login_once(rsa_key, users), args.repeats)
+    print(f"End-to-end login over a socketpair (icount={icount}, key already loaded):")
+    print("-" * 60)
+    print(f"  mean {statistics.mean(e2e):.3f} ms, median {statistics.median(e2e):.3f} ms, " +
+          f"{1000 / statistics.mean(e2e):.1f} logins/sec/core")
+    print("=" * 60)
+
+    if tmp_keyfile:
+        os.remove(tmp_keyfile)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Command pipelining benchmark for SiFT v1.0
+Creates and deletes directories over a link with a configurable one-way
+delay, once with send_command (one round trip per command) and once with
+send_command_async at several pipeline depths.
+- the link is a relay thread between two socketpairs that holds every chunk
+  back for the delay before forwarding it
+Results are reported as commands per second.
+"""
+
+import os, sys, time, socket, threading, argparse, tempfile, shutil, heapq
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from Crypto.Random import get_random_bytes
+from siftprotocols.siftmtp import SiFT_MTP
+from siftprotocols.siftcmd import SiFT_CMD
+
+# Forward everything from src to dst after the given delay, until src is closed
+def relay(src, dst, delay):
+    queue, cond = [], threading.Condition()
+    closed = [False]
+
+    def reader():
+        seq = 0
+        while True:
+            try:
+                chunk = src.recv(65536)
+            except OSError:
+                chunk = b''
+            with cond:
+                if not chunk:
+                    closed[0] = True
+                    cond.notify()
+                    return
+                heapq.heappush(queue, (time.perf_counter() + delay, seq, chunk))
+                seq += 1
+                cond.notify()
+
+    def writer():
+        while True:
+            with cond:
+                while not queue and not closed[0]:
+                    cond.wait()
+                if not queue:
+                    dst.shutdown(socket.SHUT_WR)
+                    return
+                due, _, chunk = queue[0]
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    cond.wait(wait)
+                    continue
+                heapq.heappop(queue)
+            dst.sendall(chunk)
+
+    for fn in (reader, writer):
+        threading.Thread(target=fn, daemon=True).start()
+
+# Client and server SiFT_CMD connected through a delayed link, the server runs in a thread
+def delayed_session(rootdir, delay):
+    client_sock, client_end = socket.socketpair()
+    server_end, server_sock = socket.socketpair()
+    relay(client_end, server_end, delay)
+    relay(server_end, client_end, delay)
+
+    server_mtp, client_mtp = SiFT_MTP(server_sock), SiFT_MTP(client_sock)
+    key = get_random_bytes(32)
+    server_mtp.set_session_keys(key, key, is_client=False)
+    client_mtp.set_session_keys(key, key, is_client=True)
+    server_mtp.set_send_coalescing(True)
+    server_cmdp, client_cmdp = SiFT_CMD(server_mtp), SiFT_CMD(client_mtp)
+    for obj in (server_mtp, client_mtp, server_cmdp, client_cmdp):
+        obj.DEBUG = False
+    server_cmdp.set_server_rootdir(rootdir)
+    server_cmdp.set_user_rootdir('bench/')
+
+    def serve():
+        try:
+            while True:
+                server_cmdp.receive_command()
+        except Exception:
+            pass # client closed the connection
+
+    server = threading.Thread(target=serve)
+    server.start()
+    return client_cmdp, client_sock, server
+
+# mkd then del of count directories, returns the commands per second
+def run(rootdir, delay, count, depth, binary):
+    cmdp, sock, server = delayed_session(rootdir, delay)
+    cmdp.set_binary(binary)
+    names = [f'dir_{i:05d}' for i in range(count)]
+    start = time.perf_counter()
+    for command in (cmdp.cmd_mkd, cmdp.cmd_del):
+        if depth:
+            cmdp.set_pipeline_depth(depth)
+            futures = [cmdp.send_command_async({'command': command, 'param_1': name}) for name in names]
+            results = [f.result() for f in futures]
+        else:
+            results = [cmdp.send_command({'command': command, 'param_1': name}) for name in names]
+        if any(r['result_1'] != cmdp.res_success for r in results):
+            raise RuntimeError(command + ' failed on the server')
+    elapsed = time.perf_counter() - start
+    sock.close()
+    server.join()
+    return 2 * count / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure mkd/del throughput with and without pipelining over a delayed link')
+    parser.add_argument('--delay-ms', type=float, default=5.0, help='one-way delay of the link')
+    parser.add_argument('--count', type=int, default=200, help='directories created and deleted per run')
+    parser.add_argument('--depths', default='4,16,64', help='pipeline depths to measure, comma separated')
+    parser.add_argument('--binary', action='store_true', help='use the binary payload encoding')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("SiFT v1.0 command pipelining benchmark")
+    print("=" * 60)
+    print(f"One-way delay {args.delay_ms} ms, {args.count} x mkd + {args.count} x del")
+    print("-" * 60)
+
+    rootdir = tempfile.mkdtemp() + '/'
+    os.makedirs(rootdir + 'bench')
+    delay = args.delay_ms / 1000
+    baseline = run(rootdir, delay, args.count, 0, args.binary)
+    print(f"  {'stop-and-wait':<16} {baseline:10.1f} commands/sec")
+    for depth in [int(d) for d in args.depths.split(',')]:
+        rate = run(rootdir, delay, args.count, depth, args.binary)
+        print(f"  {'depth ' + str(depth):<16} {rate:10.1f} commands/sec  ({rate / baseline:.1f}x)")
+    shutil.rmtree(rootdir)
+    print("=" * 60)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 #python3
 
-import sys, os, socket, cmd, getpass
+import sys, os, time, socket, cmd, getpass, fnmatch
 from Crypto.Hash import SHA256
 from siftprotocols.siftmtp import SiFT_MTP, SiFT_MTP_Error
 from siftprotocols.siftlogin import SiFT_LOGIN, SiFT_LOGIN_Error
@@ -14,9 +14,131 @@ server_ip = '127.0.0.1' # localhost
 server_port = 5150
 pubkey_file = 'server_pubkey.pem'  # Server's RSA public key
 #pubkey_file = 'reference_server_pubkey.pem'  # Server's RSA public key
+x25519_pubkey_file = 'server_x25519_pubkey.pem'  # Server's X25519 public key (selects the X25519 login)
+ticket_file = 'session_ticket.txt'  # Resumption ticket from the last login (None to disable)
+binary_codec = True  # Compact binary payload encoding (False for text payloads)
+listing_cache_ttl = 30.0  # Seconds a directory listing is reused without asking the server (0 to disable)
+trailer_hash_download = True  # Let the server send the file hash after the file instead of hashing it first
 
 # --------------------------------
 
+# Open a connection to the server
+def connect_server():
+    try:
+        sckt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sckt.connect((server_ip, server_port))
+    except:
+        print('Network_Error: Cannot open connection to the server')
+        sys.exit(1)
+    else:
+        print('Connection to server established on ' + server_ip + ':' + str(server_port))
+    return sckt
+
+# Load username, ticket and resumption secret saved at the last login
+def load_ticket():
+    if not ticket_file or not os.path.exists(ticket_file):
+        return None
+    try:
+        with open(ticket_file, 'r') as f:
+            fields = f.read().strip().split(':')
+        return fields[0], bytes.fromhex(fields[1]), bytes.fromhex(fields[2])
+    except:
+        return None
+
+# Save the ticket received at login for resuming the next session
+def save_ticket(username, loginp):
+    if not ticket_file: return
+    if not loginp.ticket:
+        if os.path.exists(ticket_file): os.remove(ticket_file)
+        return
+    fd = os.open(ticket_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(username + ':' + loginp.ticket.hex() + ':' + loginp.resumption_secret.hex())
+
+# Build the request of a shell command given on the command line, it is sent as early data with the login
+# request, so the response arrives one round trip after the login response (upl needs a local file first,
+# pwd is answered by the client), the request must be the one the shell command sends
+def build_early_command(cmdp, line):
+    commands = {'ls': cmdp.cmd_lst, 'cd': cmdp.cmd_chd,
+                'mkd': cmdp.cmd_mkd, 'del': cmdp.cmd_del, 'dnl': cmdp.cmd_dnl}
+    name, _, arg = line.partition(' ')
+    if name not in commands or (arg.startswith('-') and arg != '--refresh'): # options change the request
+        return None
+    if name in ('mkd', 'del') and (len(arg.split()) > 1 or set(arg) & set('*?[')): # sent as a batch after the login
+        return None
+    cmd_req_struct = {}
+    cmd_req_struct['command'] = commands[name]
+    if name == 'ls': # first page of a paged listing, as sent by SiFT_CMD.iter_listing()
+        cmd_req_struct['param_1'] = '0'
+        cmd_req_struct['param_2'] = cmdp.size_lst_entries
+    elif name == 'dnl':
+        cmd_req_struct = build_dnl_request(cmdp, arg.split(' ')[0])
+    else:
+        cmd_req_struct['param_1'] = arg.split(' ')[0]
+    return cmdp.build_early_command(cmd_req_struct)
+
+# Build the download request of a file, asking for the hash after the file if configured
+def build_dnl_request(cmdp, filename):
+    cmd_req_struct = {}
+    cmd_req_struct['command'] = cmdp.cmd_dnl
+    cmd_req_struct['param_1'] = filename
+    if trailer_hash_download: cmd_req_struct['param_2'] = cmdp.dnl_trailer
+    return cmd_req_struct
+
+# Expand the glob patterns among the names against the listing of the current directory on the server
+def expand_globs(names):
+    if not any(set(name) & set('*?[') for name in names):
+        return names
+    entries = [e.rstrip('/') for e in cmdp.get_listing()]
+    expanded = []
+    for name in names:
+        if set(name) & set('*?['):
+            matches = fnmatch.filter(entries, name)
+            if not matches: print('No match for ' + name)
+            expanded += matches
+        else:
+            expanded.append(name)
+    return expanded
+
+# Run the same command on each name in batch requests, the failed items are reported one by one
+def run_batch(command, names, mode=None):
+    cmd_req_structs = [{'command': command, 'param_1': name} for name in names]
+    if mode:
+        for cmd_req_struct in cmd_req_structs: cmd_req_struct['param_2'] = mode
+    try:
+        cmd_res_structs = cmdp.send_batch(cmd_req_structs, stop_on_error=False)
+    except SiFT_CMD_Error as e:
+        print('SiFT_CMD_Error: ' + e.err_msg)
+    else:
+        for name, cmd_res_struct in zip(names, cmd_res_structs):
+            if cmd_res_struct['result_1'] != cmdp.res_success:
+                print('Remote_Error: ' + name + ': ' + cmd_res_struct['result_2'])
+
+# Delete a file or a directory with its content on the server, printing the progress of long deletes
+def delete_tree(name):
+    cmd_req_struct = {}
+    cmd_req_struct['command'] = cmdp.cmd_del
+    cmd_req_struct['param_1'] = name
+    cmd_req_struct['param_2'] = cmdp.del_recursive
+    try:
+        cmd_res_struct = cmdp.send_command(cmd_req_struct, progress=lambda count: print(name + ': ' + str(count) + ' entries deleted...'))
+    except SiFT_CMD_Error as e:
+        print('SiFT_CMD_Error: ' + e.err_msg)
+    else:
+        if cmd_res_struct['result_1'] == cmdp.res_failure:
+            print('Remote_Error: ' + name + ': ' + cmd_res_struct['result_2'])
+
+# Print an entry of a long listing: type, size, modification time, hash (- if not known) and path
+def print_entry(entry):
+    mtime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['mtime_ns'] / 1e9))
+    file_hash = entry['hash'].hex() if entry['hash'] else '-'
+    print(f"{entry['type']} {entry['size']:>12} {mtime} {file_hash} {entry['name']}")
+
+# Print the change events of watched directories
+def print_events(events):
+    for event, path in events:
+        print(f'Event: {event:<6} {path}')
+
 class SiFTShell(cmd.Cmd):
     intro = 'Client shell for the SiFT protocol. Type help or ? to list commands.\n'
     prompt = '(sift) '
@@ -28,38 +150,95 @@ class SiFTShell(cmd.Cmd):
 
         if arg: print('Command arguments are ignored...')
 
-        cmd_req_struct = {}
-        cmd_req_struct['command'] = cmdp.cmd_pwd
+        # the directory is tracked by the client after the first pwd
         try:
-            cmd_res_struct = cmdp.send_command(cmd_req_struct)
+            print(cmdp.get_cwd())
         except SiFT_CMD_Error as e:
             print('SiFT_CMD_Error: ' + e.err_msg)
-        else:
-            if cmd_res_struct['result_1'] == cmdp.res_failure:
-                print('Remote_Error: ' + cmd_res_struct['result_2'])
-            else:
-                print(cmd_res_struct['result_2'])
 
     def do_ls(self, arg):
-        'List content of the current working directory on the server: ls'
+        'List content of the current working directory on the server, a listing is reused for a while unless refreshed, -R lists everything below it: ls [--refresh | -R]'
 
-        if arg: print('Command arguments are ignored...')
+        if arg and arg not in ('--refresh', '-R'): print('Command arguments are ignored...')
 
-        cmd_req_struct = {}
-        cmd_req_struct['command'] = cmdp.cmd_lst
         try:
-            cmd_res_struct = cmdp.send_command(cmd_req_struct)
+            if arg == '-R': entries = list(cmdp.iter_listing(recursive=True))
+            else: entries = cmdp.get_listing(refresh=(arg == '--refresh'))
         except SiFT_CMD_Error as e:
             print('SiFT_CMD_Error: ' + e.err_msg)
         else:
-            if cmd_res_struct['result_1'] == cmdp.res_failure:
-                print('Remote_Error: ' + cmd_res_struct['result_2'])
-            else:
-                if cmd_res_struct['result_2']: print(cmd_res_struct['result_2'])
-                else: print('[empty]')
+            if entries: print('\n'.join(entries))
+            else: print('[empty]')
+
+    def do_sync(self, arg):
+        'Compare the files of a local directory with the current working directory on the server: sync [<localdir>]'
+
+        local_dir = arg.split(' ')[0] or '.'
+        if not os.path.isdir(local_dir):
+            print('Local directory ' + local_dir + ' does not exist')
+            return
+        try:
+            status = cmdp.compare_directory(local_dir)
+        except SiFT_CMD_Error as e:
+            print('SiFT_CMD_Error: ' + e.err_msg)
+        else:
+            if not status: print('[empty]')
+            for name in sorted(status):
+                print(f'{status[name]:<12} {name}')
+
+    def do_manifest(self, arg):
+        'List type, size, modification time and known hash of everything below the current working directory on the server, -d limits the depth, a * ? [] pattern filters the names: manifest [-d <depth>] [<pattern>]'
+
+        args = arg.split()
+        depth = 0
+        if args[:1] == ['-d']:
+            if len(args) < 2 or not args[1].isdigit():
+                print('Depth must be a number')
+                return
+            depth = int(args[1])
+            args = args[2:]
+        try:
+            entries = cmdp.iter_manifest(depth, args[0] if args else None)
+            count = 0
+            for entry in entries:
+                print_entry(entry)
+                count += 1
+        except SiFT_CMD_Error as e:
+            print('SiFT_CMD_Error: ' + e.err_msg)
+        else:
+            if not count: print('[empty]')
+
+    def do_find(self, arg):
+        'Find everything below the current working directory on the server whose name matches a * ? [] pattern or contains a text (at least 3 characters outside of wildcards), filters bound size (bytes) and modification time (seconds since the epoch): find <pattern> [size>=<n>] [mtime<<t>] ...'
+
+        args = arg.split()
+        if not args:
+            print('Pattern is missing')
+            return
+        try:
+            entries = cmdp.iter_find(args[0], ' '.join(args[1:]))
+            count = 0
+            for entry in entries:
+                print_entry(entry)
+                count += 1
+        except SiFT_CMD_Error as e:
+            print('SiFT_CMD_Error: ' + e.err_msg)
+        else:
+            if not count: print('[not found]')
+
+    def do_du(self, arg):
+        'Show the bytes and files below a directory on the server and below each of its subdirectories: du [<path>]'
+
+        try:
+            usage = cmdp.disk_usage(arg.split(' ')[0])
+        except SiFT_CMD_Error as e:
+            print('SiFT_CMD_Error: ' + e.err_msg)
+        else:
+            for entry in usage['subdirs'] + [usage]:
+                print(f"{entry['bytes']:>14} {entry['files']:>9}  {entry['name'] or arg.split(' ')[0] or '.'}")
 
     def do_cd(self, arg):
-        'Change the current working directory on the server: cd <dirname>'
+        'Change the current working directory on the server, the path may have several directories and ..: cd <path>'
 
         cmd_req_struct = {}
         cmd_req_struct['command'] = cmdp.cmd_chd
@@ -73,11 +252,21 @@ class SiFTShell(cmd.Cmd):
                 print('Remote_Error: ' + cmd_res_struct['result_2'])
 
     def do_mkd(self, arg):
-        'Create a new directory in the current working directory on the server: mkd <dirname>'
+        'Create new directories on the server, -p also creates the missing directories of the paths: mkd [-p] <path> [<path> ...]'
+
+        names = arg.split()
+        mode = None
+        if names and names[0] == '-p':
+            mode = cmdp.mkd_parents
+            names = names[1:]
+        if len(names) > 1:
+            run_batch(cmdp.cmd_mkd, names, mode)
+            return
 
         cmd_req_struct = {}
         cmd_req_struct['command'] = cmdp.cmd_mkd
-        cmd_req_struct['param_1'] = arg.split(' ')[0]
+        cmd_req_struct['param_1'] = names[0] if names else ''
+        if mode: cmd_req_struct['param_2'] = mode
         try:
             cmd_res_struct = cmdp.send_command(cmd_req_struct)
         except SiFT_CMD_Error as e:
@@ -87,7 +276,24 @@ class SiFTShell(cmd.Cmd):
                 print('Remote_Error: ' + cmd_res_struct['result_2'])
 
     def do_del(self, arg):
-        'Delete the given file or (empty) directory on the server: del <filename> or del <dirname>'
+        'Delete the given files or (empty) directories on the server, -r also deletes non-empty directories, * ? [] patterns are expanded: del [-r] <name> [<name> ...]'
+
+        names = arg.split()
+        recursive = bool(names) and names[0] == '-r'
+        if recursive: names = names[1:]
+        if len(names) > 1 or any(set(name) & set('*?[') for name in names):
+            try:
+                names = expand_globs(names)
+            except SiFT_CMD_Error as e:
+                print('SiFT_CMD_Error: ' + e.err_msg)
+                return
+            if recursive: # one by one, a recursive delete reports its progress
+                for name in names: delete_tree(name)
+            elif names: run_batch(cmdp.cmd_del, names)
+            return
+        if recursive:
+            delete_tree(names[0] if names else '')
+            return
 
         cmd_req_struct = {}
         cmd_req_struct['command'] = cmdp.cmd_del
@@ -100,6 +306,78 @@ class SiFTShell(cmd.Cmd):
             if cmd_res_struct['result_1'] == cmdp.res_failure:
                 print('Remote_Error: ' + cmd_res_struct['result_2'])
 
+    def do_cpy(self, arg):
+        'Copy a file on the server, into the destination if it is a directory: cpy <path> <destination>'
+        self.copy_or_move(cmdp.cmd_cpy, arg)
+
+    def do_mov(self, arg):
+        'Move or rename a file or directory on the server, into the destination if it is a directory: mov <path> <destination>'
+        self.copy_or_move(cmdp.cmd_mov, arg)
+
+    def copy_or_move(self, command, arg):
+        names = arg.split()
+        if len(names) != 2:
+            print('Source and destination must be given')
+            return
+
+        cmd_req_struct = {}
+        cmd_req_struct['command'] = command
+        cmd_req_struct['param_1'] = names[0]
+        cmd_req_struct['param_2'] = names[1]
+        try:
+            cmd_res_struct = cmdp.send_command(cmd_req_struct)
+        except SiFT_CMD_Error as e:
+            print('SiFT_CMD_Error: ' + e.err_msg)
+        else:
+            if cmd_res_struct['result_1'] == cmdp.res_failure:
+                print('Remote_Error: ' + cmd_res_struct['result_2'])
+
+    def do_stat(self, arg):
+        'Show type, size, modification time and hash of files or directories on the server, -h lets the server compute hashes it does not know yet: stat [-h] <path> [<path> ...]'
+
+        names = arg.split()
+        compute_hash = bool(names) and names[0] == '-h'
+        if compute_hash: names = names[1:]
+        if not names:
+            print('A path must be given')
+            return
+        try:
+            entries = cmdp.stat_paths(names, compute_hash)
+        except SiFT_CMD_Error as e:
+            print('SiFT_CMD_Error: ' + e.err_msg)
+        else:
+            for entry in entries:
+                if entry['type'] == '-':
+                    print('Remote_Error: ' + entry['name'] + ': File or directory does not exist')
+                else:
+                    print_entry(entry)
+
+    def do_watch(self, arg):
+        'Watch a directory on the server for changes, its events are shown as they arrive, -s stops watching it: watch [-s] [<path>]'
+
+        args = arg.split()
+        stop = args[:1] == ['-s']
+        if stop: args = args[1:]
+        cmdp.set_watch_handler(print_events)
+        try:
+            cmdp.watch(args[0] if args else '', stop)
+        except SiFT_CMD_Error as e:
+            print('SiFT_CMD_Error: ' + e.err_msg)
+
+    def do_events(self, arg):
+        'Wait for change events of the watched directories and show them: events [<seconds>]'
+
+        try:
+            timeout = float(arg.split()[0]) if arg.split() else 10.0
+        except ValueError:
+            print('Seconds must be a number')
+            return
+        deadline = time.monotonic() + timeout
+        try:
+            while time.monotonic() < deadline and cmdp.wait_events(deadline - time.monotonic()): pass
+        except SiFT_CMD_Error as e:
+            print('SiFT_CMD_Error: ' + e.err_msg)
+
     def do_upl(self, arg):
         'Upload the given file to the server: upl <filename>'
 
@@ -145,9 +423,7 @@ class SiFTShell(cmd.Cmd):
     def do_dnl(self, arg):
         'Download the given file from the server: dnl <filename>'
 
-        cmd_req_struct = {}
-        cmd_req_struct['command'] = cmdp.cmd_dnl
-        cmd_req_struct['param_1'] = arg.split(' ')[0]
+        cmd_req_struct = build_dnl_request(cmdp, arg.split(' ')[0])
         try:
             cmd_res_struct = cmdp.send_command(cmd_req_struct)
         except SiFT_CMD_Error as e:
@@ -156,8 +432,9 @@ class SiFTShell(cmd.Cmd):
             if cmd_res_struct['result_1'] == cmdp.res_reject:
                 print('Remote_Error: ' + cmd_res_struct['result_2'])
             else:
+                # an empty hash is sent by the server after the file and checked at the end of the download
                 print('File size: ' + str(cmd_res_struct['result_2']))
-                print('File hash: ' + cmd_res_struct['result_3'].hex())
+                print('File hash: ' + (cmd_res_struct['result_3'].hex() or '(sent after the file)'))
                 yn = ''
                 while yn not in ('y', 'yes', 'Y', 'YES', 'Yes', 'n', 'no', 'N', 'NO', 'No'):
                     yn = input('Do you want to proceed? (y/n) ')
@@ -165,10 +442,12 @@ class SiFTShell(cmd.Cmd):
                     print('Starting download...')
                     dnlp = SiFT_DNL(mtp)
                     try:
-                        file_hash = dnlp.handle_download_client(cmd_req_struct['param_1'])
+                        file_hash = dnlp.handle_download_client(cmd_req_struct['param_1'], trailer=not cmd_res_struct['result_3'])
                     except SiFT_DNL_Error as e:
                         print('Remote_Error: ' + e.err_msg)
                     else:
+                        if cmd_res_struct['result_3'] and file_hash != cmd_res_struct['result_3']:
+                            print('Warning: hash of the downloaded file does not match the hash sent by the server')
                         print('Completed.')
 
                 else:
@@ -191,53 +470,87 @@ class SiFTShell(cmd.Cmd):
 if __name__ == '__main__':
 
     # Check if public key file exists
-    if not os.path.exists(pubkey_file):
+    if not os.path.exists(pubkey_file) and not os.path.exists(x25519_pubkey_file):
         print(f'Error: Server public key file "{pubkey_file}" not found!')
         print('Please run generate_keys.py first and copy server_pubkey.pem to the client folder.')
         sys.exit(1)
 
-    # Connect to server
-    try:
-        sckt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sckt.connect((server_ip, server_port))
-    except:
-        print('Network_Error: Cannot open connection to the server')
-        sys.exit(1)
-    else:
-        print('Connection to server established on ' + server_ip + ':' + str(server_port))
-
-    # Create MTP instance
-    mtp = SiFT_MTP(sckt)
-
-    # Create login protocol instance
-    loginp = SiFT_LOGIN(mtp)
-
-    # Load server's RSA public key
-    try:
-        loginp.load_rsa_public_key(pubkey_file)
-        print(f'Server public key loaded from {pubkey_file}')
-    except SiFT_LOGIN_Error as e:
-        print('SiFT_LOGIN_Error: ' + e.err_msg)
-        sys.exit(1)
-
-    # Get credentials
-    print()
-    username = input('   Username: ')
-    password = getpass.getpass('   Password: ')
-    print()
+    # A command given on the command line is executed right after the login and the client exits
+    # (e.g. python3 client.py ls), it is sent together with the login request if possible
+    cmdp = SiFT_CMD(None)
+    cmdp.set_binary(binary_codec)
+    cmdp.set_cache_ttl(listing_cache_ttl)
+    oneshot = ' '.join(sys.argv[1:])
+    early_payload = build_early_command(cmdp, oneshot) if oneshot else None
+
+    # Try to resume the previous session with a saved ticket first
+    logged_in = False
+    saved_ticket = load_ticket()
+    if saved_ticket:
+        username, ticket, resumption_secret = saved_ticket
+        sckt = connect_server()
+        mtp = SiFT_MTP(sckt)
+        loginp = SiFT_LOGIN(mtp)
+        loginp.set_binary(binary_codec)
+        try:
+            loginp.handle_resume_client(username, ticket, resumption_secret, early_payload)
+            print('Session of ' + username + ' resumed!')
+            print()
+            logged_in = True
+        except SiFT_LOGIN_Error as e:
+            # the server closes the connection on failure, so a full login needs a new one
+            print('Session resumption failed --> ' + e.err_msg)
+            sckt.close()
+
+    if not logged_in:
+        # Connect to server
+        sckt = connect_server()
+
+        # Create MTP instance
+        mtp = SiFT_MTP(sckt)
+
+        # Create login protocol instance
+        loginp = SiFT_LOGIN(mtp)
+        loginp.set_binary(binary_codec)
+
+        # Load server's X25519 public key if present, otherwise its RSA public key
+        try:
+            if os.path.exists(x25519_pubkey_file):
+                loginp.load_x25519_public_key(x25519_pubkey_file)
+                print(f'Server X25519 public key loaded from {x25519_pubkey_file}')
+            else:
+                loginp.load_rsa_public_key(pubkey_file)
+                print(f'Server public key loaded from {pubkey_file}')
+        except SiFT_LOGIN_Error as e:
+            print('SiFT_LOGIN_Error: ' + e.err_msg)
+            sys.exit(1)
 
-    # Perform login
-    try:
-        loginp.handle_login_client(username, password)
-        print('Login successful!')
+        # Get credentials
+        print()
+        username = input('   Username: ')
+        password = getpass.getpass('   Password: ')
         print()
-    except SiFT_LOGIN_Error as e:
-        print('SiFT_LOGIN_Error: ' + e.err_msg)
-        sckt.close()
-        sys.exit(1)
-
-    # Create command protocol instance
-    cmdp = SiFT_CMD(mtp)
 
-    # Start interactive shell
-    SiFTShell().cmdloop()
+        # Perform login
+        try:
+            loginp.handle_login_client(username, password, early_payload)
+            print('Login successful!')
+            print()
+        except SiFT_LOGIN_Error as e:
+            print('SiFT_LOGIN_Error: ' + e.err_msg)
+            sckt.close()
+            sys.exit(1)
+
+    # Keep the fresh ticket for the next session
+    save_ticket(username, loginp)
+
+    # Command protocol runs on the connection that logged in
+    cmdp.mtp = mtp
+
+    if oneshot:
+        shell = SiFTShell()
+        shell.onecmd(oneshot)
+        shell.onecmd('bye')
+    else:
+        # Start interactive shell
+        SiFTShell().cmdloop()
@@ -3,10 +3,13 @@
 import time
 from Crypto.Hash import SHA256
 from Crypto.Protocol.KDF import PBKDF2, HKDF
-from Crypto.PublicKey import RSA
+from Crypto.PublicKey import RSA, ECC
+from Crypto.Protocol.DH import key_agreement, import_x25519_public_key
 from Crypto.Cipher import PKCS1_OAEP
 from Crypto.Random import get_random_bytes
 from siftprotocols.siftmtp import SiFT_MTP, SiFT_MTP_Error
+from siftprotocols.siftticket import SiFT_TICKET_Error
+from siftprotocols.sifttlv import SiFT_TLV
 
 
 class SiFT_LOGIN_Error(Exception):
@@ -23,16 +26,33 @@ class SiFT_LOGIN:
         self.coding = 'utf-8'
         self.size_temp_key = 32 # 32-byte AES key
         self.size_random = 16 # 16-byte random value
+        self.size_resumption_secret = 32 # 32-byte secret bound to a resumption ticket
+        self.size_max_login_payload = 2048 # larger login requests are rejected before any crypto
+        self.timestamp_window = 2000000000 # acceptance window of login timestamps (+-2 seconds in ns)
+        self.early_data = '1' # login request flag announcing an early command request
+        self.tlv_req = SiFT_TLV(('timestamp', 'username', 'password', 'client_random', 'early_data'))
+        self.tlv_res = SiFT_TLV(('request_hash', 'server_random', 'ticket', 'server_epk'))
         # --------- STATE ------------
         self.mtp = mtp
         self.server_users = None
         self.rsa_key = None  # RSA key (public for client, private for server)
+        self.x25519_key = None  # Long-term X25519 key (public for client, private for server)
+        self.ticket_mgr = None  # Ticket manager issuing resumption tickets (for server)
+        self.replay_cache = None  # Recently seen login requests, shared by all sessions (for server)
+        self.ticket = None  # Resumption ticket received at the last login (for client)
+        self.resumption_secret = None  # Secret bound to the ticket (for client)
+        self.binary = False  # Binary encoding of login payloads (chosen by the client, mirrored by the server)
 
     # Set RSA key (public or private)
     def set_rsa_key(self, rsa_key):
         self.rsa_key = rsa_key
 
 
+    # Set X25519 key (public or private)
+    def set_x25519_key(self, x25519_key):
+        self.x25519_key = x25519_key
+
+
     # Load RSA public key from PEM file (for client)
     def load_rsa_public_key(self, pubkey_file):
         try:
@@ -61,44 +81,121 @@ class SiFT_LOGIN:
             raise SiFT_LOGIN_Error(f'Failed to load RSA private key --> {str(e)}')
 
 
+    # Load X25519 public key from PEM file (for client, selects the X25519 login mode)
+    def load_x25519_public_key(self, pubkey_file):
+        try:
+            with open(pubkey_file, 'rb') as f:
+                self.x25519_key = ECC.import_key(f.read())
+            
+            # Verify it's an X25519 public key
+            if self.x25519_key.curve != 'Curve25519' or self.x25519_key.has_private():
+                raise SiFT_LOGIN_Error('Expected X25519 public key')
+                
+        except Exception as e:
+            raise SiFT_LOGIN_Error(f'Failed to load X25519 public key --> {str(e)}')
+
+
+    # Load X25519 private key from PEM file (for server, enables the X25519 login mode)
+    def load_x25519_private_key(self, privkey_file):
+        try:
+            with open(privkey_file, 'rb') as f:
+                self.x25519_key = ECC.import_key(f.read())
+            
+            # Verify it's an X25519 private key
+            if self.x25519_key.curve != 'Curve25519' or not self.x25519_key.has_private():
+                raise SiFT_LOGIN_Error('Expected X25519 private key')
+                
+        except Exception as e:
+            raise SiFT_LOGIN_Error(f'Failed to load X25519 private key --> {str(e)}')
+
+
     # Set server users database (for server)
     def set_server_users(self, users):
         self.server_users = users
 
 
+    # Set ticket manager to issue and accept resumption tickets (for server)
+    def set_ticket_manager(self, ticket_mgr):
+        self.ticket_mgr = ticket_mgr
+
+
+    # Set replay cache rejecting login requests seen within the timestamp window (for server)
+    def set_replay_cache(self, replay_cache):
+        self.replay_cache = replay_cache
+
+
+    # Select the binary encoding of the login request (for client)
+    def set_binary(self, binary):
+        self.binary = binary
+
+
     # Build login request payload
     def build_login_req(self, login_req_struct):
+        if self.binary:
+            return self.tlv_req.encode(login_req_struct)
         login_req_str = str(login_req_struct['timestamp'])
         login_req_str += self.delimiter + login_req_struct['username']
         login_req_str += self.delimiter + login_req_struct['password']
         login_req_str += self.delimiter + login_req_struct['client_random'].hex()
+        if login_req_struct.get('early_data'):
+            login_req_str += self.delimiter + self.early_data
         return login_req_str.encode(self.coding)
 
 
     # Parse login request payload
     def parse_login_req(self, login_req):
+        if self.tlv_req.is_binary(login_req):
+            login_req_struct = self.tlv_req.decode(login_req)
+            for field, field_type in (('timestamp', int), ('username', str), ('password', str), ('client_random', bytes)):
+                if not isinstance(login_req_struct.get(field), field_type):
+                    raise SiFT_LOGIN_Error('Missing or malformed ' + field + ' in login request')
+            login_req_struct['early_data'] = bool(login_req_struct.get('early_data'))
+            return login_req_struct
         login_req_fields = login_req.decode(self.coding).split(self.delimiter)
         login_req_struct = {}
         login_req_struct['timestamp'] = int(login_req_fields[0])
         login_req_struct['username'] = login_req_fields[1]
         login_req_struct['password'] = login_req_fields[2]
         login_req_struct['client_random'] = bytes.fromhex(login_req_fields[3])
+        login_req_struct['early_data'] = len(login_req_fields) > 4 and login_req_fields[4] == self.early_data
         return login_req_struct
 
 
     # Build login response payload
     def build_login_res(self, login_res_struct):
+        if self.binary:
+            return self.tlv_res.encode(login_res_struct)
         login_res_str = login_res_struct['request_hash'].hex()
         login_res_str += self.delimiter + login_res_struct['server_random'].hex()
+        if login_res_struct.get('ticket') or login_res_struct.get('server_epk'):
+            login_res_str += self.delimiter + (login_res_struct.get('ticket') or b'').hex()
+        if login_res_struct.get('server_epk'):
+            login_res_str += self.delimiter + login_res_struct['server_epk'].hex()
         return login_res_str.encode(self.coding)
 
 
     # Parse login response payload
     def parse_login_res(self, login_res):
+        if self.tlv_res.is_binary(login_res):
+            login_res_struct = self.tlv_res.decode(login_res)
+            for field in ('request_hash', 'server_random'):
+                if not isinstance(login_res_struct.get(field), bytes):
+                    raise SiFT_LOGIN_Error('Missing or malformed ' + field + ' in login response')
+            login_res_struct['ticket'] = login_res_struct.get('ticket') or None
+            login_res_struct['server_epk'] = login_res_struct.get('server_epk')
+            return login_res_struct
         login_res_fields = login_res.decode(self.coding).split(self.delimiter)
         login_res_struct = {}
         login_res_struct['request_hash'] = bytes.fromhex(login_res_fields[0])
         login_res_struct['server_random'] = bytes.fromhex(login_res_fields[1])
+        if len(login_res_fields) > 2 and login_res_fields[2]:
+            login_res_struct['ticket'] = bytes.fromhex(login_res_fields[2])
+        else:
+            login_res_struct['ticket'] = None
+        if len(login_res_fields) > 3:
+            login_res_struct['server_epk'] = bytes.fromhex(login_res_fields[3])
+        else:
+            login_res_struct['server_epk'] = None
         return login_res_struct
 
 
@@ -111,9 +208,9 @@ class SiFT_LOGIN:
         return False
 
 
-    # Derive session keys from client and server randoms
-    def derive_session_keys(self, client_random, server_random, request_hash):
-        ikm = client_random + server_random
+    # Derive session keys from client and server randoms (and the resumption secret if resuming)
+    def derive_session_keys(self, client_random, server_random, request_hash, secret=b''):
+        ikm = secret + client_random + server_random
     
         # use request_hash as salt
         final_transfer_key = HKDF(
@@ -126,14 +223,65 @@ class SiFT_LOGIN:
         # Retrn same key twice for compatibility
         return final_transfer_key, final_transfer_key
 
+
+    # Derive the secret bound to a resumption ticket from the established session key
+    def derive_resumption_secret(self, final_transfer_key, request_hash):
+        return HKDF(
+            master=final_transfer_key,
+            key_len=self.size_resumption_secret,
+            salt=request_hash,
+            hashmod=SHA256,
+            context=b'SiFT resumption secret'
+        )
+
+
+    # Derive the key of the early command request from values known to both sides before the login response
+    def derive_early_data_key(self, client_random, request_hash, secret=b''):
+        return HKDF(
+            master=secret + client_random,
+            key_len=32,
+            salt=request_hash,
+            hashmod=SHA256,
+            context=b'SiFT early data key'
+        )
+
+
+    # Compute an X25519 shared secret between our private key and the peer's raw public key
+    def x25519_shared_secret(self, priv_key, peer_epk):
+        try:
+            peer_key = import_x25519_public_key(peer_epk)
+        except ValueError as e:
+            raise SiFT_LOGIN_Error(f'Invalid X25519 public key --> {str(e)}')
+        return key_agreement(static_priv=priv_key, eph_pub=peer_key, kdf=lambda z: z)
+
+
+    # Derive the temporary key protecting an X25519 login request from the client-ephemeral/server-static secret
+    def derive_x25519_temp_key(self, shared_secret, client_epk):
+        server_pk = self.x25519_key.public_key().export_key(format='raw')
+        return HKDF(
+            master=shared_secret,
+            key_len=self.size_temp_key,
+            salt=client_epk + server_pk,
+            hashmod=SHA256,
+            context=b'SiFT X25519 temporary key'
+        )
+
+
+    # Derive the temporary key protecting a resumed login request
+    def derive_resumption_temp_key(self, resumption_secret, ticket):
+        return HKDF(
+            master=resumption_secret,
+            key_len=self.size_temp_key,
+            salt=SHA256.new(ticket).digest(),
+            hashmod=SHA256,
+            context=b'SiFT resumption temporary key'
+        )
+
     # Handle login process on the server side
     def handle_login_server(self):
-        if not self.server_users:
+        if self.server_users is None:
             raise SiFT_LOGIN_Error('User database is required for handling login at server')
 
-        if not self.rsa_key or not self.rsa_key.has_private():
-            raise SiFT_LOGIN_Error('RSA private key required for server login')
-        
         # receive header first
         try:
             msg_hdr = self.mtp.receive_bytes(self.mtp.size_msg_hdr)
@@ -144,47 +292,124 @@ class SiFT_LOGIN:
         parsed_msg_hdr = self.mtp.parse_msg_header(msg_hdr)
         
         # Verify its a login request
-        if parsed_msg_hdr['typ'] != self.mtp.type_login_req:
+        if parsed_msg_hdr['typ'] not in self.mtp.login_req_types:
             raise SiFT_LOGIN_Error('Login request expected, but received something else')
+
+        # Fast checks on the header before any expensive crypto is done
+        if parsed_msg_hdr['ver'] != self.mtp.msg_hdr_ver:
+            raise SiFT_LOGIN_Error('Unsupported version found in login request header')
+        if int.from_bytes(parsed_msg_hdr['sqn'], byteorder='big') != self.mtp.sqn_receive:
+            raise SiFT_LOGIN_Error('Sequence number mismatch in login request header')
         
         # Get message length
         msg_len = int.from_bytes(parsed_msg_hdr['len'], byteorder='big')
         
         # Calculate sizes
         body_len = msg_len - self.mtp.size_msg_hdr
-        epd_len = body_len - self.mtp.size_msg_mac - self.mtp.size_etk
-        
-        # Receive encrypted payload
-        try:
-            encrypted_payload = self.mtp.receive_bytes(epd_len)
-        except SiFT_MTP_Error as e:
-            raise SiFT_LOGIN_Error('Unable to receive encrypted payload --> ' + e.err_msg)
-        
-        # Receive MAC
-        try:
-            mac = self.mtp.receive_bytes(self.mtp.size_msg_mac)
-        except SiFT_MTP_Error as e:
-            raise SiFT_LOGIN_Error('Unable to receive MAC --> ' + e.err_msg)
-        
-        # Receive encrypted temporary key
-        try:
-            etk = self.mtp.receive_bytes(self.mtp.size_etk)
-        except SiFT_MTP_Error as e:
-            raise SiFT_LOGIN_Error('Unable to receive encrypted temporary key --> ' + e.err_msg)
+        if body_len <= self.mtp.size_msg_mac:
+            raise SiFT_LOGIN_Error('Login request has incorrect size')
 
-        # Decrypt temporary key from etk using RSA-OAEP
-        try:
-            cipher = PKCS1_OAEP.new(self.rsa_key)
-            temp_key = cipher.decrypt(etk)
+        # Server ephemeral key of an X25519 login, sent back in the login response
+        server_eph_key = None
+
+        if parsed_msg_hdr['typ'] == self.mtp.type_login_req:
+            if not self.rsa_key or not self.rsa_key.has_private():
+                raise SiFT_LOGIN_Error('RSA private key required for server login')
+
+            epd_len = body_len - self.mtp.size_msg_mac - self.mtp.size_etk
+            if epd_len <= 0 or epd_len > self.size_max_login_payload:
+                raise SiFT_LOGIN_Error('Login request has incorrect size')
             
-            if len(temp_key) != self.size_temp_key:
-                raise SiFT_LOGIN_Error('Decrypted temporary key has incorrect size')
+            # Receive encrypted payload
+            try:
+                encrypted_payload = self.mtp.receive_bytes(epd_len)
+            except SiFT_MTP_Error as e:
+                raise SiFT_LOGIN_Error('Unable to receive encrypted payload --> ' + e.err_msg)
             
-            # Set temporary key in MTP (server side)
-            self.mtp.set_temp_key(temp_key, is_client=False)
+            # Receive MAC
+            try:
+                mac = self.mtp.receive_bytes(self.mtp.size_msg_mac)
+            except SiFT_MTP_Error as e:
+                raise SiFT_LOGIN_Error('Unable to receive MAC --> ' + e.err_msg)
             
-        except Exception as e:
-            raise SiFT_LOGIN_Error(f'Failed to decrypt temporary key --> {str(e)}')
+            # Receive encrypted temporary key
+            try:
+                etk = self.mtp.receive_bytes(self.mtp.size_etk)
+            except SiFT_MTP_Error as e:
+                raise SiFT_LOGIN_Error('Unable to receive encrypted temporary key --> ' + e.err_msg)
+
+            # Decrypt temporary key from etk using RSA-OAEP
+            try:
+                cipher = PKCS1_OAEP.new(self.rsa_key)
+                temp_key = cipher.decrypt(etk)
+                
+                if len(temp_key) != self.size_temp_key:
+                    raise SiFT_LOGIN_Error('Decrypted temporary key has incorrect size')
+                
+                # Set temporary key in MTP (server side)
+                self.mtp.set_temp_key(temp_key, is_client=False)
+                
+            except Exception as e:
+                raise SiFT_LOGIN_Error(f'Failed to decrypt temporary key --> {str(e)}')
+
+            ticket_username, session_secret = None, b''
+            early_secret = session_secret
+
+        elif parsed_msg_hdr['typ'] == self.mtp.type_login_req_x25519:
+            if not self.x25519_key or not self.x25519_key.has_private():
+                raise SiFT_LOGIN_Error('X25519 login is not supported by this server')
+
+            epd_len = body_len - self.mtp.size_msg_mac - self.mtp.size_epk
+            if epd_len <= 0 or epd_len > self.size_max_login_payload:
+                raise SiFT_LOGIN_Error('Login request has incorrect size')
+
+            # Receive encrypted payload, MAC and client ephemeral public key
+            try:
+                encrypted_payload = self.mtp.receive_bytes(epd_len)
+                mac = self.mtp.receive_bytes(self.mtp.size_msg_mac)
+                etk = self.mtp.receive_bytes(self.mtp.size_epk)
+            except SiFT_MTP_Error as e:
+                raise SiFT_LOGIN_Error('Unable to receive X25519 login request --> ' + e.err_msg)
+
+            # Derive temporary key from client ephemeral and server static keys (no RSA decryption needed)
+            static_secret = self.x25519_shared_secret(self.x25519_key, etk)
+            temp_key = self.derive_x25519_temp_key(static_secret, etk)
+            self.mtp.set_temp_key(temp_key, is_client=False)
+
+            # Ephemeral-ephemeral secret gives forward secrecy to the session keys
+            server_eph_key = ECC.generate(curve='Curve25519')
+            ticket_username = None
+            session_secret = self.x25519_shared_secret(server_eph_key, etk) + static_secret
+            early_secret = static_secret # the client sends early data before it knows the ephemeral secret
+
+        else: # resumed login, the ticket replaces the etk
+            if not self.ticket_mgr:
+                raise SiFT_LOGIN_Error('Resumed login is not supported by this server')
+
+            # Receive encrypted payload, MAC and ticket trailer at once, their sizes are only known from the end
+            try:
+                msg_body = self.mtp.receive_bytes(body_len)
+            except SiFT_MTP_Error as e:
+                raise SiFT_LOGIN_Error('Unable to receive resumed login request --> ' + e.err_msg)
+
+            ticket_len = int.from_bytes(msg_body[-self.mtp.size_ticket_len:], byteorder='big')
+            epd_len = body_len - self.mtp.size_ticket_len - ticket_len - self.mtp.size_msg_mac
+            if epd_len <= 0 or epd_len > self.size_max_login_payload:
+                raise SiFT_LOGIN_Error('Resumed login request has incorrect size')
+            encrypted_payload = msg_body[:epd_len]
+            mac = msg_body[epd_len:epd_len+self.mtp.size_msg_mac]
+            etk = msg_body[epd_len+self.mtp.size_msg_mac:-self.mtp.size_ticket_len]
+
+            # Open the ticket to recover the resumption secret
+            try:
+                ticket_username, session_secret, ticket_binding = self.ticket_mgr.open_ticket(etk)
+            except SiFT_TICKET_Error as e:
+                raise SiFT_LOGIN_Error('Resumption ticket rejected --> ' + e.err_msg)
+
+            # Derive temporary key from the ticket (no RSA decryption needed)
+            temp_key = self.derive_resumption_temp_key(session_secret, etk)
+            self.mtp.set_temp_key(temp_key, is_client=False)
+            early_secret = session_secret
         
         # Decrypt the payload using the temporary key
         try:
@@ -198,7 +423,7 @@ class SiFT_LOGIN:
         # DEBUG 
         if self.DEBUG:
             print('Incoming login request payload (' + str(len(msg_payload)) + '):')
-            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8'))
+            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8', errors='backslashreplace'))
             print('ETK (' + str(len(etk)) + '): ' + etk.hex()[:64] + '...')
             print('------------------------------------------')
         # DEBUG 
@@ -216,7 +441,8 @@ class SiFT_LOGIN:
         hash_fn.update(msg_payload)
         request_hash = hash_fn.digest()
 
-        # Parse login request
+        # Parse login request, the response uses the encoding of the request
+        self.binary = self.tlv_req.is_binary(msg_payload)
         try:
             login_req_struct = self.parse_login_req(msg_payload)
         except Exception as e:
@@ -226,41 +452,57 @@ class SiFT_LOGIN:
         current_time = int(time.time_ns())
         timestamp_diff_seconds = abs(current_time - login_req_struct['timestamp'])
         
-        if timestamp_diff_seconds > 2000000000:
+        if timestamp_diff_seconds > self.timestamp_window:
             raise SiFT_LOGIN_Error(f'Timestamp verification failed - difference: {timestamp_diff_seconds:.2f} seconds')
 
+        # Reject a replay of a request seen within the timestamp window (it could carry an early command)
+        if self.replay_cache is not None:
+            if not self.replay_cache.check_and_add(request_hash, login_req_struct['timestamp'] + self.timestamp_window):
+                raise SiFT_LOGIN_Error('Replayed login request rejected')
+
         # Verify client_random size
         if len(login_req_struct['client_random']) != self.size_random:
             raise SiFT_LOGIN_Error('Client random has incorrect size')
 
-        # Check username and password
-        if login_req_struct['username'] in self.server_users:
-            if not self.check_password(login_req_struct['password'], 
-                                      self.server_users[login_req_struct['username']]):
-                raise SiFT_LOGIN_Error('Password verification failed')
-        else:
+        # Check username and password (or the ticket when resuming)
+        if login_req_struct['username'] not in self.server_users:
             raise SiFT_LOGIN_Error('Unknown user attempted to log in')
+        if ticket_username is not None:
+            if login_req_struct['username'] != ticket_username:
+                raise SiFT_LOGIN_Error('Resumption ticket was issued to another user')
+            if ticket_binding != self.ticket_mgr.user_binding(self.server_users[login_req_struct['username']]):
+                raise SiFT_LOGIN_Error('Resumption ticket was issued before the password of the user changed or was revoked')
+        elif not self.check_password(login_req_struct['password'], 
+                                     self.server_users[login_req_struct['username']]):
+            raise SiFT_LOGIN_Error('Password verification failed')
 
         # Generate server random
         server_random = get_random_bytes(self.size_random)
 
-        # Build login response
+        # Derive session keys
+        final_transfer_key, _ = \
+            self.derive_session_keys(login_req_struct['client_random'], server_random, request_hash,
+                                     secret=session_secret)
+
+        # Build login response (with a fresh resumption ticket if tickets are enabled)
         login_res_struct = {}
         login_res_struct['request_hash'] = request_hash
         login_res_struct['server_random'] = server_random
+        if self.ticket_mgr:
+            login_res_struct['ticket'] = self.ticket_mgr.issue_ticket(login_req_struct['username'],
+                self.derive_resumption_secret(final_transfer_key, request_hash),
+                self.ticket_mgr.user_binding(self.server_users[login_req_struct['username']]))
+        if server_eph_key:
+            login_res_struct['server_epk'] = server_eph_key.public_key().export_key(format='raw')
         msg_payload = self.build_login_res(login_res_struct)
 
         # DEBUG 
         if self.DEBUG:
             print('Outgoing login response payload (' + str(len(msg_payload)) + '):')
-            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8'))
+            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8', errors='backslashreplace'))
             print('------------------------------------------')
         # DEBUG 
 
-        # Derive session keys
-        final_transfer_key, _ = \
-            self.derive_session_keys(login_req_struct['client_random'], server_random, request_hash)
-
         # DEBUG
         if self.DEBUG:
             print('Derived session keys:')
@@ -271,6 +513,11 @@ class SiFT_LOGIN:
         # Set session keys in MTP (server side, so is_client=False)
         self.mtp.set_session_keys(final_transfer_key, final_transfer_key, is_client=False)
 
+        # The client sent its first command right behind the login request, it is received next
+        if login_req_struct['early_data']:
+            self.mtp.set_early_key(self.derive_early_data_key(login_req_struct['client_random'],
+                                                              request_hash, secret=early_secret))
+
         # Send login response
         try:
             self.mtp.send_msg(self.mtp.type_login_res, msg_payload)
@@ -286,7 +533,10 @@ class SiFT_LOGIN:
 
 
     # Handle login process on the client side
-    def handle_login_client(self, username, password):
+    def handle_login_client(self, username, password, early_payload=None):
+        if self.x25519_key:
+            return self.handle_login_client_x25519(username, password, early_payload)
+
         if not self.rsa_key or self.rsa_key.has_private():
             raise SiFT_LOGIN_Error('RSA public key required for client login')
 
@@ -306,6 +556,50 @@ class SiFT_LOGIN:
         except Exception as e:
             raise SiFT_LOGIN_Error(f'Failed to encrypt temporary key --> {str(e)}')
 
+        self.login_client(username, password, self.mtp.type_login_req, etk, early_payload=early_payload)
+
+
+    # Handle login on the client side with an ephemeral X25519 key exchange instead of RSA-OAEP
+    def handle_login_client_x25519(self, username, password, early_payload=None):
+        if not self.x25519_key or self.x25519_key.has_private():
+            raise SiFT_LOGIN_Error('X25519 public key required for client login')
+
+        # explicitly set is_client FIRST
+        self.mtp.is_client = True
+
+        # Generate ephemeral key and derive the temp key from it and the server static key
+        client_eph_key = ECC.generate(curve='Curve25519')
+        client_epk = client_eph_key.public_key().export_key(format='raw')
+        static_secret = self.x25519_shared_secret(client_eph_key, self.x25519_key.export_key(format='raw'))
+        temp_key = self.derive_x25519_temp_key(static_secret, client_epk)
+
+        # Set temp key in MTP for this login request (client side)
+        self.mtp.set_temp_key(temp_key, is_client=True)
+
+        self.login_client(username, password, self.mtp.type_login_req_x25519, client_epk,
+                          secret=static_secret, eph_key=client_eph_key, early_payload=early_payload)
+
+
+    # Handle resumed login on the client side using a ticket from an earlier login (no RSA needed)
+    def handle_resume_client(self, username, ticket, resumption_secret, early_payload=None):
+        if not ticket or len(resumption_secret) != self.size_resumption_secret:
+            raise SiFT_LOGIN_Error('Resumption ticket and secret required for resumed login')
+
+        # explicitly set is_client FIRST
+        self.mtp.is_client = True
+
+        # Derive temp key from the resumption secret and set it in MTP (client side)
+        temp_key = self.derive_resumption_temp_key(resumption_secret, ticket)
+        self.mtp.set_temp_key(temp_key, is_client=True)
+
+        self.login_client(username, '', self.mtp.type_login_req_resume, ticket, secret=resumption_secret,
+                          early_payload=early_payload)
+
+
+    # Send the login request and process the login response (client side, temp key already set)
+    # If early_payload is given, it is sent as a command request right behind the login request
+    def login_client(self, username, password, msg_type, etk, secret=b'', eph_key=None, early_payload=None):
+
         # Generate client random
         client_random = get_random_bytes(self.size_random)
 
@@ -318,12 +612,13 @@ class SiFT_LOGIN:
         login_req_struct['username'] = username
         login_req_struct['password'] = password
         login_req_struct['client_random'] = client_random
+        login_req_struct['early_data'] = early_payload is not None
         msg_payload = self.build_login_req(login_req_struct)
 
         # DEBUG 
         if self.DEBUG:
             print('Outgoing login request payload (' + str(len(msg_payload)) + '):')
-            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8'))
+            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8', errors='backslashreplace'))
             print('ETK (' + str(len(etk)) + '): ' + etk.hex()[:64] + '...')
             print('------------------------------------------')
         # DEBUG 
@@ -333,12 +628,20 @@ class SiFT_LOGIN:
         hash_fn.update(msg_payload)
         request_hash = hash_fn.digest()
 
-        # Send login request (w/ encrypted temporary key)
+        # Send login request (w/ encrypted temporary key or resumption ticket)
         try:
-            self.mtp.send_msg(self.mtp.type_login_req, msg_payload, etk=etk)
+            self.mtp.send_msg(msg_type, msg_payload, etk=etk)
         except SiFT_MTP_Error as e:
             raise SiFT_LOGIN_Error('Unable to send login request --> ' + e.err_msg)
 
+        # Send the early command request without waiting for the login response
+        if early_payload is not None:
+            self.mtp.set_early_key(self.derive_early_data_key(client_random, request_hash, secret=secret))
+            try:
+                self.mtp.send_msg(self.mtp.type_command_req, early_payload)
+            except SiFT_MTP_Error as e:
+                raise SiFT_LOGIN_Error('Unable to send early command request --> ' + e.err_msg)
+
         # Try to receive a login response
         try:
             msg_type, msg_payload = self.mtp.receive_msg()
@@ -348,7 +651,7 @@ class SiFT_LOGIN:
         # DEBUG 
         if self.DEBUG:
             print('Incoming login response payload (' + str(len(msg_payload)) + '):')
-            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8'))
+            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8', errors='backslashreplace'))
             print('------------------------------------------')
         # DEBUG 
 
@@ -369,9 +672,23 @@ class SiFT_LOGIN:
         if len(login_res_struct['server_random']) != self.size_random:
             raise SiFT_LOGIN_Error('Server random has incorrect size')
 
+        # Mix the ephemeral-ephemeral secret in when the login used an X25519 key exchange
+        if eph_key:
+            if not login_res_struct['server_epk']:
+                raise SiFT_LOGIN_Error('Server ephemeral key missing from X25519 login response')
+            secret = self.x25519_shared_secret(eph_key, login_res_struct['server_epk']) + secret
+
         # Derive session keys
         final_transfer_key, _ = \
-            self.derive_session_keys(client_random, login_res_struct['server_random'], request_hash)
+            self.derive_session_keys(client_random, login_res_struct['server_random'], request_hash,
+                                     secret=secret)
+
+        # Keep the ticket for resuming the session later
+        if login_res_struct['ticket']:
+            self.ticket = login_res_struct['ticket']
+            self.resumption_secret = self.derive_resumption_secret(final_transfer_key, request_hash)
+        else:
+            self.ticket, self.resumption_secret = None, None
 
 
         # DEBUG
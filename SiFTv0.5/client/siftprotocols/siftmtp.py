@@ -1,5 +1,6 @@
 #python3
 
+import select
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
 
@@ -22,9 +23,16 @@ class SiFT_MTP:
         self.size_msg_hdr_rnd = 6
         self.size_msg_hdr_rsv = 2
         self.size_msg_mac = 12
+        self.size_max_payload = 2**16 - 1 - self.size_msg_hdr - self.size_msg_mac  # largest payload of a command message
         self.size_etk = 256  # RSA-2048 encrypted key
+        self.size_ticket_len = 2  # length of the resumption ticket trailer
+        self.size_epk = 32  # X25519 ephemeral public key
+        self.size_rcv_chunk = 65536  # bytes read ahead from the socket at once
+        self.size_snd_buffer = 65536  # coalesced messages are sent once this many bytes are queued
         
         self.type_login_req =    b'\x00\x00'
+        self.type_login_req_resume = b'\x00\x01'
+        self.type_login_req_x25519 = b'\x00\x02'
         self.type_login_res =    b'\x00\x10'
         self.type_command_req =  b'\x01\x00'
         self.type_command_res =  b'\x01\x10'
@@ -34,13 +42,23 @@ class SiFT_MTP:
         self.type_dnload_req =   b'\x03\x00'
         self.type_dnload_res_0 = b'\x03\x10'
         self.type_dnload_res_1 = b'\x03\x11'
-        self.msg_types = (self.type_login_req, self.type_login_res, 
+        self.type_notify =       b'\x04\x10'  # change events pushed by the server at any time
+        self.msg_types = (self.type_login_req, self.type_login_req_resume, self.type_login_req_x25519,
+                          self.type_login_res, 
                           self.type_command_req, self.type_command_res,
                           self.type_upload_req_0, self.type_upload_req_1, self.type_upload_res,
-                          self.type_dnload_req, self.type_dnload_res_0, self.type_dnload_res_1)
+                          self.type_dnload_req, self.type_dnload_res_0, self.type_dnload_res_1,
+                          self.type_notify)
+        self.login_req_types = (self.type_login_req, self.type_login_req_resume, self.type_login_req_x25519)
+        self.login_types = self.login_req_types + (self.type_login_res,)
         
         # --------- STATE ------------
         self.peer_socket = peer_socket
+        self.rcv_buffer = bytearray()  # bytes read ahead from the socket
+        self.rcv_pos = 0  # bytes of rcv_buffer already taken
+        self.snd_buffer = bytearray()  # messages queued while sends are coalesced
+        self.coalesce_sends = False
+        self.notify_handler = None  # called with the payload of each notification
         
         # Sequence numbers for replay protection
         self.sqn_send = 1
@@ -52,6 +70,9 @@ class SiFT_MTP:
         
         # Temporary key (used only for login messages)
         self.temp_key = None
+
+        # Early data key (used only for a command request sent right behind the login request)
+        self.early_key = None
         
         # Flag to indicate if we're client or server
         self.is_client = None
@@ -68,6 +89,13 @@ class SiFT_MTP:
             self.is_client = is_client
 
 
+    # Set early data key for the one command request piggybacked on the login exchange
+    def set_early_key(self, early_key):
+        if len(early_key) != 32:
+            raise SiFT_MTP_Error('Early data key must be 32 bytes')
+        self.early_key = early_key
+
+
     # Set session keys derived from login protocol
     def set_session_keys(self, client_encrypt_key, server_encrypt_key, is_client):
         if len(client_encrypt_key) != 32 or len(server_encrypt_key) != 32:
@@ -152,24 +180,66 @@ class SiFT_MTP:
         return parsed_msg_hdr
 
 
-    # Receive exactly n bytes from peer socket
+    # Receive exact number of bytes from peer socket
+    # reads ahead, so messages the peer sent back-to-back are taken from the buffer without further recv calls
     def receive_bytes(self, n):
-        bytes_received = b''
-        bytes_count = 0
-        while bytes_count < n:
+        while len(self.rcv_buffer) - self.rcv_pos < n:
+            # nothing left to process without blocking, so queued messages must go out first
+            self.flush()
             try:
-                chunk = self.peer_socket.recv(n-bytes_count)
+                chunk = self.peer_socket.recv(max(self.size_rcv_chunk, n))
             except:
                 raise SiFT_MTP_Error('Unable to receive via peer socket')
             if not chunk: 
                 raise SiFT_MTP_Error('Connection with peer is broken')
-            bytes_received += chunk
-            bytes_count += len(chunk)
+            if self.rcv_pos:
+                del self.rcv_buffer[:self.rcv_pos]
+                self.rcv_pos = 0
+            self.rcv_buffer += chunk
+        bytes_received = bytes(self.rcv_buffer[self.rcv_pos:self.rcv_pos+n])
+        self.rcv_pos += n
+        if self.rcv_pos == len(self.rcv_buffer):
+            self.rcv_buffer.clear()
+            self.rcv_pos = 0
         return bytes_received
 
 
-    # Receive and decrypt a message
+    # Set the handler of notifications, they are dropped without one
+    def set_notify_handler(self, handler):
+        self.notify_handler = handler
+
+
+    # Receive and decrypt a message, notifications arriving before it are passed to the notify handler
     def receive_msg(self):
+        while True:
+            msg_type, msg_payload = self._receive_msg()
+            if msg_type != self.type_notify:
+                return msg_type, msg_payload
+            if self.notify_handler:
+                self.notify_handler(msg_payload)
+
+
+    # Wait up to timeout seconds (None for no limit) for a notification and pass it to the notify handler,
+    # returns False if none arrived (to be used only while no other message is expected)
+    def receive_notify(self, timeout=None):
+        if len(self.rcv_buffer) == self.rcv_pos:  # nothing read ahead
+            self.flush()
+            try:
+                readable, _, _ = select.select([self.peer_socket], [], [], timeout)
+            except (OSError, ValueError):
+                raise SiFT_MTP_Error('Unable to receive via peer socket')
+            if not readable:
+                return False
+        msg_type, msg_payload = self._receive_msg()
+        if msg_type != self.type_notify:
+            raise SiFT_MTP_Error('Notification expected, but received something else')
+        if self.notify_handler:
+            self.notify_handler(msg_payload)
+        return True
+
+
+    # Receive and decrypt a message
+    def _receive_msg(self):
         # Receive header
         try:
             msg_hdr = self.receive_bytes(self.size_msg_hdr)
@@ -229,11 +299,14 @@ class SiFT_MTP:
             raise SiFT_MTP_Error(f'Sequence number mismatch - expected {self.sqn_receive}, got {sqn_received}')
 
         # Determine which key to use (temp_key for login messages, session keys for everything else)
-        if parsed_msg_hdr['typ'] == self.type_login_req or parsed_msg_hdr['typ'] == self.type_login_res:
+        if parsed_msg_hdr['typ'] in self.login_types:
             # Login messages use temporary key
             if self.temp_key is None:
                 raise SiFT_MTP_Error('Temporary key not set for login message')
             key = self.temp_key
+        elif parsed_msg_hdr['typ'] == self.type_command_req and self.early_key is not None:
+            # Early command request uses the early data key, only once
+            key, self.early_key = self.early_key, None
         else:
             # Other messages use session keys
             key = self._get_encryption_key(sending=False)
@@ -255,14 +328,38 @@ class SiFT_MTP:
         return parsed_msg_hdr['typ'], msg_payload
 
 
-    # Send all bytes via peer socket
+    # Send raw bytes via peer socket, or queue them until the next flush while sends are coalesced
     def send_bytes(self, bytes_to_send):
+        if self.coalesce_sends:
+            self.snd_buffer += bytes_to_send
+            if len(self.snd_buffer) >= self.size_snd_buffer:
+                self.flush()
+            return
         try:
             self.peer_socket.sendall(bytes_to_send)
         except:
             raise SiFT_MTP_Error('Unable to send via peer socket')
 
 
+    # Send the queued messages at once
+    def flush(self):
+        if not self.snd_buffer:
+            return
+        bytes_to_send = bytes(self.snd_buffer)
+        self.snd_buffer.clear()
+        try:
+            self.peer_socket.sendall(bytes_to_send)
+        except:
+            raise SiFT_MTP_Error('Unable to send via peer socket')
+
+
+    # Queue outgoing messages until the next receive has to wait for the peer (or the queue is full)
+    def set_send_coalescing(self, enabled):
+        self.coalesce_sends = enabled
+        if not enabled:
+            self.flush()
+
+
     # Encrypt and send a message
     def send_msg(self, msg_type, msg_payload, etk=None):
         # Generate random field
@@ -275,7 +372,7 @@ class SiFT_MTP:
         sqn = self.sqn_send.to_bytes(self.size_msg_hdr_sqn, byteorder='big')
         
         # Determine which key to use
-        if msg_type == self.type_login_req or msg_type == self.type_login_res:
+        if msg_type in self.login_types:
             # Login request and response use temporary key
             if self.temp_key is None:
                 raise SiFT_MTP_Error('Temporary key not set for login message')
@@ -283,6 +380,18 @@ class SiFT_MTP:
             if msg_type == self.type_login_req:
                 if etk is None or len(etk) != self.size_etk:
                     raise SiFT_MTP_Error('Encrypted temporary key required for login request')
+            if msg_type == self.type_login_req_resume:
+                # the resumption ticket is carried in place of the etk, followed by its length
+                if not etk or len(etk) >= 2**(8*self.size_ticket_len):
+                    raise SiFT_MTP_Error('Resumption ticket required for resumed login request')
+                etk = etk + len(etk).to_bytes(self.size_ticket_len, byteorder='big')
+            if msg_type == self.type_login_req_x25519:
+                # the client ephemeral public key is carried in place of the etk
+                if etk is None or len(etk) != self.size_epk:
+                    raise SiFT_MTP_Error('Ephemeral public key required for X25519 login request')
+        elif msg_type == self.type_command_req and self.early_key is not None:
+            # Early command request uses the early data key, only once
+            key, self.early_key = self.early_key, None
         else:
             # Other messages use session keys
             key = self._get_encryption_key(sending=True)
@@ -293,8 +402,8 @@ class SiFT_MTP:
         msg_hdr_without_len = self.msg_hdr_ver + msg_type
         
         # Calculate message length
-        if msg_type == self.type_login_req:
-            msg_len = self.size_msg_hdr + len(msg_payload) + self.size_msg_mac + self.size_etk
+        if msg_type in self.login_req_types:
+            msg_len = self.size_msg_hdr + len(msg_payload) + self.size_msg_mac + len(etk)
         else:
             msg_len = self.size_msg_hdr + len(msg_payload) + self.size_msg_mac
         
@@ -312,7 +421,7 @@ class SiFT_MTP:
             raise SiFT_MTP_Error('Encryption failed --> ' + str(e))
 
         # Build complete message
-        if msg_type == self.type_login_req:
+        if msg_type in self.login_req_types:
             msg = msg_hdr + encrypted_payload + mac + etk
         else:
             msg = msg_hdr + encrypted_payload + mac
@@ -2,6 +2,7 @@
 
 from Crypto.Hash import SHA256
 from siftprotocols.siftmtp import SiFT_MTP, SiFT_MTP_Error
+from siftprotocols.sifttlv import SiFT_TLV
 
 class SiFT_UPL_Error(Exception):
 
@@ -16,13 +17,23 @@ class SiFT_UPL:
         self.delimiter = '\n'
         self.coding = 'utf-8'
         self.size_fragment = 1024
+        self.tlv = SiFT_TLV(('file_hash', 'file_size'))
         # --------- STATE ------------
         self.mtp = mtp
+        self.binary = False # binary encoding of the upload response (mirrors the upload command request)
+
+
+    # selects the binary encoding of the upload response (to be used by the server)
+    def set_binary(self, binary):
+        self.binary = binary
 
 
     # builds an upload response from a dictionary
     def build_upload_res(self, upl_res_struct):
 
+        if self.binary:
+            return self.tlv.encode(upl_res_struct)
+
         upl_res_str = upl_res_struct['file_hash'].hex()
         upl_res_str += self.delimiter + str(upl_res_struct['file_size'])
         return upl_res_str.encode(self.coding)
@@ -31,6 +42,12 @@ class SiFT_UPL:
     # parses an upload response into a dictionary
     def parse_upload_res(self, upl_res):
 
+        if self.tlv.is_binary(upl_res):
+            upl_res_struct = self.tlv.decode(upl_res)
+            if not isinstance(upl_res_struct.get('file_hash'), bytes) or not isinstance(upl_res_struct.get('file_size'), int):
+                raise SiFT_UPL_Error('Missing or malformed fields in upload response')
+            return upl_res_struct
+
         upl_res_fields = upl_res.decode(self.coding).split(self.delimiter)
         upl_res_struct = {}
         upl_res_struct['file_hash'] = bytes.fromhex(upl_res_fields[0])
@@ -81,7 +98,7 @@ class SiFT_UPL:
         # DEBUG 
         if self.DEBUG:
             print('Incoming payload (' + str(len(msg_payload)) + '):')
-            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8'))
+            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8', errors='backslashreplace'))
             print('------------------------------------------')
         # DEBUG 
 
@@ -99,10 +116,11 @@ class SiFT_UPL:
             raise SiFT_UPL_Error('Hash verification of uploaded file failed')
 
 
-    # handles a file upload on the server (to be used by the server)
-    def handle_upload_server(self, filepath):
+    # handles a file upload on the server and returns the hash of the file (to be used by the server)
+    # the file is opened with the given opener (see open()) if there is one
+    def handle_upload_server(self, filepath, opener=None):
 
-        with open(filepath, 'wb') as f:
+        with open(filepath, 'wb', opener=opener) as f:
 
             # creating hash function for file hash computation
             hash_fn = SHA256.new()
@@ -144,7 +162,7 @@ class SiFT_UPL:
         # DEBUG 
         if self.DEBUG:
             print('Outgoing payload (' + str(len(msg_payload)) + '):')
-            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8'))
+            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8', errors='backslashreplace'))
             print('------------------------------------------')
         # DEBUG 
 
@@ -154,5 +172,7 @@ class SiFT_UPL:
         except SiFT_MTP_Error as e:
             raise SiFT_UPL_Error('Unable to send upload response --> ' + e.err_msg)
 
+        return file_hash
+
 
 
@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
 """
 RSA Key Generation Utility for SiFT v1.0
-Generates a 2048-bit RSA key pair for the server.
-- Private key (key pair) is saved in PEM format for the server
-- Public key is exported in PEM format for the client
+Generates a 2048-bit RSA key pair and an X25519 key pair for the server.
+- Private keys (key pairs) are saved in PEM format for the server
+- Public keys are exported in PEM format for the client
+- The X25519 key pair is used by the faster ephemeral ECDH login mode
 """
 
-from Crypto.PublicKey import RSA
-from Crypto.Random import get_random_bytes
+from Crypto.PublicKey import RSA, ECC
 import sys
 
 # Generate RSA key pair of specified size
@@ -37,6 +37,29 @@ def save_public_key(key, filename='server_pubkey.pem'):
     print(f"Public key saved to: {filename}")
     return filename
 
+# Generate the long-term X25519 key pair authenticating the server in X25519 logins
+def generate_x25519_keypair():
+    print("Generating X25519 key pair...")
+    key = ECC.generate(curve='Curve25519')
+    print("Key pair generated successfully!")
+    return key
+
+# Save the X25519 private key in PEM format
+def save_x25519_private_key(key, filename='server_x25519_key.pem'):
+    with open(filename, 'wb') as f:
+        f.write(key.export_key(format='PEM').encode('ascii'))
+    
+    print(f"X25519 private key saved to: {filename}")
+    return filename
+
+# Save the X25519 public key in PEM format
+def save_x25519_public_key(key, filename='server_x25519_pubkey.pem'):
+    with open(filename, 'wb') as f:
+        f.write(key.public_key().export_key(format='PEM').encode('ascii'))
+    
+    print(f"X25519 public key saved to: {filename}")
+    return filename
+
 # Main function
 def main():
     print("=" * 60)
@@ -46,6 +69,7 @@ def main():
     
     # Generate key pair
     key = generate_rsa_keypair(2048)
+    x25519_key = generate_x25519_keypair()
     
     print()
     print("Saving keys...")
@@ -56,17 +80,23 @@ def main():
     
     # Save public key for client
     public_key_file = save_public_key(key, 'server_pubkey.pem')
+
+    # Save X25519 keys for the ephemeral ECDH login mode
+    x25519_private_key_file = save_x25519_private_key(x25519_key, 'server_x25519_key.pem')
+    x25519_public_key_file = save_x25519_public_key(x25519_key, 'server_x25519_pubkey.pem')
     
     print("-" * 60)
     print()
     print("Key generation complete!")
     print()
     print("IMPORTANT:")
-    print(f"  1. Copy '{private_key_file}' to the SERVER folder")
+    print(f"  1. Copy '{private_key_file}' and '{x25519_private_key_file}' to the SERVER folder")
     print(f"  2. Copy '{public_key_file}' to the CLIENT folder")
+    print(f"  3. Optionally copy '{x25519_public_key_file}' to the CLIENT folder to log in with X25519")
     print()
     print("The server will use the private key for decryption during login.")
     print("The client will use the public key to encrypt the temporary key.")
+    print("With the X25519 public key, the client uses an ephemeral ECDH exchange instead.")
     print("=" * 60)
 
 if __name__ == '__main__':
@@ -1,9 +1,22 @@
 #python3
 
-import sys, threading, socket, getpass, os
+import sys, threading, socket, os, time
 from siftprotocols.siftmtp import SiFT_MTP, SiFT_MTP_Error
 from siftprotocols.siftlogin import SiFT_LOGIN, SiFT_LOGIN_Error
 from siftprotocols.siftcmd import SiFT_CMD, SiFT_CMD_Error
+from siftprotocols.siftupl import SiFT_UPL_Error
+from siftprotocols.siftdnl import SiFT_DNL_Error
+from siftprotocols.siftticket import SiFT_TICKET
+from siftprotocols.siftadmission import SiFT_ADMISSION, SiFT_ADMISSION_Error
+from siftprotocols.siftusers import SiFT_USERS_FILE, SiFT_USERS_DB
+from siftprotocols.siftreplay import SiFT_REPLAY
+from siftprotocols.siftlisting import SiFT_LISTING_CACHE
+from siftprotocols.sifthashindex import SiFT_HASH_INDEX, SiFT_HASH_INDEX_DB
+from siftprotocols.siftmetrics import SiFT_METRICS
+from siftprotocols.siftwatch import SiFT_WATCH
+from siftprotocols.siftnameindex import SiFT_NAME_INDEX
+from siftprotocols.siftusage import SiFT_USAGE
+from siftprotocols.siftlocks import SiFT_PATH_LOCKS
 
 class Server:
     def __init__(self):
@@ -12,11 +25,26 @@ class Server:
         self.server_usersfile_coding = 'utf-8'
         self.server_usersfile_rec_delimiter = '\n'
         self.server_usersfile_fld_delimiter = ':'
+        self.server_usersdb = None # sqlite3 user database (e.g. 'users.db'), used instead of the users file if set
         self.server_rootdir = './users/'
         self.server_privkeyfile = 'server_key.pem'  # RSA private key file
+        self.server_x25519_privkeyfile = 'server_x25519_key.pem'  # X25519 private key file (optional)
         self.server_ip = socket.gethostbyname('localhost')
         # self.server_ip = socket.gethostbyname(socket.gethostname())
         self.server_port = 5150
+        self.server_ticket_lifetime = 3600 # seconds a resumption ticket is valid
+        self.server_ticket_rotation = 900 # seconds between ticket key rotations
+        self.server_max_logins = os.cpu_count() or 4 # logins doing crypto at the same time
+        self.server_login_rate = 1.0 # login attempts per second per source IP
+        self.server_login_burst = 5 # login attempts per source IP back-to-back
+        self.server_login_timeout = 10 # seconds a client may take to complete the whole login
+        self.server_listing_cache_size = 1024 # directory listings cached for all sessions
+        self.server_hashindexdb = 'hashindex.db' # sqlite3 database of file hashes (None keeps them in memory only)
+        self.server_watch_interval = 0.5 # seconds change events of watched directories are collected before they are sent
+        self.server_watch_rescan = 5.0 # seconds between rescans of watched directories for changes made outside of the server (0 disables them)
+        self.server_nameindexdb = 'nameindex.db' # sqlite3 database of entry names searched by find (None keeps them in memory only)
+        self.server_usage_rescan = 300.0 # seconds between reconciliation scans of the directory counts of du (0 disables them)
+        self.server_lock_timeout = 10.0 # seconds a command waits for a file or directory used by another session before it fails
         # -------------------------------------------------------------
         
         # Check if private key file exists
@@ -32,6 +60,59 @@ class Server:
             print('=' * 70)
             sys.exit(1)
         
+        # Private keys are parsed once and shared by all logins, not for every connection
+        keys = SiFT_LOGIN(None)
+        try:
+            keys.load_rsa_private_key(self.server_privkeyfile)
+        except SiFT_LOGIN_Error as e:
+            print('SiFT_LOGIN_Error: Failed to load private key --> ' + e.err_msg)
+            sys.exit(1)
+        # X25519 private key only if the X25519 login mode is enabled
+        if os.path.exists(self.server_x25519_privkeyfile):
+            try:
+                keys.load_x25519_private_key(self.server_x25519_privkeyfile)
+            except SiFT_LOGIN_Error as e:
+                print('SiFT_LOGIN_Error: Failed to load X25519 private key --> ' + e.err_msg)
+        self.rsa_key, self.x25519_key = keys.rsa_key, keys.x25519_key
+
+        # User store is opened once and shared by all sessions
+        self.users = self.load_users(self.server_usersfile)
+
+        # Ticket keys are shared by all sessions, so tickets survive reconnects
+        self.ticket_mgr = SiFT_TICKET(self.server_ticket_lifetime, self.server_ticket_rotation)
+
+        # Admission control keeps login crypto from starving authenticated sessions
+        self.admission = SiFT_ADMISSION(self.server_max_logins, self.server_login_rate, self.server_login_burst)
+
+        # Login requests seen by any session, a replayed one could repeat its early command
+        self.replay_cache = SiFT_REPLAY()
+
+        # Directory listings are cached for all sessions and checked against the directory mtime
+        self.listing_cache = SiFT_LISTING_CACHE(self.server_listing_cache_size)
+
+        # Hashes of uploaded and downloaded files, downloads of unchanged files are accepted without reading them
+        if self.server_hashindexdb:
+            self.hash_index = SiFT_HASH_INDEX_DB(self.server_hashindexdb)
+        else:
+            self.hash_index = SiFT_HASH_INDEX()
+
+        # Latencies of the commands of all sessions, by command and result
+        self.metrics = SiFT_METRICS()
+
+        # Change events of watched directories, pushed to the watching sessions by a notifier thread
+        self.watch = SiFT_WATCH(self.server_watch_interval, self.server_watch_rescan)
+        self.watch.start()
+
+        # Names of the entries below the user roots, indexed on the first find of a user and updated by the sessions
+        self.name_index = SiFT_NAME_INDEX(self.server_nameindexdb or ':memory:')
+
+        # Recursive byte and file counts of the directories, updated by the sessions and reconciled by a scanner thread
+        self.usage = SiFT_USAGE(self.server_usage_rescan)
+        self.usage.start()
+
+        # Sessions of the same user lock the paths they use: shared for downloads and listings, exclusive for uploads, deletes and moves
+        self.path_locks = SiFT_PATH_LOCKS(self.server_lock_timeout)
+
         self.server_socket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((self.server_ip, self.server_port))
@@ -42,6 +123,8 @@ class Server:
         print('=' * 70)
         print(f'Listening on {self.server_ip}:{self.server_port}')
         print(f'Private key: {self.server_privkeyfile}')
+        if os.path.exists(self.server_x25519_privkeyfile):
+            print(f'X25519 private key: {self.server_x25519_privkeyfile}')
         print('Press Ctrl-C to stop the server')
         print('=' * 70)
         
@@ -49,21 +132,12 @@ class Server:
 
 
     def load_users(self, usersfile):
-        users = {}
-        with open(usersfile, 'rb') as f:
-            allrecords = f.read().decode(self.server_usersfile_coding)
-        records = allrecords.split(self.server_usersfile_rec_delimiter)
-        for r in records:
-            if not r.strip(): # skip empty lines
-                continue
-            fields = r.split(self.server_usersfile_fld_delimiter)
-            username = fields[0]
-            usr_struct = {}
-            usr_struct['pwdhash'] = bytes.fromhex(fields[1])
-            usr_struct['icount'] = int(fields[2])
-            usr_struct['salt'] = bytes.fromhex(fields[3])
-            usr_struct['rootdir'] = fields[4]
-            users[username] = usr_struct
+        if self.server_usersdb:
+            return SiFT_USERS_DB(self.server_usersdb)
+        users = SiFT_USERS_FILE(usersfile)
+        users.coding = self.server_usersfile_coding
+        users.rec_delimiter = self.server_usersfile_rec_delimiter
+        users.fld_delimiter = self.server_usersfile_fld_delimiter
         return users
 
 
@@ -71,10 +145,48 @@ class Server:
         try:
             while True:
                 client_socket, addr = self.server_socket.accept()
+
+                # Shed the login before a thread is started for it if the server is overloaded,
+                # the login slot is released by the thread once the login is done
+                try:
+                    self.admission.admit(addr[0])
+                except SiFT_ADMISSION_Error as e:
+                    print('SiFT_ADMISSION_Error: ' + e.err_msg)
+                    print('Closing connection with client on ' + addr[0] + ':' + str(addr[1]))
+                    client_socket.close()
+                    continue
                 threading.Thread(target=self.handle_client, args=(client_socket, addr, )).start()
         except KeyboardInterrupt:
             print('\n' + '=' * 70)
             print('Server shutdown requested')
+            stats = self.admission.get_stats()
+            print(f"Logins admitted: {stats['admitted']}, shed (rate): {stats['shed_rate']}, " +
+                  f"shed (concurrency): {stats['shed_concurrency']}")
+            stats = self.listing_cache.get_stats()
+            print(f"Listing cache hits: {stats['hits']}, misses: {stats['misses']}, " +
+                  f"invalidations: {stats['invalidations']}, evictions: {stats['evictions']}")
+            stats = self.hash_index.get_stats()
+            print(f"Hash index hits: {stats['hits']}, misses: {stats['misses']}, files: {stats['entries']}")
+            self.watch.stop()
+            stats = self.watch.get_stats()
+            print(f"Watch events: {stats['events']}, coalesced: {stats['coalesced']}, notifications: {stats['notifications']}, " +
+                  f"overflows: {stats['overflows']}, rescans: {stats['rescans']}")
+            stats = self.name_index.get_stats()
+            print(f"Name index lookups: {stats['lookups']}, builds: {stats['builds']}, updates: {stats['updates']}, " +
+                  f"stale: {stats['stale']}, entries: {stats['entries']}")
+            self.usage.stop()
+            stats = self.usage.get_stats()
+            print(f"Disk usage queries: {stats['queries']}, builds: {stats['builds']}, updates: {stats['updates']}, " +
+                  f"corrections: {stats['corrections']}, directories: {stats['directories']}")
+            stats = self.path_locks.get_stats()
+            print(f"Path locks shared: {stats['shared']}, exclusive: {stats['exclusive']}, contended: {stats['contended']}, " +
+                  f"timeouts: {stats['timeouts']}, wait total: {stats['wait_total']:.3f} s, wait max: {stats['wait_max']:.3f} s")
+            stats = self.metrics.get_stats()
+            if stats: print('Command latencies (ms):')
+            for name in sorted(stats):
+                s = stats[name]
+                print(f"  {name:<16} count {s['count']:8d}  mean {s['mean'] * 1000:9.3f}  p50 {s['p50'] * 1000:9.3f}  " +
+                      f"p90 {s['p90'] * 1000:9.3f}  p99 {s['p99'] * 1000:9.3f}  max {s['max'] * 1000:9.3f}")
             print('=' * 70)
             self.server_socket.close()
             sys.exit(0)
@@ -83,51 +195,87 @@ class Server:
     def handle_client(self, client_socket, addr):
         print('New client on ' + addr[0] + ':' + str(addr[1]))
 
+        try: # admitted by accept_connections()
+            mtp, user, users = self.login_client(client_socket, addr)
+        finally:
+            self.admission.release()
+        if not user:
+            return
+
+        self.serve_client(client_socket, addr, mtp, user, users)
+
+
+    def login_client(self, client_socket, addr):
+
         mtp = SiFT_MTP(client_socket)
 
         loginp = SiFT_LOGIN(mtp)
-        
-        # Load servers RSA private key
-        try:
-            loginp.load_rsa_private_key(self.server_privkeyfile)
-        except SiFT_LOGIN_Error as e:
-            print('SiFT_LOGIN_Error: Failed to load private key --> ' + e.err_msg)
-            print('Closing connection with client on ' + addr[0] + ':' + str(addr[1]))
-            client_socket.close()
-            return
-        
-        # Load users database
-        users = self.load_users(self.server_usersfile)
+
+        # Servers private keys, loaded at startup
+        loginp.set_rsa_key(self.rsa_key)
+        loginp.set_x25519_key(self.x25519_key)
+
+        # Set users database
+        users = self.users
         loginp.set_server_users(users)
+        loginp.set_ticket_manager(self.ticket_mgr)
+        loginp.set_replay_cache(self.replay_cache)
 
-        # Handle login
+        # Handle login (slow clients must not hold the login slot, the timeout bounds the whole login, not each receive)
+        mtp.set_deadline(time.monotonic() + self.server_login_timeout)
         try:
             user = loginp.handle_login_server()
         except SiFT_LOGIN_Error as e:
             print('SiFT_LOGIN_Error: ' + e.err_msg)
             print('Closing connection with client on ' + addr[0] + ':' + str(addr[1]))
             client_socket.close()
-            return
+            return mtp, None, None
+        mtp.set_deadline(None)
+
+        return mtp, user, users
+
+
+    def serve_client(self, client_socket, addr, mtp, user, users):
 
         # Setup command protocol
         cmdp = SiFT_CMD(mtp)
         cmdp.set_server_rootdir(self.server_rootdir)
         cmdp.set_user_rootdir(users[user]['rootdir'])
+        cmdp.set_listing_cache(self.listing_cache)
+        cmdp.set_hash_index(self.hash_index)
+        cmdp.set_metrics(self.metrics)
+        cmdp.set_watch_hub(self.watch)
+        cmdp.set_name_index(self.name_index)
+        cmdp.set_usage(self.usage)
+        cmdp.set_path_locks(self.path_locks)
 
-        # Handle commands
-        while True:
-            try:
-                cmdp.receive_command()
-            except SiFT_CMD_Error as e:
-                print('SiFT_CMD_Error: ' + e.err_msg)
-                print('Closing connection with client on ' + addr[0] + ':' + str(addr[1]))
-                client_socket.close()
-                return
-            except SiFT_MTP_Error as e:
-                print('SiFT_MTP_Error: ' + e.err_msg)
-                print('Closing connection with client on ' + addr[0] + ':' + str(addr[1]))
-                client_socket.close()
-                return
+        # Responses to requests the client pipelined are sent together once the next request is not yet there
+        mtp.set_send_coalescing(True)
+
+        # Handle commands, the session is closed however the connection ends
+        try:
+            while True:
+                try:
+                    cmdp.receive_command()
+                except SiFT_CMD_Error as e:
+                    print('SiFT_CMD_Error: ' + e.err_msg)
+                    print('Closing connection with client on ' + addr[0] + ':' + str(addr[1]))
+                    return
+                except SiFT_MTP_Error as e:
+                    print('SiFT_MTP_Error: ' + e.err_msg)
+                    print('Closing connection with client on ' + addr[0] + ':' + str(addr[1]))
+                    return
+                except SiFT_UPL_Error as e:
+                    print('SiFT_UPL_Error: ' + e.err_msg)
+                    print('Closing connection with client on ' + addr[0] + ':' + str(addr[1]))
+                    return
+                except SiFT_DNL_Error as e:
+                    print('SiFT_DNL_Error: ' + e.err_msg)
+                    print('Closing connection with client on ' + addr[0] + ':' + str(addr[1]))
+                    return
+        finally:
+            cmdp.close()
+            client_socket.close()
 
 
 # main
@@ -0,0 +1,77 @@
+#python3
+
+import time, threading
+
+class SiFT_ADMISSION_Error(Exception):
+
+    def __init__(self, err_msg):
+        self.err_msg = err_msg
+
+class SiFT_ADMISSION:
+    def __init__(self, max_concurrent=4, rate=1.0, burst=5):
+
+        self.DEBUG = True  # Set to True only for development debugging
+        # --------- CONSTANTS ------------
+        self.max_concurrent = max_concurrent # logins doing crypto at the same time
+        self.rate = rate # login attempts per second refilled per source IP
+        self.burst = burst # login attempts a source IP can make back-to-back
+        self.max_tracked = 10000 # source IPs tracked before idle buckets are evicted
+        # --------- STATE ------------
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.buckets = {} # source IP --> [tokens, last refill time]
+        self.counters = {'admitted': 0, 'shed_rate': 0, 'shed_concurrency': 0, 'in_progress': 0}
+
+
+    # refills the token bucket of a source IP and takes a token if there is one
+    def take_token(self, ip):
+        now = time.monotonic()
+        with self.lock:
+            if ip not in self.buckets and len(self.buckets) >= self.max_tracked:
+                self.evict_idle(now)
+            bucket = self.buckets.setdefault(ip, [self.burst, now])
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
+
+
+    # drops buckets that have refilled completely, they carry no state (lock must be held)
+    def evict_idle(self, now):
+        idle = [ip for ip, (tokens, last) in self.buckets.items()
+                if tokens + (now - last) * self.rate >= self.burst]
+        for ip in idle:
+            del self.buckets[ip]
+
+
+    # admits a login from the given source IP or raises an error if it must be shed
+    # never waits for a free login slot, it is called by the accept loop of the server
+    def admit(self, ip):
+        if not self.take_token(ip):
+            with self.lock:
+                self.counters['shed_rate'] += 1
+            raise SiFT_ADMISSION_Error('Login rate limit exceeded for ' + ip)
+
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.counters['shed_concurrency'] += 1
+            raise SiFT_ADMISSION_Error('Too many concurrent logins')
+
+        with self.lock:
+            self.counters['admitted'] += 1
+            self.counters['in_progress'] += 1
+
+
+    # releases the login slot taken by admit()
+    def release(self):
+        with self.lock:
+            self.counters['in_progress'] -= 1
+        self.slots.release()
+
+
+    # returns a snapshot of the admission counters
+    def get_stats(self):
+        with self.lock:
+            return dict(self.counters)
@@ -1,17 +1,49 @@
 #python3
 
-import os
+import os, sys, stat, time, errno, fnmatch, threading, queue
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, OrderedDict
 from base64 import b64encode, b64decode
 from Crypto.Hash import SHA256
 from siftprotocols.siftmtp import SiFT_MTP, SiFT_MTP_Error
 from siftprotocols.siftupl import SiFT_UPL, SiFT_UPL_Error
 from siftprotocols.siftdnl import SiFT_DNL, SiFT_DNL_Error
+from siftprotocols.sifttlv import SiFT_TLV
+try:
+    import fcntl
+except ImportError: # not on Windows
+    fcntl = None
 
 class SiFT_CMD_Error(Exception):
 
     def __init__(self, err_msg):
         self.err_msg = err_msg
 
+# result of a command sent with SiFT_CMD.send_command_async(), responses are received on demand
+class SiFT_CMD_FUTURE:
+    def __init__(self, cmdp, cmd_req_struct):
+
+        # --------- STATE ------------
+        self.cmdp = cmdp
+        self.cmd_req_struct = cmd_req_struct
+        self.command = cmd_req_struct['command']
+        self.cmd_res_struct = None
+        self.error = None
+
+
+    def done(self):
+        return self.cmd_res_struct is not None or self.error is not None
+
+
+    # returns the command response, receiving responses until this one arrived
+    def result(self):
+        while not self.done():
+            self.cmdp.receive_pipelined_res()
+        if self.error is not None:
+            raise SiFT_CMD_Error(self.error)
+        return self.cmd_res_struct
+
+
 class SiFT_CMD:
     def __init__(self, mtp):
 
@@ -26,28 +58,124 @@ class SiFT_CMD:
         self.cmd_del = 'del'
         self.cmd_upl = 'upl'
         self.cmd_dnl = 'dnl'
-        self.commands = (self.cmd_pwd, self.cmd_lst, self.cmd_chd, 
-                         self.cmd_mkd, self.cmd_del, 
-                         self.cmd_upl, self.cmd_dnl)
+        self.cmd_bat = 'bat'
+        self.cmd_cpy = 'cpy'
+        self.cmd_mov = 'mov'
+        self.cmd_stt = 'stt'
+        self.cmd_mnf = 'mnf'
+        self.cmd_wch = 'wch'
+        self.cmd_fnd = 'fnd'
+        self.cmd_dus = 'dus'
+        self.batch_commands = (self.cmd_pwd, self.cmd_lst, self.cmd_chd, self.cmd_mkd, self.cmd_del,
+                               self.cmd_cpy, self.cmd_mov, self.cmd_stt, self.cmd_wch, self.cmd_dus)
+        self.batch_stop = 'stop' # batch mode: the first failed command ends the batch
+        self.batch_continue = 'continue' # batch mode: all commands are executed
+        self.size_batch = 128 # commands per batch request sent by the client
+        self.size_lst_page = 32768 # bytes of entry names per page of a paged listing (fits in a message after base64)
+        self.size_lst_entries = 1000 # entries per page requested by the client
+        self.lst_long = 'long' # listing mode with type, size, mtime and hash of the entries
+        self.lst_recursive = 'recursive' # listing mode with the paths of all entries below the directory
+        self.mkd_parents = 'parents' # mkd mode creating the missing directories of the path
+        self.del_recursive = 'recursive' # del mode removing a directory with its content
+        self.size_delete_workers = 8 # threads unlinking the files of a directory in a recursive delete
+        self.size_delete_chunk = 256 # files unlinked by a thread at once
+        self.progress_interval = 1.0 # seconds between progress responses of a long running command
+        self.dnl_trailer = 'trailer' # download mode with the hash sent after the file
+        self.stt_hash = 'hash' # stt mode computing the hashes that are not in the hash index
+        self.size_stt_paths = 256 # paths per stt request
+        self.size_mnf_batch = 256 # manifest entries passed from the scanning thread at once
+        self.size_mnf_queue = 16 # batches of manifest entries scanned ahead of the pages sent
+        self.wch_stop = 'stop' # wch mode ending the watch of a directory
+        self.size_watches = 64 # directories watched by a session
+        self.fnd_filter_ops = ('>=', '<=', '>', '<') # fnd filters: size or mtime (seconds since the epoch), operator and value
+        self.size_fnd_literal = 3 # characters of a fnd pattern to match outside of wildcards (the trigrams of the name index)
+        self.size_hash_chunk = 65536
+        self.size_client_cache = 64 # remote directory listings cached by the client
+        self.dir_fd_supported = ({os.open, os.stat, os.mkdir, os.rmdir, os.unlink, os.rename} <= os.supports_dir_fd
+                                 and os.scandir in os.supports_fd)
+        self.size_copy_chunk = 2**20 # bytes copied at once by a server-local copy
+        self.ioctl_ficlone = 0x40049409 # Linux FICLONE, makes a file share the blocks of another one (reflink)
+        self.reflink_supported = fcntl is not None and sys.platform.startswith('linux')
+        self.copy_range_supported = hasattr(os, 'copy_file_range')
         self.res_success = 'success'
         self.res_failure = 'failure'
         self.res_accept =  'accept'
         self.res_reject =  'reject'
+        self.res_progress = 'progress' # intermediate response, the final one follows
+        self.res_event = 'event' # change events of watched directories, sent in a notification
+        self.tlv = SiFT_TLV(('command', 'request_hash', 'result_1', 'result_2', 'result_3',
+                             'param_1', 'param_2', 'param_3'))
+        self.text_codecs = {'str': (str, str), 'int': (str, int), 'hex': (bytes.hex, bytes.fromhex),
+                            'b64': (lambda v: b64encode(v.encode(self.coding)).decode(self.coding),
+                                    lambda f: b64decode(f).decode(self.coding))}
+        self.field_types = {'str': str, 'int': int, 'hex': bytes, 'b64': str, 'nested': list} # types of the values in binary payloads
+        self.registry = {} # command --> handler, request fields, response fields, failure response fields
+        self.register_command(self.cmd_pwd, self.serve_pwd, (), (('result_2', 'str', False),))
+        self.register_command(self.cmd_lst, self.serve_lst,
+                              (('param_1', 'str', True), ('param_2', 'int', True), ('param_3', 'str', True)), # cursor, page size, mode
+                              (('result_2', 'b64', False), ('result_3', 'str', True))) # entries, next cursor
+        self.register_command(self.cmd_chd, self.serve_chd, (('param_1', 'str', False),), ())
+        self.register_command(self.cmd_mkd, self.serve_mkd, (('param_1', 'str', False), ('param_2', 'str', True)), ())
+        self.register_command(self.cmd_del, self.serve_del, (('param_1', 'str', False), ('param_2', 'str', True)),
+                              (('result_2', 'int', True),)) # entries removed by a recursive delete, so far for 'progress'
+        self.register_command(self.cmd_upl, self.serve_upl,
+                              (('param_1', 'str', False), ('param_2', 'int', False), ('param_3', 'hex', False)), ())
+        self.register_command(self.cmd_dnl, self.serve_dnl, (('param_1', 'str', False), ('param_2', 'str', True)),
+                              (('result_2', 'int', False), ('result_3', 'hex', False))) # file size and hash
+        self.register_command(self.cmd_bat, self.serve_bat, (('param_1', 'str', False), ('param_2', 'nested', False)),
+                              (('result_2', 'nested', False),), (('result_2', 'nested', False),))
+        self.register_command(self.cmd_cpy, self.serve_cpy_mov, (('param_1', 'str', False), ('param_2', 'str', False)), ())
+        self.register_command(self.cmd_mov, self.serve_cpy_mov, (('param_1', 'str', False), ('param_2', 'str', False)), ())
+        self.register_command(self.cmd_stt, self.serve_stt, (('param_1', 'b64', False), ('param_2', 'str', True)), # paths, mode
+                              (('result_2', 'b64', False),)) # entries in the format of a long listing
+        self.register_command(self.cmd_mnf, self.serve_mnf,
+                              (('param_1', 'int', False), ('param_2', 'int', False), ('param_3', 'str', True)), # page size, depth, pattern
+                              (('result_2', 'b64', False), ('result_3', 'str', True))) # entries, next cursor
+        self.register_command(self.cmd_wch, self.serve_wch, (('param_1', 'str', False), ('param_2', 'str', True)), # path, mode
+                              (('result_2', 'b64', True),)) # events of a notification
+        self.register_command(self.cmd_fnd, self.serve_fnd,
+                              (('param_1', 'int', False), ('param_2', 'str', False), ('param_3', 'str', True)), # page size, pattern, filters
+                              (('result_2', 'b64', False), ('result_3', 'str', True))) # entries, next cursor
+        self.register_command(self.cmd_dus, self.serve_dus, (('param_1', 'str', False),), # path
+                              (('result_2', 'b64', False),)) # counts of the directory and of its subdirectories
         # --------- STATE ------------
         self.mtp = mtp
         self.server_rootdir = None
         self.user_rootdir = None
         self.current_dir = []
+        self.root_fd = None # open user root directory, operations are relative to it and to cwd_fd (server)
+        self.cwd_fd = None # open current directory
         self.filesize_limit = 2**16
+        self.early_request_hash = None
+        self.binary = False # binary encoding of payloads (chosen by the client, mirrored by the server)
+        self.pipeline_depth = 32 # command requests sent ahead of their responses
+        self.pending = {} # request hash --> futures of the requests sent with this hash, oldest first
+        self.pending_count = 0
+        self.listing = None # pages of a paged listing still to be sent (server)
+        self.listing_cache = None # listings shared by the sessions of the server
+        self.hash_index = None # known content hashes of files (server)
+        self.name_index = None # names of the entries below the user roots (server)
+        self.usage = None # recursive byte and file counts of the directories below the user roots (server)
+        self.path_locks = None # reader/writer locks of the paths used by the sessions (server)
+        self.transfer_locks = [] # locks taken for an accepted upload or download until it ends (server)
+        self.metrics = None # latency histograms of the commands (server)
+        self.watch_hub = None # change events of watched directories, shared by the sessions (server)
+        self.watched = set() # absolute paths of the directories watched by this session (server)
+        self.watch_handler = None # called with the change events of watched directories (client)
+        self.cache_ttl = 30.0 # seconds a cached listing is used without asking the server (client)
+        self.cached_cwd = '/' # current directory on the server, tracked from the commands of the client (a session starts in the root)
+        self.cached_listings = OrderedDict() # remote directory --> (time cached, entries), least recently used first
 
 
     # sets the root directory (to be used by the server)
     def set_server_rootdir(self, server_rootdir):
+        self.close_dirs()
         self.server_rootdir = server_rootdir
 
 
     # sets the root directory of the user (to be used by the server)
     def set_user_rootdir(self, user_rootdir):
+        self.close_dirs()
         self.user_rootdir = user_rootdir
         # DEBUG 
         if self.DEBUG:
@@ -60,144 +188,169 @@ class SiFT_CMD:
         self.filesize_limit = limit
 
 
-    # builds a command request from a dictionary
-    def build_command_req(self, cmd_req_struct):
+    # sets the listing cache shared by the sessions (to be used by the server)
+    def set_listing_cache(self, listing_cache):
+        self.listing_cache = listing_cache
 
-        cmd_req_str = cmd_req_struct['command']
 
-        if cmd_req_struct['command'] == self.cmd_chd:
-            cmd_req_str += self.delimiter + cmd_req_struct['param_1']
+    # sets the index of known file hashes (to be used by the server)
+    def set_hash_index(self, hash_index):
+        self.hash_index = hash_index
 
-        elif cmd_req_struct['command'] == self.cmd_mkd:
-            cmd_req_str += self.delimiter + cmd_req_struct['param_1']
 
-        elif cmd_req_struct['command'] == self.cmd_del:
-            cmd_req_str += self.delimiter + cmd_req_struct['param_1']
+    # sets the index of entry names used by fnd (to be used by the server)
+    def set_name_index(self, name_index):
+        self.name_index = name_index
 
-        elif cmd_req_struct['command'] == self.cmd_upl:
-            cmd_req_str += self.delimiter + cmd_req_struct['param_1']
-            cmd_req_str += self.delimiter + str(cmd_req_struct['param_2'])
-            cmd_req_str += self.delimiter + cmd_req_struct['param_3'].hex()
 
-        elif cmd_req_struct['command'] == self.cmd_dnl:
-            cmd_req_str += self.delimiter + cmd_req_struct['param_1']
+    # sets the byte and file counts of the directories used by dus (to be used by the server)
+    def set_usage(self, usage):
+        self.usage = usage
 
-        return cmd_req_str.encode(self.coding)
 
+    # sets the path locks shared by the sessions (to be used by the server)
+    def set_path_locks(self, path_locks):
+        self.path_locks = path_locks
 
-    # parses a command request into a dictionary
-    def parse_command_req(self, cmd_req):
 
-        cmd_req_fields = cmd_req.decode(self.coding).split(self.delimiter)
+    # sets the metrics the latencies of the commands are recorded in (to be used by the server)
+    def set_metrics(self, metrics):
+        self.metrics = metrics
 
-        cmd_req_struct = {}
-        cmd_req_struct['command'] = cmd_req_fields[0]
 
-        if cmd_req_struct['command'] == self.cmd_chd:
-            cmd_req_struct['param_1'] = cmd_req_fields[1]
+    # sets the change events of watched directories shared by the sessions (to be used by the server)
+    def set_watch_hub(self, watch_hub):
+        self.watch_hub = watch_hub
 
-        elif cmd_req_struct['command'] == self.cmd_mkd:
-            cmd_req_struct['param_1'] = cmd_req_fields[1]
 
-        elif cmd_req_struct['command'] == self.cmd_del:
-            cmd_req_struct['param_1'] = cmd_req_fields[1]
+    # registers a command with its handler and the fields of its payloads, a field is (name, codec, optional)
+    # codec is 'str', 'int', 'hex' (bytes), 'b64' (str of any characters) or 'nested' (payloads of other commands,
+    # the rest of the payload), an optional field that is not set ends the text payload
+    # failure and reject responses have the fail_fields, by default an error message
+    def register_command(self, command, handler, req_fields, res_fields, fail_fields=(('result_2', 'str', False),)):
+        self.registry[command] = (handler, req_fields, res_fields, fail_fields)
 
-        elif cmd_req_struct['command'] == self.cmd_upl:
-            cmd_req_struct['param_1'] = cmd_req_fields[1]
-            cmd_req_struct['param_2'] = int(cmd_req_fields[2])
-            cmd_req_struct['param_3'] = bytes.fromhex(cmd_req_fields[3])
 
-        elif cmd_req_struct['command'] == self.cmd_dnl:
-            cmd_req_struct['param_1'] = cmd_req_fields[1]
+    # sets how long cached listings are used, 0 disables the listing cache (to be used by the client)
+    def set_cache_ttl(self, ttl):
+        self.cache_ttl = ttl
+        if not ttl: self.cached_listings.clear()
 
-        return cmd_req_struct
 
+    # sets the number of command requests sent ahead of their responses (to be used by the client)
+    def set_pipeline_depth(self, depth):
+        self.pipeline_depth = max(1, depth)
 
-    # builds a command response from a dictionary
-    def build_command_res(self, cmd_res_struct):
 
-        cmd_res_str = cmd_res_struct['command']
-        cmd_res_str += self.delimiter + cmd_res_struct['request_hash'].hex()
-        cmd_res_str += self.delimiter + cmd_res_struct['result_1'] # 'success'/'failure' or 'accept'/'reject'
+    # selects the binary encoding of command requests (to be used by the client)
+    def set_binary(self, binary):
+        self.binary = binary
 
-        if cmd_res_struct['command'] == self.cmd_pwd:
-            cmd_res_str += self.delimiter + cmd_res_struct['result_2']
 
-        elif cmd_res_struct['command'] == self.cmd_lst:
-            if cmd_res_struct['result_1'] == 'failure':
-                cmd_res_str += self.delimiter + cmd_res_struct['result_2']
-            else: # 'success'
-                cmd_res_str += self.delimiter + b64encode(cmd_res_struct['result_2'].encode(self.coding)).decode(self.coding)
+    # returns the fields of the request of a command (none for unknown commands)
+    def get_req_fields(self, command):
+        entry = self.registry.get(command)
+        return entry[1] if entry else ()
 
-        elif cmd_res_struct['command'] == self.cmd_chd:
-            if cmd_res_struct['result_1'] == 'failure':
-                cmd_res_str += self.delimiter + cmd_res_struct['result_2']
 
-        elif cmd_res_struct['command'] == self.cmd_mkd:
-            if cmd_res_struct['result_1'] == 'failure':
-                cmd_res_str += self.delimiter + cmd_res_struct['result_2']
+    # returns the fields of a response of a command, they depend on its result (none for unknown commands)
+    def get_res_fields(self, command, result):
+        entry = self.registry.get(command)
+        if not entry: return ()
+        return entry[3] if result in (self.res_failure, self.res_reject) else entry[2]
 
-        elif cmd_res_struct['command'] == self.cmd_del:
-            if cmd_res_struct['result_1'] == 'failure':
-                cmd_res_str += self.delimiter + cmd_res_struct['result_2']
 
-        elif cmd_res_struct['command'] == self.cmd_upl:
-            if cmd_res_struct['result_1'] == 'reject':
-                cmd_res_str += self.delimiter + cmd_res_struct['result_2']
+    # encodes the fields of a payload after the head (list of str) as delimited text
+    def encode_text(self, head, struct, fields, build):
+        for name, codec, optional in fields:
+            value = struct.get(name) if optional else struct[name]
+            if value is None: break
+            if codec == 'nested':
+                head += [b64encode(build(item)).decode(self.coding) for item in value]
+            else:
+                head.append(self.text_codecs[codec][0](value))
+        return self.delimiter.join(head).encode(self.coding)
 
-        elif cmd_res_struct['command'] == self.cmd_dnl:
-            if cmd_res_struct['result_1'] == 'reject':
-                cmd_res_str += self.delimiter + cmd_res_struct['result_2']
-            else: # 'accept'
-                cmd_res_str += self.delimiter + str(cmd_res_struct['result_2'])
-                cmd_res_str += self.delimiter + cmd_res_struct['result_3'].hex()
 
-        return cmd_res_str.encode(self.coding)
+    # decodes the values of the fields of a text payload (after the head) into the dictionary
+    def decode_text(self, struct, values, fields, parse):
+        for i, (name, codec, optional) in enumerate(fields):
+            if codec == 'nested':
+                struct[name] = [parse(b64decode(v)) for v in values[i:]]
+                break
+            if i >= len(values):
+                if optional: break
+                raise SiFT_CMD_Error('Missing field ' + name)
+            struct[name] = self.text_codecs[codec][1](values[i])
+        return struct
 
 
-    # parses a command response into a dictionary
-    def parse_command_res(self, cmd_res):
+    # replaces the dictionaries in the nested fields of a payload by their binary encoding
+    def encode_nested(self, struct, fields, build):
+        for name, codec, _ in fields:
+            if codec == 'nested' and name in struct:
+                struct = dict(struct)
+                struct[name] = [build(item) for item in struct[name]]
+        return struct
 
-        cmd_res_fields = cmd_res.decode(self.coding).split(self.delimiter)
-        
-        cmd_res_struct = {}
-        cmd_res_struct['command'] = cmd_res_fields[0]
-        cmd_res_struct['request_hash'] = bytes.fromhex(cmd_res_fields[1])
-        cmd_res_struct['result_1'] = cmd_res_fields[2]
 
-        if cmd_res_struct['command'] == self.cmd_pwd:
-            cmd_res_struct['result_2'] = cmd_res_fields[3]
+    # builds a command request from a dictionary
+    def build_command_req(self, cmd_req_struct):
+        req_fields = self.get_req_fields(cmd_req_struct['command'])
+        if self.binary:
+            return self.tlv.encode(self.encode_nested(cmd_req_struct, req_fields, self.build_command_req))
+        return self.encode_text([cmd_req_struct['command']], cmd_req_struct, req_fields, self.build_command_req)
+
+
+    # parses a command request into a dictionary
+    def parse_command_req(self, cmd_req):
+
+        if self.tlv.is_binary(cmd_req):
+            cmd_req_struct = self.tlv.decode(cmd_req)
+            if not isinstance(cmd_req_struct.get('command'), str):
+                raise SiFT_CMD_Error('Missing or malformed command in command request')
+            for name, codec, optional in self.get_req_fields(cmd_req_struct['command']):
+                if optional and name not in cmd_req_struct: continue
+                if not isinstance(cmd_req_struct.get(name), self.field_types[codec]):
+                    raise SiFT_CMD_Error('Missing or malformed ' + name + ' in command request')
+                if codec == 'nested':
+                    cmd_req_struct[name] = [self.parse_command_req(item) for item in cmd_req_struct[name]]
+            return cmd_req_struct
 
-        elif cmd_res_struct['command'] == self.cmd_lst:
-            if cmd_res_struct['result_1'] == 'failure':
-                cmd_res_struct['result_2'] = cmd_res_fields[3]
-            else: # 'success'
-                cmd_res_struct['result_2'] = b64decode(cmd_res_fields[3]).decode(self.coding)
+        cmd_req_fields = cmd_req.decode(self.coding).split(self.delimiter)
+        cmd_req_struct = {}
+        cmd_req_struct['command'] = cmd_req_fields[0]
+        return self.decode_text(cmd_req_struct, cmd_req_fields[1:], self.get_req_fields(cmd_req_struct['command']), self.parse_command_req)
 
-        elif cmd_res_struct['command'] == self.cmd_chd:
-            if cmd_res_struct['result_1'] == 'failure':
-                cmd_res_struct['result_2'] = cmd_res_fields[3]
 
-        elif cmd_res_struct['command'] == self.cmd_mkd:
-            if cmd_res_struct['result_1'] == 'failure':
-                cmd_res_struct['result_2'] = cmd_res_fields[3]
+    # builds a command response from a dictionary
+    def build_command_res(self, cmd_res_struct):
+        res_fields = self.get_res_fields(cmd_res_struct['command'], cmd_res_struct['result_1'])
+        if self.binary:
+            return self.tlv.encode(self.encode_nested(cmd_res_struct, res_fields, self.build_command_res))
+        head = [cmd_res_struct['command'], cmd_res_struct['request_hash'].hex(), cmd_res_struct['result_1']]
+        return self.encode_text(head, cmd_res_struct, res_fields, self.build_command_res)
 
-        elif cmd_res_struct['command'] == self.cmd_del:
-            if cmd_res_struct['result_1'] == 'failure':
-                cmd_res_struct['result_2'] = cmd_res_fields[3]
 
-        elif cmd_res_struct['command'] == self.cmd_upl:
-            if cmd_res_struct['result_1'] == 'reject':
-                cmd_res_struct['result_2'] = cmd_res_fields[3]
+    # parses a command response into a dictionary
+    def parse_command_res(self, cmd_res):
 
-        elif cmd_res_struct['command'] == self.cmd_dnl:
-            if cmd_res_struct['result_1'] == 'reject':
-                cmd_res_struct['result_2'] = cmd_res_fields[3]
-            else: # 'accept'
-                cmd_res_struct['result_2'] = int(cmd_res_fields[3])
-                cmd_res_struct['result_3'] = bytes.fromhex(cmd_res_fields[4])
+        if self.tlv.is_binary(cmd_res):
+            cmd_res_struct = self.tlv.decode(cmd_res)
+            if not isinstance(cmd_res_struct.get('request_hash'), bytes) or 'result_1' not in cmd_res_struct:
+                raise SiFT_CMD_Error('Missing or malformed fields in command response')
+            for name, codec, _ in self.get_res_fields(cmd_res_struct.get('command'), cmd_res_struct['result_1']):
+                if codec == 'nested':
+                    cmd_res_struct[name] = [self.parse_command_res(item) for item in cmd_res_struct.get(name, [])]
+            return cmd_res_struct
 
-        return cmd_res_struct
+        cmd_res_fields = cmd_res.decode(self.coding).split(self.delimiter)
+        cmd_res_struct = {}
+        cmd_res_struct['command'] = cmd_res_fields[0]
+        cmd_res_struct['request_hash'] = bytes.fromhex(cmd_res_fields[1])
+        cmd_res_struct['result_1'] = cmd_res_fields[2]
+        res_fields = self.get_res_fields(cmd_res_struct['command'], cmd_res_struct['result_1'])
+        return self.decode_text(cmd_res_struct, cmd_res_fields[3:], res_fields, self.parse_command_res)
 
 
     # handles incoming command (to be used by the server)
@@ -215,13 +368,16 @@ class SiFT_CMD:
         # DEBUG 
         if self.DEBUG:
             print('Incoming payload (' + str(len(msg_payload)) + '):')
-            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8'))
+            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8', errors='backslashreplace'))
             print('------------------------------------------')
         # DEBUG 
 
         if msg_type != self.mtp.type_command_req:
             raise SiFT_CMD_Error('Command request expected, but received something else')
 
+        # the response uses the encoding of the request
+        self.binary = self.tlv.is_binary(msg_payload)
+
         # computing hash of request payload
         hash_fn = SHA256.new()
         hash_fn.update(msg_payload)
@@ -233,7 +389,7 @@ class SiFT_CMD:
         except:
             raise SiFT_CMD_Error('Parsing command request failed')
 
-        if cmd_req_struct['command'] not in self.commands:
+        if cmd_req_struct['command'] not in self.registry:
             raise SiFT_CMD_Error('Unexpected command received')
 
         # executing command
@@ -242,10 +398,20 @@ class SiFT_CMD:
         # building a command response
         msg_payload = self.build_command_res(cmd_res_struct)
 
+        # a response that does not fit in one message is replaced by a failure
+        if len(msg_payload) > self.mtp.size_max_payload:
+            cmd_res_struct = {'command': cmd_res_struct['command'], 'request_hash': request_hash,
+                              'result_1': self.res_failure}
+            if cmd_res_struct['command'] == self.cmd_bat:
+                cmd_res_struct['result_2'] = [] # no per-command results, the client treats the batch as failed
+            else:
+                cmd_res_struct['result_2'] = 'Response does not fit in a message'
+            msg_payload = self.build_command_res(cmd_res_struct)
+
         # DEBUG 
         if self.DEBUG:
             print('Outgoing payload (' + str(len(msg_payload)) + '):')
-            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8'))
+            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8', errors='backslashreplace'))
             print('------------------------------------------')
         # DEBUG 
 
@@ -255,23 +421,37 @@ class SiFT_CMD:
         except SiFT_MTP_Error as e:
             raise SiFT_CMD_Error('Unable to send command response --> ' + e.err_msg)
 
+        # if a paged listing has more pages, then send them
+        if self.listing is not None:
+            self.send_listing_pages(cmd_res_struct['command'], request_hash)
+
         # if upload command was accepted, then execute upload
         if cmd_res_struct['command'] == self.cmd_upl and cmd_res_struct['result_1'] == self.res_accept:
             try:
                 self.exec_upl(cmd_req_struct['param_1'])
             except SiFT_UPL_Error as e:
                 raise SiFT_UPL_Error(e.err_msg)
+            finally: # the locks taken when the upload was accepted
+                self.unlock_paths(self.transfer_locks)
+                self.transfer_locks = []
 
         # if download command was accepted, then execute download
         if cmd_res_struct['command'] == self.cmd_dnl and cmd_res_struct['result_1'] == self.res_accept:
             try:
-                self.exec_dnl(cmd_req_struct['param_1'])
+                self.exec_dnl(cmd_req_struct['param_1'], trailer=(cmd_res_struct['result_3'] == b''))
             except SiFT_DNL_Error as e:
                 raise SiFT_DNL_Error(e.err_msg)
+            finally: # the locks taken when the download was accepted
+                self.unlock_paths(self.transfer_locks)
+                self.transfer_locks = []
 
 
     # builds and sends command to server (to be used by the client)
-    def send_command(self, cmd_req_struct):
+    # the progress of a long running command (e.g., recursive delete) is passed to progress(), if given
+    def send_command(self, cmd_req_struct, progress=None):
+
+        # responses of pipelined requests come first
+        self.drain_pipeline()
 
         # building a command request
         msg_payload = self.build_command_req(cmd_req_struct)
@@ -279,20 +459,458 @@ class SiFT_CMD:
         # DEBUG 
         if self.DEBUG:
             print('Outgoing payload (' + str(len(msg_payload)) + '):')
-            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8'))
+            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8', errors='backslashreplace'))
             print('------------------------------------------')
         # DEBUG 
 
-        # trying to send command request
+        # computing hash of request payload
+        hash_fn = SHA256.new()
+        hash_fn.update(msg_payload)
+        request_hash = hash_fn.digest()
+
+        # the same request was already sent as early data with the login request, only its response is pending
+        if request_hash == self.early_request_hash:
+            self.early_request_hash = None
+        else:
+            # trying to send command request
+            try:
+                self.mtp.send_msg(self.mtp.type_command_req, msg_payload)
+            except SiFT_MTP_Error as e:
+                raise SiFT_CMD_Error('Unable to send command request --> ' + e.err_msg)
+
+        cmd_res_struct = self.receive_command_res(request_hash)
+        while cmd_res_struct['result_1'] == self.res_progress:
+            if progress: progress(cmd_res_struct['result_2'])
+            cmd_res_struct = self.receive_command_res(request_hash)
+        self.update_cache(cmd_req_struct, cmd_res_struct)
+        return cmd_res_struct
+
+
+    # sends a command request without waiting for the response and returns a future of the response,
+    # at most pipeline_depth requests are outstanding (to be used by the client)
+    def send_command_async(self, cmd_req_struct):
+
+        # upload and download continue with a transfer right after the response
+        if cmd_req_struct['command'] in (self.cmd_upl, self.cmd_dnl):
+            raise SiFT_CMD_Error('Upload and download commands cannot be pipelined')
+
+        # a paged listing or a recursive delete has several responses
+        if self.is_streamed(cmd_req_struct):
+            raise SiFT_CMD_Error('Paged listings and recursive deletes cannot be pipelined')
+
+        while self.pending_count >= self.pipeline_depth:
+            self.receive_pipelined_res()
+
+        # building a command request
+        msg_payload = self.build_command_req(cmd_req_struct)
+
+        # DEBUG 
+        if self.DEBUG:
+            print('Outgoing payload (' + str(len(msg_payload)) + '):')
+            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8', errors='backslashreplace'))
+            print('------------------------------------------')
+        # DEBUG 
+
+        # computing hash of request payload
+        hash_fn = SHA256.new()
+        hash_fn.update(msg_payload)
+        request_hash = hash_fn.digest()
+
+        # requests are queued in the MTP and go out together when a response is awaited
+        self.mtp.set_send_coalescing(True)
         try:
             self.mtp.send_msg(self.mtp.type_command_req, msg_payload)
         except SiFT_MTP_Error as e:
             raise SiFT_CMD_Error('Unable to send command request --> ' + e.err_msg)
 
-        # computing hash of sent request payload
+        future = SiFT_CMD_FUTURE(self, cmd_req_struct)
+        self.pending.setdefault(request_hash, deque()).append(future)
+        self.pending_count += 1
+        return future
+
+
+    # receives one response to a pipelined request and completes its future (to be used by the client)
+    # identical requests have identical hashes, their responses complete the futures in sending order
+    def receive_pipelined_res(self):
+
+        if not self.pending_count:
+            raise SiFT_CMD_Error('No pipelined command request is waiting for a response')
+
+        try:
+            msg_type, msg_payload = self.mtp.receive_msg()
+        except SiFT_MTP_Error as e:
+            self.fail_pipeline('Unable to receive command response --> ' + e.err_msg)
+
+        # DEBUG 
+        if self.DEBUG:
+            print('Incoming payload (' + str(len(msg_payload)) + '):')
+            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8', errors='backslashreplace'))
+            print('------------------------------------------')
+        # DEBUG 
+
+        if msg_type != self.mtp.type_command_res:
+            self.fail_pipeline('Command response expected, but received something else')
+
+        try:
+            cmd_res_struct = self.parse_command_res(msg_payload)
+        except:
+            self.fail_pipeline('Parsing command response failed')
+
+        futures = self.pending.get(cmd_res_struct['request_hash'])
+        if not futures or futures[0].command != cmd_res_struct['command']:
+            self.fail_pipeline('Verification of command response failed')
+
+        future = futures.popleft()
+        if not futures:
+            del self.pending[cmd_res_struct['request_hash']]
+        self.pending_count -= 1
+        if not self.pending_count:
+            self.mtp.set_send_coalescing(False)
+        future.cmd_res_struct = cmd_res_struct
+        self.update_cache(future.cmd_req_struct, cmd_res_struct)
+
+
+    # fails all outstanding pipelined requests, the session cannot be used any more
+    def fail_pipeline(self, err_msg):
+        for futures in self.pending.values():
+            for future in futures:
+                future.error = err_msg
+        self.pending = {}
+        self.pending_count = 0
+        raise SiFT_CMD_Error(err_msg)
+
+
+    # receives the responses of all outstanding pipelined requests (to be used by the client)
+    def drain_pipeline(self):
+        while self.pending_count:
+            self.receive_pipelined_res()
+
+
+    # sends the commands in batch requests and returns their responses in order (to be used by the client)
+    # with stop_on_error, the commands after the first failed one are not executed
+    def send_batch(self, cmd_req_structs, stop_on_error=True):
+
+        mode = self.batch_stop if stop_on_error else self.batch_continue
+        results = []
+        for i in range(0, len(cmd_req_structs), self.size_batch):
+            cmd_req_struct = {}
+            cmd_req_struct['command'] = self.cmd_bat
+            cmd_req_struct['param_1'] = mode
+            cmd_req_struct['param_2'] = cmd_req_structs[i:i+self.size_batch]
+            cmd_res_struct = self.send_command(cmd_req_struct)
+            if cmd_res_struct['result_1'] != self.res_success and not cmd_res_struct['result_2']:
+                raise SiFT_CMD_Error('Batch failed on the server without results')
+            results += cmd_res_struct['result_2']
+            if stop_on_error and cmd_res_struct['result_1'] != self.res_success:
+                break
+        return results
+
+
+    # tells if the server answers a command request with several responses
+    def is_streamed(self, cmd_req_struct):
+        if cmd_req_struct['command'] == self.cmd_lst:
+            return 'param_1' in cmd_req_struct # paged listing
+        if cmd_req_struct['command'] == self.cmd_del:
+            return cmd_req_struct.get('param_2') == self.del_recursive # progress of a recursive delete
+        return cmd_req_struct['command'] in (self.cmd_mnf, self.cmd_fnd) # always paged
+
+
+    # lists the current directory on the server in pages and yields the entries as the pages arrive (to be used by the client)
+    # directories end with /, a listing can be continued from the cursor (number of entries already seen)
+    # a long listing yields dictionaries made by parse_long_entry(), a recursive one the paths of all entries below the directory
+    def iter_listing(self, page_size=None, cursor='0', long=False, recursive=False):
+
+        if long and recursive:
+            raise SiFT_CMD_Error('Long listings cannot be recursive')
+
+        cmd_req_struct = {}
+        cmd_req_struct['command'] = self.cmd_lst
+        cmd_req_struct['param_1'] = cursor
+        cmd_req_struct['param_2'] = page_size or self.size_lst_entries
+        if long: cmd_req_struct['param_3'] = self.lst_long
+        elif recursive: cmd_req_struct['param_3'] = self.lst_recursive
+        yield from self.iter_pages(cmd_req_struct, self.parse_long_entry if long else None)
+
+
+    # yields the entries of everything below the current directory on the server as made by parse_long_entry(),
+    # named by their paths relative to it, down to depth (0 for no limit) and only those whose names match the pattern
+    # (e.g., *.txt), the server scans the tree while the pages are sent (to be used by the client)
+    def iter_manifest(self, depth=0, pattern=None, page_size=None):
+
+        cmd_req_struct = {}
+        cmd_req_struct['command'] = self.cmd_mnf
+        cmd_req_struct['param_1'] = page_size or self.size_lst_entries
+        cmd_req_struct['param_2'] = depth
+        if pattern: cmd_req_struct['param_3'] = pattern
+        yield from self.iter_pages(cmd_req_struct, self.parse_long_entry)
+
+
+    # yields the entries below the current directory on the server whose names match the pattern (glob, or part of the name
+    # without * ? [) as made by parse_long_entry(), named by their paths relative to it, filters bound size and mtime
+    # (e.g., 'size>=1000 mtime<1700000000'), the server finds them in its name index (to be used by the client)
+    def iter_find(self, pattern, filters='', page_size=None):
+
+        cmd_req_struct = {}
+        cmd_req_struct['command'] = self.cmd_fnd
+        cmd_req_struct['param_1'] = page_size or self.size_lst_entries
+        cmd_req_struct['param_2'] = pattern
+        if filters: cmd_req_struct['param_3'] = filters
+        yield from self.iter_pages(cmd_req_struct, self.parse_long_entry)
+
+
+    # returns the recursive byte and file counts of a directory on the server given by its path relative to the current directory
+    # ('' for the current directory itself) as a dict with bytes, files and name (''), with the dicts of its subdirectories
+    # (names ending with /) in subdirs (to be used by the client)
+    def disk_usage(self, path=''):
+
+        cmd_req_struct = {}
+        cmd_req_struct['command'] = self.cmd_dus
+        cmd_req_struct['param_1'] = path
+        cmd_res_struct = self.send_command(cmd_req_struct)
+        if cmd_res_struct['result_1'] == self.res_failure:
+            raise SiFT_CMD_Error('Getting disk usage failed on the server --> ' + cmd_res_struct['result_2'])
+        entries = []
+        for line in cmd_res_struct['result_2'].split('\n'):
+            fields = line.split('\t', 2)
+            entries.append({'bytes': int(fields[0]), 'files': int(fields[1]), 'name': fields[2]})
+        entries[0]['subdirs'] = entries[1:]
+        return entries[0]
+
+
+    # sends a paged listing request and yields the entries as the pages arrive, parsed by parse if given
+    def iter_pages(self, cmd_req_struct, parse=None):
+
+        cmd_res_struct = self.send_command(cmd_req_struct)
+        request_hash = cmd_res_struct['request_hash']
+
+        last_page = False
+        try:
+            while True:
+                if cmd_res_struct['result_1'] == self.res_failure:
+                    last_page = True
+                    raise SiFT_CMD_Error('Listing failed on the server --> ' + cmd_res_struct['result_2'])
+                last_page = not cmd_res_struct.get('result_3') # servers without paging send one page without cursor
+                if cmd_res_struct['result_2'] and parse:
+                    yield from map(parse, cmd_res_struct['result_2'].split('\n'))
+                elif cmd_res_struct['result_2']:
+                    yield from cmd_res_struct['result_2'].split('\n')
+                if last_page:
+                    return
+                cmd_res_struct = self.receive_command_res(request_hash)
+        finally:
+            # the pages of an abandoned listing are still received, so that the next response is in sync
+            while not last_page:
+                cmd_res_struct = self.receive_command_res(request_hash)
+                last_page = cmd_res_struct['result_1'] == self.res_failure or not cmd_res_struct.get('result_3')
+
+
+    # updates the cached remote state with a command and its response (to be used by the client)
+    # the client's own chd moves the tracked cwd, its own mkd, del and upl drop the affected listings
+    def update_cache(self, cmd_req_struct, cmd_res_struct):
+
+        command = cmd_req_struct['command']
+        if command == self.cmd_bat and isinstance(cmd_res_struct.get('result_2'), list):
+            for item_req_struct, item_res_struct in zip(cmd_req_struct['param_2'], cmd_res_struct['result_2']):
+                self.update_cache(item_req_struct, item_res_struct)
+
+        elif command == self.cmd_pwd:
+            if cmd_res_struct['result_1'] == self.res_success:
+                self.cached_cwd = cmd_res_struct['result_2']
+
+        elif command == self.cmd_chd:
+            if cmd_res_struct['result_1'] == self.res_success and self.cached_cwd is not None:
+                parts = [part for part in self.cached_cwd.split('/') if part]
+                for part in cmd_req_struct['param_1'].split('/'):
+                    if part == '..': parts = parts[:-1]
+                    elif part: parts.append(part)
+                self.cached_cwd = '/'.join(parts) + '/'
+
+        elif command in (self.cmd_mkd, self.cmd_del, self.cmd_upl):
+            self.drop_cached_listings(cmd_req_struct['param_1'])
+
+        elif command in (self.cmd_cpy, self.cmd_mov):
+            self.drop_cached_listings(cmd_req_struct['param_1'])
+            self.drop_cached_listings(cmd_req_struct['param_2'])
+            if command == self.cmd_mov and '..' in cmd_req_struct['param_1'].split('/'): # the moved directory may hold the cwd
+                self.cached_cwd = None
+
+
+    # drops the cached listings that a change at the given path (relative to the cwd) may have made stale
+    def drop_cached_listings(self, path):
+        if self.cached_cwd is None or '..' in path.split('/'):
+            self.cached_listings.clear()
+        else: # the current directory and everything below the first directory of the path
+            subdir = '/'.join(p for p in (self.cached_cwd.strip('/'), path.split('/')[0]) if p) + '/'
+            for cached in [cached for cached in self.cached_listings if cached == self.cached_cwd or cached.startswith(subdir)]:
+                del self.cached_listings[cached]
+
+
+    # returns the current directory on the server, asking the server only if it is not tracked yet (to be used by the client)
+    def get_cwd(self, refresh=False):
+        if self.cached_cwd is None or refresh:
+            cmd_res_struct = self.send_command({'command': self.cmd_pwd})
+            if cmd_res_struct['result_1'] == self.res_failure:
+                raise SiFT_CMD_Error('Getting the current directory failed on the server --> ' + cmd_res_struct['result_2'])
+        return self.cached_cwd
+
+
+    # returns the entries of the current directory on the server, from the cache if they were listed within cache_ttl seconds
+    # (to be used by the client)
+    def get_listing(self, refresh=False):
+
+        cwd = self.get_cwd()
+        listing = self.cached_listings.get(cwd)
+        if listing is not None and not refresh and time.monotonic() - listing[0] < self.cache_ttl:
+            self.cached_listings.move_to_end(cwd)
+            return listing[1]
+
+        listed_at = time.monotonic()
+        entries = tuple(self.iter_listing())
+        if self.cache_ttl:
+            self.cached_listings[cwd] = (listed_at, entries)
+            self.cached_listings.move_to_end(cwd)
+            while len(self.cached_listings) > self.size_client_cache:
+                self.cached_listings.popitem(last=False)
+        return entries
+
+
+    # parses a line of a long listing into a dictionary
+    def parse_long_entry(self, line):
+        fields = line.split('\t', 4)
+        entry = {}
+        entry['type'] = fields[0] # 'f', 'd' or '-' (stt of a path that does not exist)
+        entry['size'] = int(fields[1])
+        entry['mtime_ns'] = int(fields[2])
+        entry['hash'] = bytes.fromhex(fields[3]) if fields[3] else None
+        entry['name'] = fields[4]
+        return entry
+
+
+    # returns the entries of the given paths (relative to the current directory) on the server as made by parse_long_entry(),
+    # type '-' for paths that do not exist, hashes unknown to the server are computed by it if compute_hash (to be used by the client)
+    def stat_paths(self, paths, compute_hash=False):
+
+        futures = []
+        for i in range(0, len(paths), self.size_stt_paths):
+            cmd_req_struct = {}
+            cmd_req_struct['command'] = self.cmd_stt
+            cmd_req_struct['param_1'] = '\n'.join(paths[i:i+self.size_stt_paths])
+            if compute_hash: cmd_req_struct['param_2'] = self.stt_hash
+            futures.append(self.send_command_async(cmd_req_struct))
+
+        entries = []
+        for future in futures:
+            cmd_res_struct = future.result()
+            if cmd_res_struct['result_1'] == self.res_failure:
+                raise SiFT_CMD_Error('Getting file status failed on the server --> ' + cmd_res_struct['result_2'])
+            entries += map(self.parse_long_entry, cmd_res_struct['result_2'].split('\n'))
+        return entries
+
+
+    # starts watching a directory on the server given by its path relative to the current directory ('' for the current
+    # directory itself), or ends watching it if stop, change events are passed to the watch handler (to be used by the client)
+    def watch(self, path='', stop=False):
+
+        cmd_req_struct = {}
+        cmd_req_struct['command'] = self.cmd_wch
+        cmd_req_struct['param_1'] = path
+        if stop: cmd_req_struct['param_2'] = self.wch_stop
+        self.mtp.set_notify_handler(self.handle_notify)
+        cmd_res_struct = self.send_command(cmd_req_struct)
+        if cmd_res_struct['result_1'] == self.res_failure:
+            raise SiFT_CMD_Error('Watching failed on the server --> ' + cmd_res_struct['result_2'])
+
+
+    # sets the handler called with the (event, path) pairs of each notification, events are 'create', 'delete', 'modify'
+    # and 'rescan', paths are relative to the user root and directories end with / (to be used by the client)
+    def set_watch_handler(self, handler):
+        self.watch_handler = handler
+
+
+    # handles a notification of the server: the cached listings of the changed directories are dropped
+    # and the events are passed to the watch handler (to be used by the client)
+    def handle_notify(self, msg_payload):
+
+        # DEBUG 
+        if self.DEBUG:
+            print('Incoming payload (' + str(len(msg_payload)) + '):')
+            print(msg_payload[:512].decode('utf-8', errors='backslashreplace'))
+            print('------------------------------------------')
+        # DEBUG 
+
+        try:
+            notify_struct = self.parse_command_res(msg_payload)
+        except:
+            raise SiFT_CMD_Error('Parsing notification failed')
+
+        events = [tuple(line.split('\t', 1)) for line in (notify_struct.get('result_2') or '').split('\n') if line]
+        for event, path in events:
+            entry = path.rstrip('/')
+            self.cached_listings.pop(entry.rsplit('/', 1)[0] + '/' if '/' in entry else '/', None) # the directory of the entry
+            if path.endswith('/'): self.cached_listings.pop(path, None) # the entry itself (or the directory of a rescan event)
+        if self.watch_handler:
+            self.watch_handler(events)
+
+
+    # waits up to timeout seconds (None for no limit) for a notification of the watched directories and handles it,
+    # returns False if none arrived (to be used by the client)
+    def wait_events(self, timeout=None):
+        self.drain_pipeline()
+        try:
+            return self.mtp.receive_notify(timeout)
+        except SiFT_MTP_Error as e:
+            raise SiFT_CMD_Error('Unable to receive notification --> ' + e.err_msg)
+
+
+    # compares the files of a local directory with the current directory on the server using one long listing (to be used by the client)
+    # the server computes the hashes it does not know yet for files of the same size
+    # returns file name --> 'same', 'different', 'unknown' (the file changed on the server meanwhile), 'local only' or 'remote only'
+    def compare_directory(self, local_dir):
+
+        remote = {entry['name']: entry for entry in self.iter_listing(long=True) if entry['type'] == 'f'}
+        unhashed = [name for name, entry in remote.items() if entry['hash'] is None and self.check_fdname(name)
+                    and os.path.isfile(os.path.join(local_dir, name)) and os.path.getsize(os.path.join(local_dir, name)) == entry['size']]
+        if unhashed:
+            for entry in self.stat_paths(unhashed, compute_hash=True):
+                if entry['type'] == 'f' and entry['size'] == remote[entry['name']]['size']:
+                    remote[entry['name']]['hash'] = entry['hash']
+        status = {}
+        with os.scandir(local_dir) as entries:
+            for f in entries:
+                if f.name.startswith('.') or not f.is_file(): continue
+                entry = remote.pop(f.name, None)
+                if entry is None:
+                    status[f.name] = 'local only'
+                elif entry['size'] != f.stat().st_size:
+                    status[f.name] = 'different'
+                elif entry['hash'] is None:
+                    status[f.name] = 'unknown'
+                else:
+                    hash_fn = SHA256.new()
+                    with open(f.path, 'rb') as lf:
+                        for chunk in iter(lambda: lf.read(self.size_hash_chunk), b''):
+                            hash_fn.update(chunk)
+                    status[f.name] = 'same' if hash_fn.digest() == entry['hash'] else 'different'
+        for name in remote:
+            status[name] = 'remote only'
+        return status
+
+
+    # builds a command request to be sent as early data with the login request (to be used by the client)
+    # after the login, send_command() with the same request only receives the response
+    def build_early_command(self, cmd_req_struct):
+
+        msg_payload = self.build_command_req(cmd_req_struct)
+
         hash_fn = SHA256.new()
         hash_fn.update(msg_payload)
-        request_hash = hash_fn.digest()
+        self.early_request_hash = hash_fn.digest()
+
+        return msg_payload
+
+
+    # receives and verifies the response to the command with the given request hash (to be used by the client)
+    def receive_command_res(self, request_hash):
 
         # trying to receive a command response
         try:
@@ -303,7 +921,7 @@ class SiFT_CMD:
         # DEBUG 
         if self.DEBUG:
             print('Incoming payload (' + str(len(msg_payload)) + '):')
-            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8'))
+            print(msg_payload[:max(512, len(msg_payload))].decode('utf-8', errors='backslashreplace'))
             print('------------------------------------------')
         # DEBUG 
 
@@ -337,170 +955,1132 @@ class SiFT_CMD:
         return True
 
 
-    # execute command
+    # splits a path relative to the current directory into its names, each one is checked with check_fdname()
+    # (.. is accepted if allow_parent), returns None if a name is not accepted
+    def split_path(self, path, allow_parent=False):
+        if path.endswith('/'): path = path[:-1]
+        names = path.split('/')
+        for name in names:
+            if not (self.check_fdname(name) or (allow_parent and name == '..')): return None
+        return names
+
+
+    # resolves the names of a path relative to the current directory into names relative to the user root
+    # returns None if .. leads outside of the user root directory
+    def resolve_names(self, names):
+        dirnames = list(self.current_dir)
+        for name in names:
+            if name != '..': dirnames.append(name)
+            elif dirnames: dirnames.pop()
+            else: return None
+        return dirnames
+
+
+    # path of a directory given by its names below the user root, ending with /
+    def dir_path(self, dirnames):
+        path = self.server_rootdir + self.user_rootdir + '/'.join(dirnames)
+        if path[-1] != '/': path += '/'
+        return path
+
+
+    # path of the current directory, ending with /
+    def cwd_path(self):
+        return self.dir_path(self.current_dir)
+
+
+    # opens a directory to be used as dir_fd, relative to the given dir_fd
+    def open_dir(self, path, dir_fd=None):
+        return os.open(path, os.O_RDONLY | os.O_DIRECTORY, dir_fd=dir_fd)
+
+
+    # opens the directory reached from the user root through the given directory names
+    def open_dir_chain(self, dirnames):
+        fd = self.root_fd
+        try:
+            for dirname in dirnames:
+                next_fd = self.open_dir(dirname, fd)
+                if fd != self.root_fd: os.close(fd)
+                fd = next_fd
+        except OSError:
+            if fd != self.root_fd: os.close(fd)
+            raise
+        return fd
+
+
+    # returns the fd of the current directory, the user root and the cwd are opened on first use
+    # returns None if the platform has no dir_fd support, full paths are used then
+    def get_cwd_fd(self):
+        if not self.dir_fd_supported:
+            return None
+        if self.root_fd is None:
+            self.root_fd = self.open_dir(self.server_rootdir + self.user_rootdir)
+        if self.cwd_fd is None:
+            self.cwd_fd = self.open_dir_chain(self.current_dir)
+        return self.cwd_fd
+
+
+    # returns the path and the dir_fd to use for a name in the current directory ('' for the directory itself)
+    def in_cwd(self, name=''):
+        fd = self.get_cwd_fd()
+        if fd is None:
+            return self.cwd_path() + name, None
+        return name or '.', fd
+
+
+    # returns the path and the dir_fd to use for the entry with the given names below the user root
+    def in_root(self, names):
+        if self.get_cwd_fd() is None:
+            return self.server_rootdir + self.user_rootdir + '/'.join(names), None
+        return '/'.join(names) or '.', self.root_fd
+
+
+    # returns an opener for open() that opens files relative to dir_fd
+    def opener(self, dir_fd):
+        return lambda path, flags: os.open(path, flags, 0o666, dir_fd=dir_fd)
+
+
+    # changes the current directory to the one reached from the user root through the given names,
+    # raises OSError if it is not a directory
+    def change_dir(self, dirnames):
+        if self.get_cwd_fd() is None:
+            if not os.path.isdir(self.dir_path(dirnames)):
+                raise NotADirectoryError('/'.join(dirnames))
+        else:
+            depth = len(self.current_dir)
+            if dirnames[:depth] == self.current_dir: # below the cwd, relative to it
+                fd = self.open_dir('/'.join(dirnames[depth:]) or '.', self.cwd_fd)
+            else: # walked from the user root, .. could lead out of it through a symbolic link
+                fd = self.open_dir_chain(dirnames)
+            if self.cwd_fd != self.root_fd: os.close(self.cwd_fd)
+            self.cwd_fd = fd
+        self.current_dir = list(dirnames)
+
+
+    # closes the directory fds of the session
+    def close_dirs(self):
+        if self.cwd_fd is not None and self.cwd_fd != self.root_fd: os.close(self.cwd_fd)
+        if self.root_fd is not None: os.close(self.root_fd)
+        self.cwd_fd = None
+        self.root_fd = None
+
+
+    # releases the resources of the session (to be used by the server when the client is gone)
+    def close(self):
+        self.close_listing()
+        self.unlock_paths(self.transfer_locks) # the session ended before the transfer
+        self.transfer_locks = []
+        self.close_dirs()
+        if self.watch_hub is not None:
+            self.watch_hub.remove(self)
+        self.watched.clear()
+
+
+    # execute command, the handler of the command fills in the response, its latency is recorded in the metrics
     def exec_cmd(self, cmd_req_struct, request_hash):
 
         cmd_res_struct = {}
         cmd_res_struct['command'] = cmd_req_struct['command']
         cmd_res_struct['request_hash'] = request_hash
 
-        # pwd
-        if cmd_req_struct['command'] == self.cmd_pwd:
-            cmd_res_struct['result_1'] = self.res_success
-            cmd_res_struct['result_2'] = '/'.join(self.current_dir) + '/'
-
-        # lst
-        elif cmd_req_struct['command'] == self.cmd_lst:
-            path = self.server_rootdir + self.user_rootdir + '/'.join(self.current_dir)
-            if os.path.exists(path):
-                dirlist_str = ''
-                with os.scandir(path) as dirlist:
-                    for f in dirlist:
-                        if not f.name.startswith('.'):
-                            if f.is_file(): dirlist_str += f.name + '\n'
-                            elif f.is_dir(): dirlist_str += f.name + '/\n'
-                if dirlist_str and dirlist_str[-1] == '\n': dirlist_str = dirlist_str[:-1]
+        handler = self.registry[cmd_req_struct['command']][0]
+        start = time.perf_counter()
+        handler(cmd_req_struct, cmd_res_struct)
+        if self.metrics is not None:
+            self.metrics.record(cmd_req_struct['command'] + ' ' + cmd_res_struct['result_1'], time.perf_counter() - start)
+
+        return cmd_res_struct
+
+
+    # returns the current directory
+    def serve_pwd(self, cmd_req_struct, cmd_res_struct):
+        cmd_res_struct['result_1'] = self.res_success
+        cmd_res_struct['result_2'] = '/'.join(self.current_dir) + '/'
+
+
+    # lists the current directory
+    def serve_lst(self, cmd_req_struct, cmd_res_struct):
+        paged = 'param_1' in cmd_req_struct # the first page is sent here and the rest by send_listing_pages()
+        cursor, page_size = cmd_req_struct.get('param_1'), cmd_req_struct.get('param_2')
+        if paged and (not cursor.isdigit() or not isinstance(page_size, int) or page_size < 1):
+            cmd_res_struct['result_1'] = self.res_failure
+            cmd_res_struct['result_2'] = 'Malformed listing cursor or page size'
+        else:
+            locks = []
+            try:
+                locks = self.lock_paths([(self.current_dir, False)]) # the first page, the rest is read without the lock
+                if cmd_req_struct.get('param_3') == self.lst_long:
+                    entries = self.iter_long_entries()
+                elif cmd_req_struct.get('param_3') == self.lst_recursive:
+                    entries = self.iter_tree_entries()
+                else:
+                    entries = self.iter_dir_entries()
+                if paged:
+                    self.listing = self.iter_listing_pages(entries, int(cursor), page_size)
+                    page, cursor = next(self.listing)
+                else:
+                    page = list(entries)
+            except TimeoutError:
+                cmd_res_struct['result_1'] = self.res_failure
+                cmd_res_struct['result_2'] = 'Directory is in use by another session'
+            except OSError:
+                self.close_listing()
+                cmd_res_struct['result_1'] = self.res_failure
+                cmd_res_struct['result_2'] = 'Operation failed due to local error on server'
+            else:
                 cmd_res_struct['result_1'] = self.res_success
-                cmd_res_struct['result_2'] = dirlist_str
+                cmd_res_struct['result_2'] = '\n'.join(page)
+                if paged:
+                    if not cursor: self.close_listing()
+                    cmd_res_struct['result_3'] = cursor
+            finally:
+                self.unlock_paths(locks)
+
+
+    # sends the manifest of the current directory: the long listing entries of everything below it, named by their paths,
+    # in pages like a paged listing, down to the given depth (0 for no limit) and only entries whose names match the pattern
+    def serve_mnf(self, cmd_req_struct, cmd_res_struct):
+        page_size, depth = cmd_req_struct['param_1'], cmd_req_struct['param_2']
+        if page_size < 1 or depth < 0:
+            cmd_res_struct['result_1'] = self.res_failure
+            cmd_res_struct['result_2'] = 'Malformed page size or depth'
+        else:
+            try:
+                self.listing = self.iter_listing_pages(self.iter_manifest_entries(depth, cmd_req_struct.get('param_3')), 0, page_size)
+                page, cursor = next(self.listing)
+            except OSError:
+                self.close_listing()
+                cmd_res_struct['result_1'] = self.res_failure
+                cmd_res_struct['result_2'] = 'Operation failed due to local error on server'
             else:
+                cmd_res_struct['result_1'] = self.res_success
+                cmd_res_struct['result_2'] = '\n'.join(page)
+                cmd_res_struct['result_3'] = cursor
+                if not cursor: self.close_listing()
+
+
+    # sends the entries below the current directory whose names match the pattern, found in the name index without
+    # scanning the tree, as long listing entries named by their paths in pages like a paged listing
+    # a pattern without * ? [ matches the names containing it, the filters bound size and mtime (e.g., size>=1000 mtime<1700000000)
+    def serve_fnd(self, cmd_req_struct, cmd_res_struct):
+        page_size, pattern = cmd_req_struct['param_1'], cmd_req_struct['param_2']
+        bounds = self.parse_filters(cmd_req_struct.get('param_3', ''))
+        if self.name_index is None:
+            cmd_res_struct['result_1'] = self.res_failure
+            cmd_res_struct['result_2'] = 'Finding files is not supported by the server'
+        elif page_size < 1 or not pattern or bounds is None:
+            cmd_res_struct['result_1'] = self.res_failure
+            cmd_res_struct['result_2'] = 'Malformed page size, pattern or filters'
+        elif self.longest_literal(pattern) < self.size_fnd_literal:
+            cmd_res_struct['result_1'] = self.res_failure
+            cmd_res_struct['result_2'] = 'Pattern needs at least ' + str(self.size_fnd_literal) + ' consecutive characters outside of wildcards'
+        else:
+            if not set(pattern) & set('*?['): pattern = '*' + pattern + '*'
+            try:
+                self.listing = self.iter_listing_pages(self.iter_found_entries(pattern, bounds), 0, page_size)
+                page, cursor = next(self.listing)
+            except OSError:
+                self.close_listing()
                 cmd_res_struct['result_1'] = self.res_failure
                 cmd_res_struct['result_2'] = 'Operation failed due to local error on server'
-
-        # chd
-        elif cmd_req_struct['command'] == self.cmd_chd:
-            dirname = cmd_req_struct['param_1']
-            if dirname == '..':
-                if not self.current_dir: # we are in user root dir
-                    cmd_res_struct['result_1'] = self.res_failure
-                    cmd_res_struct['result_2'] = 'Cannot change to directory outside of the user root directory'
-                else:
-                    path = self.server_rootdir + self.user_rootdir + '/'.join(self.current_dir[:-1])
-                    if not os.path.exists(path):
-                        cmd_res_struct['result_1'] = self.res_failure
-                        cmd_res_struct['result_2'] = 'Directory does not exist'
-                    else:                    
-                        self.current_dir = self.current_dir[:-1]
-                        cmd_res_struct['result_1'] = self.res_success
             else:
-                if not self.check_fdname(dirname):
-                    cmd_res_struct['result_1'] = self.res_failure
-                    cmd_res_struct['result_2'] = 'Directory name is empty, starts with . or contains unsupported characters'
-                else:
-                    path = self.server_rootdir + self.user_rootdir + '/'.join(self.current_dir)
-                    if path[-1] == '/': path += dirname
-                    else: path += '/' + dirname
-                    if not os.path.exists(path):
-                        cmd_res_struct['result_1'] = self.res_failure
-                        cmd_res_struct['result_2'] = 'Directory does not exist'
-                    else:                    
-                        self.current_dir.append(dirname)
-                        cmd_res_struct['result_1'] = self.res_success
-
-        # mkd
-        elif cmd_req_struct['command'] == self.cmd_mkd:
-            dirname = cmd_req_struct['param_1']
-            if not self.check_fdname(dirname):
+                cmd_res_struct['result_1'] = self.res_success
+                cmd_res_struct['result_2'] = '\n'.join(page)
+                cmd_res_struct['result_3'] = cursor
+                if not cursor: self.close_listing()
+
+
+    # sends the recursive byte and file counts of a directory given by its path relative to the current directory
+    # ('' for the current directory itself) and of each of its subdirectories, kept up to date by the server without scanning
+    # each line is bytes, files and name separated by tabs, the directory itself comes first with an empty name
+    def serve_dus(self, cmd_req_struct, cmd_res_struct):
+        path = cmd_req_struct['param_1']
+        names = [] if not path else self.split_path(path, allow_parent=True)
+        if self.usage is None:
+            cmd_res_struct['result_1'] = self.res_failure
+            cmd_res_struct['result_2'] = 'Disk usage is not supported by the server'
+        elif names is None:
+            cmd_res_struct['result_1'] = self.res_failure
+            cmd_res_struct['result_2'] = 'Directory name is empty, starts with . or contains unsupported characters'
+        elif self.resolve_names(names) is None:
+            cmd_res_struct['result_1'] = self.res_failure
+            cmd_res_struct['result_2'] = 'Cannot access files outside of the user root directory'
+        else:
+            try:
+                counts = self.usage.usage(os.path.abspath(self.dir_path([])), '/'.join(self.resolve_names(names)))
+            except OSError:
                 cmd_res_struct['result_1'] = self.res_failure
-                cmd_res_struct['result_2'] = 'Directory name is empty, starts with . or contains unsupported characters'
+                cmd_res_struct['result_2'] = 'Operation failed due to local error on server'
+                return
+            if counts is None:
+                cmd_res_struct['result_1'] = self.res_failure
+                cmd_res_struct['result_2'] = 'Directory does not exist'
+            else:
+                dir_bytes, dir_count, subdirs = counts
+                lines = ['\t'.join((str(dir_bytes), str(dir_count), ''))]
+                lines += ['\t'.join((str(subdir_bytes), str(subdir_count), name + '/')) for name, subdir_bytes, subdir_count in subdirs]
+                cmd_res_struct['result_1'] = self.res_success
+                cmd_res_struct['result_2'] = '\n'.join(lines)
+
+
+    # changes the current directory
+    def serve_chd(self, cmd_req_struct, cmd_res_struct):
+        names = self.split_path(cmd_req_struct['param_1'], allow_parent=True)
+        if names is None:
+            cmd_res_struct['result_1'] = self.res_failure
+            cmd_res_struct['result_2'] = 'Directory name is empty, starts with . or contains unsupported characters'
+        else:
+            dirnames = self.resolve_names(names)
+            if dirnames is None:
+                cmd_res_struct['result_1'] = self.res_failure
+                cmd_res_struct['result_2'] = 'Cannot change to directory outside of the user root directory'
             else:
-                path = self.server_rootdir + self.user_rootdir + '/'.join(self.current_dir)
-                if path[-1] == '/': path += dirname
-                else: path += '/' + dirname
-                if os.path.exists(path):
+                try:
+                    self.change_dir(dirnames)
+                except OSError:
                     cmd_res_struct['result_1'] = self.res_failure
-                    cmd_res_struct['result_2'] = 'Directory already exists'
+                    cmd_res_struct['result_2'] = 'Directory does not exist'
                 else:
-                    try:
-                        os.mkdir(path)
-                    except:
-                        cmd_res_struct['result_1'] = self.res_failure
-                        cmd_res_struct['result_2'] = 'Creating directory failed'                    
-                    else:
-                        cmd_res_struct['result_1'] = self.res_success
+                    cmd_res_struct['result_1'] = self.res_success
+
 
-        # del
-        elif cmd_req_struct['command'] == self.cmd_del:
-            fdname = cmd_req_struct['param_1']
-            if not self.check_fdname(fdname):
+    # creates a directory
+    def serve_mkd(self, cmd_req_struct, cmd_res_struct):
+        names = self.split_path(cmd_req_struct['param_1'])
+        if names is None:
+            cmd_res_struct['result_1'] = self.res_failure
+            cmd_res_struct['result_2'] = 'Directory name is empty, starts with . or contains unsupported characters'
+        else:
+            parents = cmd_req_struct.get('param_2') == self.mkd_parents
+            try:
+                self.make_dirs(names, parents)
+            except FileExistsError:
                 cmd_res_struct['result_1'] = self.res_failure
-                cmd_res_struct['result_2'] = 'File name or directory name is empty, starts with . or contains unsupported characters'
+                cmd_res_struct['result_2'] = 'Directory already exists'
+            except OSError:
+                cmd_res_struct['result_1'] = self.res_failure
+                cmd_res_struct['result_2'] = 'Creating directory failed'
             else:
-                path = self.server_rootdir + self.user_rootdir + '/'.join(self.current_dir)
-                if path[-1] == '/': path += fdname
-                else: path += '/' + fdname
-                if not os.path.exists(path):
+                cmd_res_struct['result_1'] = self.res_success
+            finally: # with parents, some of the directories may have been created before a failure
+                for i in range(0 if parents else len(names) - 1, len(names)):
+                    self.invalidate_listing(self.cwd_path() + '/'.join(names[:i]))
+                    self.notify_change(self.cwd_path() + '/'.join(names[:i]), names[i])
+
+
+    # removes a file or a directory
+    def serve_del(self, cmd_req_struct, cmd_res_struct):
+        names = self.split_path(cmd_req_struct['param_1'])
+        recursive = cmd_req_struct.get('param_2') == self.del_recursive
+        if names is None:
+            cmd_res_struct['result_1'] = self.res_failure
+            cmd_res_struct['result_2'] = 'File name or directory name is empty, starts with . or contains unsupported characters'
+        else:
+            try:
+                locks = self.lock_paths([(self.current_dir + names, True)])
+            except TimeoutError:
+                cmd_res_struct['result_1'] = self.res_failure
+                cmd_res_struct['result_2'] = 'File or directory is in use by another session'
+                return
+            try:
+                try:
+                    path, fd = self.in_cwd('/'.join(names))
+                    st = os.stat(path, dir_fd=fd, follow_symlinks=not recursive)
+                except OSError:
                     cmd_res_struct['result_1'] = self.res_failure
                     cmd_res_struct['result_2'] = 'File or directory does not exist'
                 else:
-                    if os.path.isdir(path): # remove directory
+                    if stat.S_ISDIR(st.st_mode): # remove directory
                         try:
-                            os.rmdir(path)
-                        except:
+                            if recursive:
+                                cmd_res_struct['result_2'] = self.remove_tree(path, fd, lambda count: self.send_progress(cmd_res_struct, count))
+                            else:
+                                os.rmdir(path, dir_fd=fd)
+                        except OSError:
                             cmd_res_struct['result_1'] = self.res_failure
-                            cmd_res_struct['result_2'] = 'Removing directory failed'                    
+                            cmd_res_struct['result_2'] = 'Removing directory failed'
                         else:
                             cmd_res_struct['result_1'] = self.res_success
-                    elif os.path.isfile(path): # remove file
+                        finally: # a failed recursive delete may still have removed entries
+                            self.invalidate_listing(self.cwd_path() + '/'.join(names))
+                            self.invalidate_listing(self.cwd_path() + '/'.join(names[:-1]))
+                            self.notify_change(self.cwd_path() + '/'.join(names[:-1]), names[-1])
+                    elif stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode): # remove file (symbolic links are only seen in recursive mode)
                         try:
-                            os.remove(path)
-                        except:
+                            removed_st = os.stat(path, dir_fd=fd, follow_symlinks=False) if self.hash_index is not None else None
+                            os.unlink(path, dir_fd=fd)
+                        except OSError:
                             cmd_res_struct['result_1'] = self.res_failure
-                            cmd_res_struct['result_2'] = 'Removing file failed'                    
+                            cmd_res_struct['result_2'] = 'Removing file failed'
                         else:
+                            self.forget_hashes([removed_st] if removed_st else [])
+                            self.invalidate_listing(self.cwd_path() + '/'.join(names[:-1]))
+                            self.notify_change(self.cwd_path() + '/'.join(names[:-1]), names[-1])
                             cmd_res_struct['result_1'] = self.res_success
+                            if recursive: cmd_res_struct['result_2'] = 1
                     else:
                         cmd_res_struct['result_1'] = self.res_failure
-                        cmd_res_struct['result_2'] = 'Object is not a file or directory'                    
-
-        # upl
-        elif cmd_req_struct['command'] == self.cmd_upl:
-            filename = cmd_req_struct['param_1']
-            filesize = cmd_req_struct['param_2']
-            filehash = cmd_req_struct['param_3']
-            if not self.check_fdname(filename):
+                        cmd_res_struct['result_2'] = 'Object is not a file or directory'
+            finally:
+                self.unlock_paths(locks)
+
+
+    # accepts or rejects an upload, the file is received by exec_upl()
+    def serve_upl(self, cmd_req_struct, cmd_res_struct):
+        filename = cmd_req_struct['param_1']
+        filesize = cmd_req_struct['param_2']
+        filehash = cmd_req_struct['param_3']
+        if not self.check_fdname(filename):
+            cmd_res_struct['result_1'] = self.res_reject
+            cmd_res_struct['result_2'] = 'File name is empty, starts with . or contains unsupported characters'
+        else:
+            if filesize > self.filesize_limit:
                 cmd_res_struct['result_1'] = self.res_reject
-                cmd_res_struct['result_2'] = 'File name is empty, starts with . or contains unsupported characters'
+                cmd_res_struct['result_2'] = 'File to be uploaded is too large'
+            # elif ...: # potentially checking the filehash e.g., against a blacklist
             else:
-                if filesize > self.filesize_limit:
+                try: # held until exec_upl() received the file
+                    self.transfer_locks = self.lock_paths([(self.current_dir + [filename], True)])
+                except TimeoutError:
                     cmd_res_struct['result_1'] = self.res_reject
-                    cmd_res_struct['result_2'] = 'File to be uploaded is too large'
-                # elif ...: # potentially checking the filehash e.g., against a blacklist
-                else:    
+                    cmd_res_struct['result_2'] = 'File is in use by another session'
+                else:
                     cmd_res_struct['result_1'] = self.res_accept
 
-        # dnl
-        elif cmd_req_struct['command'] == self.cmd_dnl:
-            filename = cmd_req_struct['param_1']
-            if not self.check_fdname(filename):
+
+    # accepts a download with the size and the hash of the file or rejects it, the file is sent by exec_dnl()
+    def serve_dnl(self, cmd_req_struct, cmd_res_struct):
+        filename = cmd_req_struct['param_1']
+        if not self.check_fdname(filename):
+            cmd_res_struct['result_1'] = self.res_reject
+            cmd_res_struct['result_2'] = 'File name is empty, starts with . or contains unsupported characters'
+        else:
+            try: # held until exec_dnl() sent the file
+                self.transfer_locks = self.lock_paths([(self.current_dir + [filename], False)])
+            except TimeoutError:
                 cmd_res_struct['result_1'] = self.res_reject
-                cmd_res_struct['result_2'] = 'File name is empty, starts with . or contains unsupported characters'
-            else:
-                path = self.server_rootdir + self.user_rootdir + '/'.join(self.current_dir)
-                if path[-1] == '/': filepath = path + filename
-                else: filepath = path + '/' + filename
-                if not os.path.exists(filepath):
+                cmd_res_struct['result_2'] = 'File is in use by another session'
+                return
+            try:
+                try:
+                    path, fd = self.in_cwd(filename)
+                    st = os.stat(path, dir_fd=fd)
+                except OSError:
                     cmd_res_struct['result_1'] = self.res_reject
                     cmd_res_struct['result_2'] = 'File or directory does not exist'
                 else:
-                    if not os.path.isfile(filepath): # not a file
+                    if not stat.S_ISREG(st.st_mode): # not a file
                         cmd_res_struct['result_1'] = self.res_reject
                         cmd_res_struct['result_2'] = 'Only file download is supported'
                     else:
-                        with open(filepath, 'rb') as f:
-                            hash_fn = SHA256.new()
-                            file_size = 0
-                            byte_count = 1024
-                            while byte_count == 1024:
-                                chunk = f.read(1024)
-                                byte_count = len(chunk)
-                                file_size += byte_count
-                                hash_fn.update(chunk)
-                            file_hash = hash_fn.digest()
+                        # an unchanged file is accepted with the hash from the index, others are hashed and indexed,
+                        # unless the client takes the hash after the file (empty hash in the response)
+                        file_size = st.st_size
+                        file_hash = self.hash_index.get(st) if self.hash_index is not None else None
+                        if file_hash is None and cmd_req_struct.get('param_2') == self.dnl_trailer:
+                            file_hash = b''
+                        elif file_hash is None:
+                            file_hash, file_size = self.hash_file(path, fd)
+                            if file_size == st.st_size: self.index_hash(path, fd, st, file_hash)
                         cmd_res_struct['result_1'] = self.res_accept
                         cmd_res_struct['result_2'] = file_size
                         cmd_res_struct['result_3'] = file_hash
+            finally:
+                if cmd_res_struct.get('result_1') != self.res_accept:
+                    self.unlock_paths(self.transfer_locks)
+                    self.transfer_locks = []
+
+
+    # copies or moves a file or directory
+    def serve_cpy_mov(self, cmd_req_struct, cmd_res_struct):
+        src_names = self.split_path(cmd_req_struct['param_1'], allow_parent=True)
+        dst_names = self.split_path(cmd_req_struct['param_2'], allow_parent=True)
+        if src_names is None or dst_names is None:
+            cmd_res_struct['result_1'] = self.res_failure
+            cmd_res_struct['result_2'] = 'File name or directory name is empty, starts with . or contains unsupported characters'
+        else:
+            src_names, dst_names = self.resolve_names(src_names), self.resolve_names(dst_names)
+            if src_names is None or dst_names is None:
+                cmd_res_struct['result_1'] = self.res_failure
+                cmd_res_struct['result_2'] = 'Cannot copy or move outside of the user root directory'
+            elif not src_names:
+                cmd_res_struct['result_1'] = self.res_failure
+                cmd_res_struct['result_2'] = 'Cannot copy or move the user root directory'
+            else:
+                try:
+                    if cmd_req_struct['command'] == self.cmd_cpy:
+                        self.copy_entry(src_names, dst_names)
+                    else:
+                        self.move_entry(src_names, dst_names)
+                except FileNotFoundError:
+                    cmd_res_struct['result_1'] = self.res_failure
+                    cmd_res_struct['result_2'] = 'File or directory does not exist'
+                except FileExistsError:
+                    cmd_res_struct['result_1'] = self.res_failure
+                    cmd_res_struct['result_2'] = 'Destination already exists'
+                except TimeoutError:
+                    cmd_res_struct['result_1'] = self.res_failure
+                    cmd_res_struct['result_2'] = 'File or directory is in use by another session'
+                except IsADirectoryError:
+                    cmd_res_struct['result_1'] = self.res_failure
+                    cmd_res_struct['result_2'] = 'Only files can be copied, or moved across file systems'
+                except OSError:
+                    cmd_res_struct['result_1'] = self.res_failure
+                    cmd_res_struct['result_2'] = 'Copying failed' if cmd_req_struct['command'] == self.cmd_cpy else 'Moving failed'
+                else:
+                    cmd_res_struct['result_1'] = self.res_success
+
+
+    # returns type, size, mtime and the known hash of the given paths (relative to the current directory) as long listing entries
+    # type '-' stands for a path that does not exist or is neither a file nor a directory, in hash mode missing hashes are computed
+    def serve_stt(self, cmd_req_struct, cmd_res_struct):
+        paths = cmd_req_struct['param_1'].split('\n')
+        compute_hash = cmd_req_struct.get('param_2') == self.stt_hash
+        names = [self.split_path(path, allow_parent=True) for path in paths]
+        if len(paths) > self.size_stt_paths:
+            cmd_res_struct['result_1'] = self.res_failure
+            cmd_res_struct['result_2'] = 'Too many paths in one request'
+        elif None in names:
+            cmd_res_struct['result_1'] = self.res_failure
+            cmd_res_struct['result_2'] = 'File name or directory name is empty, starts with . or contains unsupported characters'
+        else:
+            names = [self.resolve_names(entry_names) for entry_names in names]
+            if None in names:
+                cmd_res_struct['result_1'] = self.res_failure
+                cmd_res_struct['result_2'] = 'Cannot access files outside of the user root directory'
+            else:
+                cmd_res_struct['result_1'] = self.res_success
+                cmd_res_struct['result_2'] = '\n'.join(self.stat_entry(path, entry_names, compute_hash)
+                                                       for path, entry_names in zip(paths, names))
+
+
+    # starts or (in stop mode) ends watching a directory given by its path relative to the current directory ('' for the
+    # current directory itself), its change events are pushed to the client in notifications by the notifier thread
+    def serve_wch(self, cmd_req_struct, cmd_res_struct):
+        path = cmd_req_struct['param_1']
+        names = [] if not path else self.split_path(path, allow_parent=True)
+        if self.watch_hub is None:
+            cmd_res_struct['result_1'] = self.res_failure
+            cmd_res_struct['result_2'] = 'Watching directories is not supported by the server'
+        elif names is None:
+            cmd_res_struct['result_1'] = self.res_failure
+            cmd_res_struct['result_2'] = 'Directory name is empty, starts with . or contains unsupported characters'
+        elif self.resolve_names(names) is None:
+            cmd_res_struct['result_1'] = self.res_failure
+            cmd_res_struct['result_2'] = 'Cannot watch outside of the user root directory'
+        else:
+            names = self.resolve_names(names)
+            abspath = os.path.abspath(self.dir_path(names))
+            if cmd_req_struct.get('param_2') == self.wch_stop:
+                if self.watch_hub.unsubscribe(self, abspath):
+                    self.watched.discard(abspath)
+                    cmd_res_struct['result_1'] = self.res_success
+                else:
+                    cmd_res_struct['result_1'] = self.res_failure
+                    cmd_res_struct['result_2'] = 'Directory is not watched'
+                return
+            try:
+                dir_path, fd = self.in_root(names)
+                is_dir = stat.S_ISDIR(os.stat(dir_path, dir_fd=fd).st_mode)
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                cmd_res_struct['result_1'] = self.res_failure
+                cmd_res_struct['result_2'] = 'Directory does not exist'
+            elif abspath not in self.watched and len(self.watched) >= self.size_watches:
+                cmd_res_struct['result_1'] = self.res_failure
+                cmd_res_struct['result_2'] = 'Too many watched directories'
+            else:
+                self.watch_hub.subscribe(self, abspath, '/'.join(names) + '/' if names else '')
+                self.watched.add(abspath)
+                cmd_res_struct['result_1'] = self.res_success
 
-        return cmd_res_struct
+
+    # executes the commands of a batch, each with its own result
+    def serve_bat(self, cmd_req_struct, cmd_res_struct):
+        stop_on_error = cmd_req_struct['param_1'] != self.batch_continue
+        cmd_res_struct['result_1'] = self.res_success
+        cmd_res_struct['result_2'] = []
+        for item_req_struct in cmd_req_struct['param_2']:
+            if item_req_struct['command'] in self.batch_commands and not self.is_streamed(item_req_struct):
+                item_res_struct = self.exec_cmd(item_req_struct, b'') # results carry no request hash of their own
+            else: # upl and dnl answer with reject instead of failure
+                item_res_struct = {'command': item_req_struct['command'], 'request_hash': b'',
+                                   'result_1': self.res_reject if item_req_struct['command'] in (self.cmd_upl, self.cmd_dnl) else self.res_failure,
+                                   'result_2': 'Command or mode is not supported in a batch'}
+            cmd_res_struct['result_2'].append(item_res_struct)
+            if item_res_struct['result_1'] != self.res_success:
+                cmd_res_struct['result_1'] = self.res_failure
+                if stop_on_error: break
+
+
+    # yields the listed entries of the current directory as read by os.scandir, names of directories end with /
+    def scan_dir_entries(self):
+        path, fd = self.in_cwd()
+        with os.scandir(path if fd is None else fd) as entries:
+            for f in entries:
+                if f.name.startswith('.'): continue
+                if f.is_file(): yield f.name
+                elif f.is_dir(): yield f.name + '/'
+
+
+    # yields the listed entries of the current directory, from the listing cache if the directory did not change
+    # a complete scan of a directory that is small enough is put in the cache
+    def iter_dir_entries(self):
+
+        if self.listing_cache is None:
+            yield from self.scan_dir_entries()
+            return
+
+        abspath = os.path.abspath(self.cwd_path())
+        path, fd = self.in_cwd()
+        mtime_ns = os.stat(path, dir_fd=fd).st_mtime_ns # read before the scan, so a change during the scan makes the entry stale
+        entries = self.listing_cache.get(abspath, mtime_ns)
+        if entries is not None:
+            yield from entries
+            return
+
+        entries = []
+        for name in self.scan_dir_entries():
+            if entries is not None:
+                entries.append(name)
+                if len(entries) > self.listing_cache.max_dir_entries: entries = None
+            yield name
+        if entries is not None:
+            self.listing_cache.put(abspath, mtime_ns, entries)
+
+
+    # drops the cached listing of a directory changed by this session
+    def invalidate_listing(self, path):
+        if self.listing_cache is not None:
+            self.listing_cache.invalidate(os.path.abspath(path))
+
+
+    # reports a possible change of an entry of a directory to the watchers of the directory, to the name index
+    # and to the directory counts
+    def notify_change(self, dir_path, name):
+        if self.watch_hub is not None:
+            self.watch_hub.publish(os.path.abspath(dir_path), name)
+        root = os.path.abspath(self.dir_path([]))
+        dir_path = os.path.relpath(os.path.abspath(dir_path), root)
+        if dir_path == '.': dir_path = ''
+        if self.name_index is not None:
+            self.name_index.update(root, dir_path, name)
+        if self.usage is not None:
+            self.usage.update(root, dir_path, name)
+
+
+    # parses the filters of fnd into (min size, max size, min mtime (ns), max mtime (ns)), None for no bound,
+    # returns None if a filter is malformed
+    def parse_filters(self, filters):
+        bounds = [None, None, None, None]
+        for term in filters.split():
+            op = next((op for op in self.fnd_filter_ops if op in term), None)
+            if op is None: return None
+            key, value = term.split(op, 1)
+            try:
+                value = int(value) if key == 'size' else int(float(value) * 10**9)
+            except ValueError:
+                return None
+            if key not in ('size', 'mtime'): return None
+            i = 0 if key == 'size' else 2
+            if op.startswith('>'): bounds[i] = value + (op == '>')
+            else: bounds[i+1] = value - (op == '<')
+        return bounds
+
+
+    # returns the length of the longest run of characters of a GLOB pattern outside of wildcards and bracket expressions,
+    # shorter runs than a trigram cannot be looked up in the name index and would scan all of its names
+    def longest_literal(self, pattern):
+        longest, run, i = 0, 0, 0
+        while i < len(pattern):
+            if pattern[i] in '*?[':
+                run = 0
+                if pattern[i] == '[':
+                    end = pattern.find(']', i + 2) # a ] right after [ (or [^) belongs to the expression
+                    i = len(pattern) if end < 0 else end
+            else:
+                run += 1
+                longest = max(longest, run)
+            i += 1
+        return longest
+
+
+    # yields the long listing entries of the entries below the current directory found in the name index,
+    # named by their paths relative to it, hashes only from the hash index as with lst -l
+    def iter_found_entries(self, pattern, bounds):
+        root = os.path.abspath(self.dir_path([]))
+        prefix = '/'.join(self.current_dir) + '/' if self.current_dir else ''
+        for path, is_dir, size, mtime_ns in self.name_index.find(root, prefix, pattern, *bounds):
+            file_hash = None
+            if not is_dir and self.hash_index is not None:
+                try:
+                    st = os.stat(os.path.join(root, path))
+                except OSError: # removed since it was found
+                    continue
+                size, mtime_ns = st.st_size, st.st_mtime_ns
+                file_hash = self.hash_index.get(st)
+            yield '\t'.join(('d' if is_dir else 'f', str(size), str(mtime_ns), file_hash.hex() if file_hash else '', path[len(prefix):]))
+
+
+    # sends change events of watched directories to the client in notifications, lines of event and path separated by a tab,
+    # paths are relative to the user root, directories end with / (called by the notifier thread)
+    def send_events(self, events):
+        lines = [event + '\t' + path for event, path in events]
+        for page, _ in self.iter_listing_pages(lines, 0, len(lines)):
+            notify_struct = {}
+            notify_struct['command'] = self.cmd_wch
+            notify_struct['request_hash'] = b''
+            notify_struct['result_1'] = self.res_event
+            notify_struct['result_2'] = '\n'.join(page)
+            msg_payload = self.build_command_res(notify_struct)
+
+            # DEBUG 
+            if self.DEBUG:
+                print('Outgoing payload (' + str(len(msg_payload)) + '):')
+                print(msg_payload[:512].decode('utf-8', errors='backslashreplace'))
+                print('------------------------------------------')
+            # DEBUG 
+
+            try:
+                with self.mtp.send_lock: # not held back by send coalescing
+                    self.mtp.send_msg(self.mtp.type_notify, msg_payload)
+                    self.mtp.flush()
+            except SiFT_MTP_Error as e:
+                raise SiFT_CMD_Error('Unable to send notification --> ' + e.err_msg)
+
+
+    # yields the long listing lines of the current directory: type (f or d), size, mtime (ns), hash if known and name,
+    # separated by tabs, everything comes from one os.scandir pass, hashes only from the hash index
+    def iter_long_entries(self):
+        path, fd = self.in_cwd()
+        with os.scandir(path if fd is None else fd) as entries:
+            for f in entries:
+                if f.name.startswith('.'): continue
+                if f.is_file(): entry_type = 'f'
+                elif f.is_dir(): entry_type = 'd'
+                else: continue
+                try:
+                    st = f.stat()
+                except OSError: # removed since it was listed
+                    continue
+                file_hash = None
+                if entry_type == 'f' and self.hash_index is not None:
+                    file_hash = self.hash_index.get(st)
+                yield '\t'.join((entry_type, str(st.st_size), str(st.st_mtime_ns), file_hash.hex() if file_hash else '', f.name))
+
+
+    # yields the manifest entries of the current directory, scanned by a worker thread while the pages are sent
+    # the thread runs ahead by at most size_mnf_queue batches and stops when the entries are not needed any more
+    def iter_manifest_entries(self, depth, pattern):
+
+        path, fd = self.in_cwd()
+        batches = queue.Queue(maxsize=self.size_mnf_queue)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def scan():
+            batch = []
+            try:
+                for line in self.scan_manifest(path, fd, '', depth, pattern):
+                    batch.append(line)
+                    if len(batch) >= self.size_mnf_batch:
+                        put(batch)
+                        batch = []
+                    if stop.is_set(): return
+                put(batch)
+                put(None)
+            except Exception as e: # raised in the thread sending the pages
+                put(e)
+
+        worker = threading.Thread(target=scan, daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None: return
+                if isinstance(item, Exception): raise item
+                yield from item
+        finally:
+            stop.set()
+            worker.join() # the directory fds are not used any more after this
+
+
+    # yields the manifest entries below a directory given by path or by name relative to dir_fd with os.scandir recursion
+    # symbolic links to directories are listed, but not followed
+    def scan_manifest(self, path, dir_fd, prefix, depth, pattern):
+        with os.scandir(path if dir_fd is None else dir_fd) as entries:
+            subdirs = []
+            for f in entries:
+                if f.name.startswith('.'): continue
+                if f.is_file(): entry_type = 'f'
+                elif f.is_dir(): entry_type = 'd'
+                else: continue
+                if entry_type == 'd' and depth != 1 and not f.is_symlink():
+                    subdirs.append(f.name)
+                if pattern and not fnmatch.fnmatchcase(f.name, pattern): continue
+                try:
+                    st = f.stat()
+                except OSError: # removed since it was listed
+                    continue
+                file_hash = None
+                if entry_type == 'f' and self.hash_index is not None:
+                    file_hash = self.hash_index.get(st)
+                yield '\t'.join((entry_type, str(st.st_size), str(st.st_mtime_ns), file_hash.hex() if file_hash else '', prefix + f.name))
+        for name in subdirs:
+            try:
+                sub_fd = None if dir_fd is None else self.open_dir(name, dir_fd)
+            except (FileNotFoundError, NotADirectoryError): # removed or replaced since it was listed
+                continue
+            try:
+                yield from self.scan_manifest(os.path.join(path, name), sub_fd, prefix + name + '/', depth - 1, pattern)
+            finally:
+                if sub_fd is not None: os.close(sub_fd)
+
+
+    # creates the directory with the given names below the current directory, with parents also the missing
+    # directories above it, an existing directory is not an error then
+    def make_dirs(self, names, parents=False):
+        for i in range(0 if parents else len(names) - 1, len(names)):
+            path, fd = self.in_cwd('/'.join(names[:i+1]))
+            try:
+                os.mkdir(path, dir_fd=fd)
+            except FileExistsError:
+                if not parents: raise
+                if not stat.S_ISDIR(os.stat(path, dir_fd=fd).st_mode): raise NotADirectoryError(path)
+
+
+    # walks a directory tree without following symbolic links and yields (dirpath, dirnames, filenames, dirfd)
+    # names are relative to dirfd, which is None if the platform has no dir_fd support, paths are needed then
+    # errors are raised, not skipped
+    def walk_tree(self, path, dir_fd, topdown=True):
+        def onerror(e): raise e
+        if dir_fd is None:
+            for dirpath, dirnames, filenames in os.walk(path, topdown, onerror):
+                yield dirpath, dirnames, filenames, None
+        else:
+            yield from os.fwalk(path, topdown, onerror, dir_fd=dir_fd)
+
+
+    # yields the paths of all entries below the current directory relative to it, paths of directories end with /
+    # a directory comes before its content, entries starting with . are left out with their content
+    def iter_tree_entries(self):
+        path, fd = self.in_cwd()
+        for dirpath, dirnames, filenames, _ in self.walk_tree(path, fd):
+            prefix = os.path.relpath(dirpath, path) + '/'
+            if prefix == './': prefix = ''
+            dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+            for name in dirnames:
+                yield prefix + name + '/'
+            for name in filenames:
+                if not name.startswith('.'): yield prefix + name
+
+
+    # removes a directory tree without following symbolic links and returns the number of removed entries
+    # the files of a directory are unlinked in chunks by a bounded pool of threads,
+    # progress(number of removed entries) is called every progress_interval seconds
+    def remove_tree(self, path, dir_fd, progress):
+
+        def unlink_chunk(names, dir_fd):
+            removed = []
+            try:
+                for name in names:
+                    if self.hash_index is not None: removed.append(os.stat(name, dir_fd=dir_fd, follow_symlinks=False))
+                    os.unlink(name, dir_fd=dir_fd)
+            finally:
+                self.forget_hashes(removed)
+            return len(names)
+
+        removed = 0
+        report_at = time.monotonic() + self.progress_interval
+        with ThreadPoolExecutor(max_workers=self.size_delete_workers) as pool:
+            for dirpath, dirnames, filenames, fd in self.walk_tree(path, dir_fd, topdown=False):
+                if fd is None:
+                    filenames = [os.path.join(dirpath, name) for name in filenames]
+                    dirnames = [os.path.join(dirpath, name) for name in dirnames]
+                chunks = [filenames[i:i+self.size_delete_chunk] for i in range(0, len(filenames), self.size_delete_chunk)]
+                for count in pool.map(unlink_chunk, chunks, [fd] * len(chunks)): # all chunks are done before fwalk closes fd
+                    removed += count
+                    if time.monotonic() >= report_at:
+                        progress(removed)
+                        report_at = time.monotonic() + self.progress_interval
+                for name in dirnames: # already emptied
+                    try:
+                        os.rmdir(name, dir_fd=fd)
+                    except NotADirectoryError: # symbolic link to a directory
+                        os.unlink(name, dir_fd=fd)
+                    removed += 1
+        os.rmdir(path, dir_fd=dir_fd)
+        return removed + 1
+
+
+    # sends an intermediate response with the progress of a long running command, it is not held back by send coalescing
+    def send_progress(self, cmd_res_struct, count):
+
+        progress_res_struct = {}
+        progress_res_struct['command'] = cmd_res_struct['command']
+        progress_res_struct['request_hash'] = cmd_res_struct['request_hash']
+        progress_res_struct['result_1'] = self.res_progress
+        progress_res_struct['result_2'] = count
+        msg_payload = self.build_command_res(progress_res_struct)
+
+        # DEBUG 
+        if self.DEBUG:
+            print('Outgoing payload (' + str(len(msg_payload)) + '):')
+            print(msg_payload[:512].decode('utf-8', errors='backslashreplace'))
+            print('------------------------------------------')
+        # DEBUG 
+
+        try:
+            self.mtp.send_msg(self.mtp.type_command_res, msg_payload)
+            self.mtp.flush()
+        except SiFT_MTP_Error as e:
+            raise SiFT_CMD_Error('Unable to send command response --> ' + e.err_msg)
+
+
+    # returns the names below the user root where an entry is copied or moved to: the destination itself,
+    # or the entry's name in it if the destination is a directory, raises FileExistsError if that already exists
+    def target_names(self, src_names, dst_names):
+        path, fd = self.in_root(dst_names)
+        try:
+            if stat.S_ISDIR(os.stat(path, dir_fd=fd).st_mode):
+                dst_names = dst_names + src_names[-1:]
+                path, fd = self.in_root(dst_names)
+            os.stat(path, dir_fd=fd, follow_symlinks=False)
+        except FileNotFoundError:
+            return dst_names
+        raise FileExistsError(path)
+
+
+    # copies the file with the given names below the user root, the hash of the file is kept in the hash index
+    def copy_entry(self, src_names, dst_names):
+
+        dst_names = self.target_names(src_names, dst_names)
+        locks = self.lock_paths([(src_names, False), (dst_names, True)])
+        try:
+            self.copy_locked(src_names, dst_names)
+        finally:
+            self.unlock_paths(locks)
+
+
+    # copies the file with the given names below the user root to the target, with the locks of both held
+    def copy_locked(self, src_names, dst_names):
+
+        src_path, src_fd = self.in_root(src_names)
+        dst_path, dst_fd = self.in_root(dst_names)
+        src_st = os.stat(src_path, dir_fd=src_fd)
+        if not stat.S_ISREG(src_st.st_mode):
+            raise IsADirectoryError(src_path)
+        file_hash = self.hash_index.get(src_st) if self.hash_index is not None else None
+        try:
+            self.copy_file(src_path, src_fd, dst_path, dst_fd)
+        finally: # a failed copy may leave a partial file
+            self.invalidate_listing(self.dir_path(dst_names[:-1]))
+            self.notify_change(self.dir_path(dst_names[:-1]), dst_names[-1])
+        if file_hash is not None and self.hash_index.make_key(os.stat(src_path, dir_fd=src_fd)) == self.hash_index.make_key(src_st):
+            self.hash_index.put(os.stat(dst_path, dir_fd=dst_fd), file_hash) # the source did not change during the copy
+
+
+    # moves the file or directory with the given names below the user root with a rename,
+    # a file is copied and removed if the rename fails because the destination is on another file system
+    def move_entry(self, src_names, dst_names):
+
+        dst_names = self.target_names(src_names, dst_names)
+        locks = self.lock_paths([(src_names, True), (dst_names, True)])
+        try:
+            self.target_names(src_names, dst_names) # the target may have been created while the locks were waited for
+            self.move_locked(src_names, dst_names)
+        finally:
+            self.unlock_paths(locks)
+
+
+    # moves the file or directory with the given names below the user root to the target, with the locks of both held
+    def move_locked(self, src_names, dst_names):
+
+        src_path, src_fd = self.in_root(src_names)
+        dst_path, dst_fd = self.in_root(dst_names)
+        try:
+            os.rename(src_path, dst_path, src_dir_fd=src_fd, dst_dir_fd=dst_fd) # keeps the inode, so the hash index stays valid
+        except OSError as e:
+            if e.errno != errno.EXDEV: raise
+            self.copy_locked(src_names, dst_names)
+            src_st = os.stat(src_path, dir_fd=src_fd, follow_symlinks=False)
+            os.unlink(src_path, dir_fd=src_fd)
+            self.forget_hashes([src_st])
+        finally:
+            for names in (src_names, src_names[:-1], dst_names, dst_names[:-1]):
+                self.invalidate_listing(self.dir_path(names))
+            for names in (src_names, dst_names):
+                self.notify_change(self.dir_path(names[:-1]), names[-1])
+
+        # the cwd is in the moved directory, its fd followed it
+        if self.current_dir[:len(src_names)] == src_names:
+            self.current_dir = dst_names + self.current_dir[len(src_names):]
+
+
+    # takes the locks of a request, a list of (names below the user root, exclusive), for this session
+    # returns the taken locks to be passed to unlock_paths(), raises TimeoutError if another session holds them for too long
+    def lock_paths(self, locks):
+        if self.path_locks is None: return []
+        locks = [(os.path.abspath(self.dir_path(names)), exclusive) for names, exclusive in locks]
+        if not self.path_locks.acquire(self, locks):
+            raise TimeoutError('Paths are locked by another session')
+        return locks
+
+
+    # releases the locks taken by lock_paths()
+    def unlock_paths(self, locks):
+        if locks: self.path_locks.release(self, locks)
+
+
+    # copies the content of a file to a new file, sharing the blocks (reflink) where the file system allows it,
+    # otherwise within the kernel with os.copy_file_range where available, otherwise in chunks
+    def copy_file(self, src_path, src_fd, dst_path, dst_fd):
+
+        with open(src_path, 'rb', buffering=0, opener=self.opener(src_fd)) as src, \
+             open(dst_path, 'xb', buffering=0, opener=self.opener(dst_fd)) as dst:
+            try:
+                if self.reflink_supported:
+                    try:
+                        fcntl.ioctl(dst.fileno(), self.ioctl_ficlone, src.fileno())
+                        return
+                    except OSError: # the file system does not share blocks
+                        pass
+                if self.copy_range_supported:
+                    try:
+                        while os.copy_file_range(src.fileno(), dst.fileno(), self.size_copy_chunk): pass
+                        return
+                    except OSError as e: # not supported between these files, the copy continues from where it stopped
+                        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP): raise
+                for chunk in iter(lambda: src.read(self.size_copy_chunk), b''):
+                    view = memoryview(chunk)
+                    while view: view = view[dst.write(view):]
+            except OSError: # no partial copy is left
+                os.unlink(dst_path, dir_fd=dst_fd)
+                raise
+
+
+    # drops the hashes of removed files from the hash index, given by their stat results (not following symbolic links)
+    # taken before the removal, a file with other hard links is still there
+    def forget_hashes(self, sts):
+        if self.hash_index is None:
+            return
+        self.hash_index.remove([st for st in sts if stat.S_ISREG(st.st_mode) and st.st_nlink <= 1])
+
+
+    # records the hash of a file in the hash index, if the file did not change since the given stat result
+    def index_hash(self, path, dir_fd, st, file_hash):
+        if self.hash_index is None:
+            return
+        try:
+            current = os.stat(path, dir_fd=dir_fd)
+        except OSError:
+            return
+        if self.hash_index.make_key(current) == self.hash_index.make_key(st):
+            self.hash_index.put(st, file_hash)
+
+
+    # reads a file and returns its hash and the number of bytes read
+    def hash_file(self, path, dir_fd):
+        hash_fn = SHA256.new()
+        file_size = 0
+        with open(path, 'rb', opener=self.opener(dir_fd)) as f:
+            for chunk in iter(lambda: f.read(self.size_hash_chunk), b''):
+                file_size += len(chunk)
+                hash_fn.update(chunk)
+        return hash_fn.digest(), file_size
+
+
+    # returns the long listing entry of the entry with the given names below the user root, named by the requested path
+    # the hash of a file is taken from the hash index, or computed and indexed if compute_hash
+    def stat_entry(self, name, names, compute_hash):
+        path, fd = self.in_root(names)
+        try:
+            st = os.stat(path, dir_fd=fd)
+        except OSError:
+            return '\t'.join(('-', '0', '0', '', name))
+        if stat.S_ISDIR(st.st_mode): entry_type = 'd'
+        elif stat.S_ISREG(st.st_mode): entry_type = 'f'
+        else: return '\t'.join(('-', '0', '0', '', name))
+        file_hash = None
+        if entry_type == 'f' and self.hash_index is not None:
+            file_hash = self.hash_index.get(st)
+        if entry_type == 'f' and file_hash is None and compute_hash:
+            try:
+                file_hash, file_size = self.hash_file(path, fd)
+            except OSError: # removed since the stat
+                return '\t'.join(('-', '0', '0', '', name))
+            if file_size == st.st_size: self.index_hash(path, fd, st, file_hash)
+            else: file_hash = None # changed while it was read
+        return '\t'.join((entry_type, str(st.st_size), str(st.st_mtime_ns), file_hash.hex() if file_hash else '', name))
+
+
+    # yields the pages of the listed entries from the given offset, with the cursor after each page ('' after the last one)
+    # a page holds at most page_size entries and size_lst_page bytes, only one page is kept in memory
+    def iter_listing_pages(self, entries, offset, page_size):
+
+        page, page_bytes, position = [], 0, 0
+        for name in entries:
+            position += 1
+            if position <= offset: continue
+            name_bytes = len(name.encode(self.coding)) + 1
+            if page and (len(page) >= page_size or page_bytes + name_bytes > self.size_lst_page):
+                yield page, str(position - 1)
+                page, page_bytes = [], 0
+            page.append(name)
+            page_bytes += name_bytes
+        yield page, ''
+
+
+    # ends the paged listing being sent
+    def close_listing(self):
+        if self.listing is not None:
+            self.listing.close()
+            self.listing = None
+
+
+    # sends the remaining pages of a paged listing (lst, mnf or fnd), each in its own command response
+    # a local error ends the listing with a failure response
+    def send_listing_pages(self, command, request_hash):
+
+        try:
+            last_page = False
+            while not last_page:
+                cmd_res_struct = {}
+                cmd_res_struct['command'] = command
+                cmd_res_struct['request_hash'] = request_hash
+                try:
+                    page, cursor = next(self.listing)
+                except OSError:
+                    cmd_res_struct['result_1'] = self.res_failure
+                    cmd_res_struct['result_2'] = 'Operation failed due to local error on server'
+                    last_page = True
+                else:
+                    cmd_res_struct['result_1'] = self.res_success
+                    cmd_res_struct['result_2'] = '\n'.join(page)
+                    cmd_res_struct['result_3'] = cursor
+                    last_page = not cursor
+                msg_payload = self.build_command_res(cmd_res_struct)
+
+                # DEBUG 
+                if self.DEBUG:
+                    print('Outgoing payload (' + str(len(msg_payload)) + '):')
+                    print(msg_payload[:512].decode('utf-8', errors='backslashreplace'))
+                    print('------------------------------------------')
+                # DEBUG 
+
+                try:
+                    self.mtp.send_msg(self.mtp.type_command_res, msg_payload)
+                except SiFT_MTP_Error as e:
+                    raise SiFT_CMD_Error('Unable to send command response --> ' + e.err_msg)
+        finally:
+            self.close_listing()
 
 
     # execute upload
@@ -508,36 +2088,39 @@ class SiFT_CMD:
         if not self.check_fdname(filename):
             raise SiFT_DNL_Error('File name is empty, starts with . or contains unsupported characters')
         else:
-            path = self.server_rootdir + self.user_rootdir + '/'.join(self.current_dir)
-            if not os.path.exists(path):
+            try:
+                path, fd = self.in_cwd(filename)
+            except OSError:
                 raise SiFT_UPL_Error('Operation failed due to local error on server')
-            else:    
-                if path[-1] == '/': filepath = path + filename
-                else: filepath = path + '/' + filename
-                # We could check here if a file with the given name already exists!
-                uplp = SiFT_UPL(self.mtp)
-                try:
-                    uplp.handle_upload_server(filepath)
-                except SiFT_UPL_Error as e:
-                    raise SiFT_UPL_Error(e.err_msg)
+            # We could check here if a file with the given name already exists!
+            uplp = SiFT_UPL(self.mtp)
+            uplp.set_binary(self.binary)
+            try:
+                file_hash = uplp.handle_upload_server(path, self.opener(fd))
+                self.index_hash(path, fd, os.stat(path, dir_fd=fd), file_hash)
+            except SiFT_UPL_Error as e:
+                raise SiFT_UPL_Error(e.err_msg)
+            finally: # a failed upload may still have created the file
+                self.invalidate_listing(self.cwd_path())
+                self.notify_change(self.cwd_path(), filename)
 
 
     # execute download
-    def exec_dnl(self, filename):
+    def exec_dnl(self, filename, trailer=False):
         if not self.check_fdname(filename):
             raise SiFT_DNL_Error('File name is empty, starts with . or contains unsupported characters')
         else:
-            path = self.server_rootdir + self.user_rootdir + '/'.join(self.current_dir)
-            if path[-1] == '/': filepath = path + filename
-            else: filepath = path + '/' + filename
-            if not os.path.exists(filepath):
+            try:
+                path, fd = self.in_cwd(filename)
+                st = os.stat(path, dir_fd=fd)
+            except OSError:
                 raise SiFT_DNL_Error('File or directory does not exist')
+            if not stat.S_ISREG(st.st_mode): # not a file
+                raise SiFT_DNL_Error('Only file download is supported')
             else:
-                if not os.path.isfile(filepath): # not a file
-                    raise SiFT_DNL_Error('Only file download is supported')
-                else:
-                    dnlp = SiFT_DNL(self.mtp)
-                    try:
-                        dnlp.handle_download_server(filepath)
-                    except SiFT_DNL_Error as e:
-                        raise SiFT_DNL_Error(e.err_msg)
+                dnlp = SiFT_DNL(self.mtp)
+                try:
+                    file_hash = dnlp.handle_download_server(path, trailer, self.opener(fd))
+                except SiFT_DNL_Error as e:
+                    raise SiFT_DNL_Error(e.err_msg)
+                if file_hash is not None: self.index_hash(path, fd, st, file_hash)
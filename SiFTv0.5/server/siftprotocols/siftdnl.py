@@ -17,6 +17,7 @@ class SiFT_DNL:
         self.coding = 'utf-8'
         self.ready = 'ready'
         self.cancel = 'cancel'
+        self.size_trailer = 32 # SHA256 at the end of the last fragment in trailer mode
         # --------- STATE ------------
         self.mtp = mtp
 
@@ -38,8 +39,9 @@ class SiFT_DNL:
             raise SiFT_DNL_Error('Unable to send download request (cancel) --> ' + e.err_msg)
 
 
-    # handles file download at the client (to be used by the client)
-    def handle_download_client(self, filepath):
+    # handles file download at the client and returns the hash of the file (to be used by the client)
+    # in trailer mode the last fragment ends with the hash of the file, which is verified here
+    def handle_download_client(self, filepath, trailer=False):
         
         # DEBUG 
         if self.DEBUG:
@@ -80,7 +82,13 @@ class SiFT_DNL:
                 if msg_type not in (self.mtp.type_dnload_res_0, self.mtp.type_dnload_res_1) :
                     raise SiFT_DNL_Error('Download response expected, but received something else')
 
-                if msg_type == self.mtp.type_dnload_res_1: download_complete = True
+                if msg_type == self.mtp.type_dnload_res_1:
+                    download_complete = True
+                    if trailer:
+                        if len(msg_payload) < self.size_trailer:
+                            raise SiFT_DNL_Error('Hash of the file is missing from the last fragment')
+                        trailer_hash = msg_payload[-self.size_trailer:]
+                        msg_payload = msg_payload[:-self.size_trailer]
 
                 file_size += len(msg_payload)
                 hash_fn.update(msg_payload)
@@ -88,11 +96,16 @@ class SiFT_DNL:
 
             file_hash = hash_fn.digest()
 
+        if trailer and file_hash != trailer_hash:
+            raise SiFT_DNL_Error('Hash of the downloaded file does not match the hash sent by the server')
+
         return file_hash
 
 
     # handles a file download on the server (to be used by the server)
-    def handle_download_server(self, filepath):
+    # in trailer mode the file is hashed while it is sent, the hash is appended to the last fragment and returned
+    # the file is opened with the given opener (see open()) if there is one
+    def handle_download_server(self, filepath, trailer=False, opener=None):
 
         # trying to receive a download request
         try:
@@ -112,7 +125,8 @@ class SiFT_DNL:
 
         if msg_payload.decode(self.coding) == self.ready:
 
-            with open(filepath, 'rb') as f:
+            hash_fn = SHA256.new()
+            with open(filepath, 'rb', opener=opener) as f:
 
                 byte_count = self.size_fragment
                 while byte_count == self.size_fragment:
@@ -123,6 +137,11 @@ class SiFT_DNL:
                     if byte_count == self.size_fragment: msg_type = self.mtp.type_dnload_res_0
                     else: msg_type = self.mtp.type_dnload_res_1
 
+                    if trailer:
+                        hash_fn.update(file_fragment)
+                        if msg_type == self.mtp.type_dnload_res_1:
+                            file_fragment += hash_fn.digest()
+
                     # DEBUG 
                     if self.DEBUG:
                         print('Outgoing payload (' + str(len(file_fragment)) + '):')
@@ -136,3 +155,5 @@ class SiFT_DNL:
                     except SiFT_MTP_Error as e:
                         raise SiFT_DNL_Error('Unable to download file fragment --> ' + e.err_msg)
 
+            if trailer: return hash_fn.digest()
+        return None
@@ -0,0 +1,133 @@
+#python3
+
+import threading, sqlite3
+from collections import OrderedDict
+
+# content hashes of files, keyed by what changes when a file is replaced or written:
+# device, inode, size and mtime (ns) from os.stat()
+class SiFT_HASH_INDEX:
+    def __init__(self, max_entries=100000):
+
+        # --------- CONSTANTS ------------
+        self.max_entries = max_entries # hashes kept before the least recently used one is dropped
+        # --------- STATE ------------
+        self.lock = threading.Lock()
+        self.hashes = OrderedDict() # (dev, ino, size, mtime_ns) --> SHA256 of the content, least recently used first
+        self.counters = {'hits': 0, 'misses': 0}
+
+
+    # index key of a file from its stat result
+    def make_key(self, st):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+    # returns the known hash of the file with the given stat result, or None
+    def get(self, st):
+        key = self.make_key(st)
+        with self.lock:
+            file_hash = self.hashes.get(key)
+            if file_hash is None:
+                self.counters['misses'] += 1
+                return None
+            self.hashes.move_to_end(key)
+            self.counters['hits'] += 1
+            return file_hash
+
+
+    # records the hash of the file with the given stat result
+    def put(self, st, file_hash):
+        key = self.make_key(st)
+        with self.lock:
+            self.hashes[key] = file_hash
+            self.hashes.move_to_end(key)
+            while len(self.hashes) > self.max_entries:
+                self.hashes.popitem(last=False)
+
+
+    # drops the hashes of removed files given by their stat results taken before the removal
+    def remove(self, sts):
+        with self.lock:
+            for st in sts:
+                self.hashes.pop(self.make_key(st), None)
+
+
+    # returns a snapshot of the index counters
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self.hashes)
+            return stats
+
+
+# hash index stored in a sqlite3 database, so the hashes survive server restarts
+# there is one row per file (device and inode), a changed size or mtime makes the row stale
+# rows of files removed by the server are deleted, the oldest rows are pruned once there are more than max_entries
+# (files removed outside of the server)
+class SiFT_HASH_INDEX_DB:
+    def __init__(self, dbfile, max_entries=1000000):
+
+        # --------- CONSTANTS ------------
+        self.max_entries = max_entries # rows kept before the least recently written ones are pruned
+        self.prune_interval = 1000 # puts between checks of the number of rows
+        # --------- STATE ------------
+        self.dbfile = dbfile
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'pruned': 0}
+        self.puts = 0 # puts since the last check of the number of rows
+        self.db = sqlite3.connect(dbfile, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL') # a lost hash is computed again, no sync on every put
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS hashes (dev INTEGER NOT NULL, ino INTEGER NOT NULL, '
+                            'size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, hash BLOB NOT NULL, PRIMARY KEY (dev, ino))')
+
+
+    # index key of a file from its stat result, as sqlite3 (signed 64 bit) integers
+    def make_key(self, st):
+        return tuple(v - 2**64 if v >= 2**63 else v for v in (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns))
+
+
+    # returns the known hash of the file with the given stat result, or None
+    def get(self, st):
+        dev, ino, size, mtime_ns = self.make_key(st)
+        with self.lock:
+            row = self.db.execute('SELECT hash FROM hashes WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?',
+                                  (dev, ino, size, mtime_ns)).fetchone()
+            self.counters['hits' if row else 'misses'] += 1
+        return bytes(row[0]) if row else None
+
+
+    # records the hash of the file with the given stat result, replacing the hash of an earlier version of the file
+    # (a replaced row gets a new rowid, so rowids order the rows by their last write)
+    def put(self, st, file_hash):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO hashes (dev, ino, size, mtime_ns, hash) VALUES (?, ?, ?, ?, ?)',
+                            self.make_key(st) + (file_hash,))
+            self.puts += 1
+            if self.puts >= self.prune_interval:
+                self.puts = 0
+                self.prune()
+
+
+    # deletes the least recently written rows above max_entries (lock must be held, in a transaction)
+    def prune(self):
+        excess = self.db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.db.execute('DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes ORDER BY rowid LIMIT ?)', (excess,))
+            self.counters['pruned'] += excess
+
+
+    # deletes the rows of removed files given by their stat results taken before the removal
+    def remove(self, sts):
+        if not sts: return
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM hashes WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?',
+                                [self.make_key(st) for st in sts])
+
+
+    # returns a snapshot of the index counters
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['entries'] = self.db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+            return stats
@@ -0,0 +1,57 @@
+#python3
+
+import time, threading
+from collections import OrderedDict
+
+class SiFT_LISTING_CACHE:
+    def __init__(self, max_listings=1024, max_dir_entries=10000):
+
+        # --------- CONSTANTS ------------
+        self.max_listings = max_listings # directories cached before the least recently used one is dropped
+        self.max_dir_entries = max_dir_entries # larger directories are not cached
+        self.racy_ns = 20000000 # a directory modified this recently may change again within the same mtime tick
+        # --------- STATE ------------
+        self.lock = threading.Lock()
+        self.listings = OrderedDict() # absolute path --> (directory mtime (ns), entries), least recently used first
+        self.counters = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0}
+
+
+    # returns the cached entries of a directory if its current mtime is the one they were cached with, None otherwise
+    def get(self, path, mtime_ns):
+        with self.lock:
+            listing = self.listings.get(path)
+            if listing is None or listing[0] != mtime_ns:
+                if listing is not None:
+                    del self.listings[path]
+                self.counters['misses'] += 1
+                return None
+            self.listings.move_to_end(path)
+            self.counters['hits'] += 1
+            return listing[1]
+
+
+    # caches the entries of a directory scanned after its mtime was read
+    def put(self, path, mtime_ns, entries):
+        if len(entries) > self.max_dir_entries or time.time_ns() - mtime_ns < self.racy_ns:
+            return
+        with self.lock:
+            self.listings[path] = (mtime_ns, tuple(entries))
+            self.listings.move_to_end(path)
+            while len(self.listings) > self.max_listings:
+                self.listings.popitem(last=False)
+                self.counters['evictions'] += 1
+
+
+    # drops the cached entries of a directory whose content was changed
+    def invalidate(self, path):
+        with self.lock:
+            if self.listings.pop(path, None) is not None:
+                self.counters['invalidations'] += 1
+
+
+    # returns a snapshot of the cache counters
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['listings'] = len(self.listings)
+            return stats
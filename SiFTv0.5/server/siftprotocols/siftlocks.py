@@ -0,0 +1,99 @@
+#python3
+
+import time, threading
+
+# reader/writer locks of paths, shared by the sessions of the server
+# a shared lock (download, listing) covers the path itself, an exclusive lock (upload, delete, move) covers everything below it:
+# it waits for all locks of other owners on the path and below it and for exclusive locks above it
+# locks of the same owner (a session) never wait for each other, the locks of a request are taken all at once
+# or none of them, so sessions cannot deadlock, a shared request also waits for exclusive requests of others waiting before it
+class SiFT_PATH_LOCKS:
+    def __init__(self, timeout=10.0):
+
+        # --------- CONSTANTS ------------
+        self.timeout = timeout # seconds a request waits for its locks before it fails
+        # --------- STATE ------------
+        self.cond = threading.Condition()
+        self.held = {} # path --> {owner: [shared count, exclusive count]}
+        self.waiting = {} # path --> {owner: number of exclusive requests waiting for it}
+        self.counters = {'shared': 0, 'exclusive': 0, 'contended': 0, 'timeouts': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+
+
+    # returns True if path is the other path or below it
+    def is_below(self, path, other):
+        return path == other or path.startswith(other.rstrip('/') + '/')
+
+
+    # returns True if a lock of the owner on a path has to wait for the locks and exclusive requests of other owners
+    # (with the lock held)
+    def conflicts(self, owner, path, exclusive):
+        for held_path, owners in self.held.items():
+            below = self.is_below(held_path, path) # the held lock is on the path or below it
+            above = self.is_below(path, held_path) # the held lock is on the path or above it
+            for held_owner, (shared_count, exclusive_count) in owners.items():
+                if held_owner is owner: continue
+                if (exclusive and below) or (exclusive_count and above): return True
+        if not exclusive:
+            for waiting_path, owners in self.waiting.items():
+                if self.is_below(path, waiting_path) and any(waiting_owner is not owner for waiting_owner in owners): return True
+        return False
+
+
+    # takes the locks (a list of (path, exclusive)) for an owner, waits at most timeout seconds (the default if None)
+    # returns False if the locks could not be taken in time
+    def acquire(self, owner, locks, timeout=None):
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        start = None
+        with self.cond:
+            try:
+                while any(self.conflicts(owner, path, exclusive) for path, exclusive in locks):
+                    if start is None:
+                        start = time.monotonic()
+                        self.counters['contended'] += 1
+                        self.set_waiting(owner, locks, 1)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.counters['timeouts'] += 1
+                        return False
+                    self.cond.wait(remaining)
+            finally:
+                if start is not None:
+                    self.set_waiting(owner, locks, -1)
+                    self.counters['wait_total'] += time.monotonic() - start
+                    self.counters['wait_max'] = max(self.counters['wait_max'], time.monotonic() - start)
+                    self.cond.notify_all() # shared requests may have waited for this one
+            for path, exclusive in locks:
+                counts = self.held.setdefault(path, {}).setdefault(owner, [0, 0])
+                counts[1 if exclusive else 0] += 1
+                self.counters['exclusive' if exclusive else 'shared'] += 1
+            return True
+
+
+    # adds step to the waiting exclusive requests of the owner on the exclusive paths of the locks (with the lock held)
+    def set_waiting(self, owner, locks, step):
+        for path, exclusive in locks:
+            if not exclusive: continue
+            owners = self.waiting.setdefault(path, {})
+            owners[owner] = owners.get(owner, 0) + step
+            if not owners[owner]: del owners[owner]
+            if not owners: del self.waiting[path]
+
+
+    # releases the locks (a list of (path, exclusive)) taken by acquire()
+    def release(self, owner, locks):
+        with self.cond:
+            for path, exclusive in locks:
+                owners = self.held[path]
+                counts = owners[owner]
+                counts[1 if exclusive else 0] -= 1
+                if counts == [0, 0]: del owners[owner]
+                if not owners: del self.held[path]
+            self.cond.notify_all()
+
+
+    # returns a snapshot of the counters and the number of locked paths
+    def get_stats(self):
+        with self.cond:
+            stats = dict(self.counters)
+            stats['paths'] = len(self.held)
+            return stats
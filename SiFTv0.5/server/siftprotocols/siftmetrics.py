@@ -0,0 +1,49 @@
+#python3
+
+import threading
+
+# latency histograms of named operations, shared by the sessions of the server
+# bucket i counts the latencies below 2**i microseconds (and not below 2**(i-1)), the last one also all longer ones
+class SiFT_METRICS:
+    def __init__(self, size_buckets=32):
+
+        # --------- CONSTANTS ------------
+        self.size_buckets = size_buckets
+        # --------- STATE ------------
+        self.lock = threading.Lock()
+        self.histograms = {} # name --> [count, total seconds, max seconds, bucket counts]
+
+
+    # records the latency of an operation
+    def record(self, name, seconds):
+        bucket = min(int(seconds * 1000000).bit_length(), self.size_buckets - 1)
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [0, 0.0, 0.0, [0] * self.size_buckets]
+            histogram[0] += 1
+            histogram[1] += seconds
+            histogram[2] = max(histogram[2], seconds)
+            histogram[3][bucket] += 1
+
+
+    # returns the latency (seconds) below which the given fraction of the recorded ones are, as the bound of their bucket
+    def get_percentile(self, buckets, count, max_seconds, fraction):
+        seen = 0
+        for i, bucket_count in enumerate(buckets):
+            seen += bucket_count
+            if seen >= fraction * count:
+                return min(2**i / 1000000, max_seconds)
+        return max_seconds
+
+
+    # returns a snapshot of the histograms: name --> count, mean, p50, p90, p99 and max (seconds) and the bucket counts
+    def get_stats(self):
+        with self.lock:
+            histograms = {name: (h[0], h[1], h[2], list(h[3])) for name, h in self.histograms.items()}
+        stats = {}
+        for name, (count, total, max_seconds, buckets) in histograms.items():
+            stats[name] = {'count': count, 'mean': total / count, 'max': max_seconds, 'buckets': buckets}
+            for key, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+                stats[name][key] = self.get_percentile(buckets, count, max_seconds, fraction)
+        return stats
@@ -1,6 +1,6 @@
 #python3
 
-import os
+import os, threading, time
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
 
@@ -25,10 +25,17 @@ class SiFT_MTP:
         self.size_msg_hdr_rnd = 6
         self.size_msg_hdr_rsv = 2
         self.size_msg_mac = 12
+        self.size_max_payload = 2**16 - 1 - self.size_msg_hdr - self.size_msg_mac  # largest payload of a command message
         self.size_nonce = 8  # sqn (2) + rnd (6)
         self.size_etk = 256  # RSA-2048 encrypted key
+        self.size_ticket_len = 2  # length of the resumption ticket trailer
+        self.size_epk = 32  # X25519 ephemeral public key
+        self.size_rcv_chunk = 65536  # bytes read ahead from the socket at once
+        self.size_snd_buffer = 65536  # coalesced messages are sent once this many bytes are queued
         
         self.type_login_req =    b'\x00\x00'
+        self.type_login_req_resume = b'\x00\x01'
+        self.type_login_req_x25519 = b'\x00\x02'
         self.type_login_res =    b'\x00\x10'
         self.type_command_req =  b'\x01\x00'
         self.type_command_res =  b'\x01\x10'
@@ -38,10 +45,15 @@ class SiFT_MTP:
         self.type_dnload_req =   b'\x03\x00'
         self.type_dnload_res_0 = b'\x03\x10'
         self.type_dnload_res_1 = b'\x03\x11'
-        self.msg_types = (self.type_login_req, self.type_login_res, 
+        self.type_notify =       b'\x04\x10'  # change events pushed by the server at any time
+        self.msg_types = (self.type_login_req, self.type_login_req_resume, self.type_login_req_x25519,
+                          self.type_login_res, 
                           self.type_command_req, self.type_command_res,
                           self.type_upload_req_0, self.type_upload_req_1, self.type_upload_res,
-                          self.type_dnload_req, self.type_dnload_res_0, self.type_dnload_res_1)
+                          self.type_dnload_req, self.type_dnload_res_0, self.type_dnload_res_1,
+                          self.type_notify)
+        self.login_req_types = (self.type_login_req, self.type_login_req_resume, self.type_login_req_x25519)
+        self.login_types = self.login_req_types + (self.type_login_res,)
         
         # Direction indicators for nonce construction (not used in 8-byte nonce)
         self.dir_client_to_server = b'\x00\x00'
@@ -49,6 +61,12 @@ class SiFT_MTP:
         
         # --------- STATE ------------
         self.peer_socket = peer_socket
+        self.rcv_buffer = bytearray()  # bytes read ahead from the socket
+        self.rcv_pos = 0  # bytes of rcv_buffer already taken
+        self.snd_buffer = bytearray()  # messages queued while sends are coalesced
+        self.coalesce_sends = False
+        self.send_lock = threading.RLock()  # notifications are sent by another thread than the responses
+        self.deadline = None  # time.monotonic() by which all receives must be done (None for no deadline)
         
         # Sequence numbers for replay protection
         self.sqn_send = 1
@@ -60,6 +78,9 @@ class SiFT_MTP:
         
         # Temporary key (used only for login_req message)
         self.temp_key = None
+
+        # Early data key (used only for a command request sent right behind the login request)
+        self.early_key = None
         
         # Flag to indicate if we're client or server (for direction field)
         self.is_client = None  # Will be set when keys are established
@@ -76,6 +97,12 @@ class SiFT_MTP:
         if self.is_client is None:
             self.is_client = is_client
 
+    # Set early data key for the one command request piggybacked on the login exchange
+    def set_early_key(self, early_key):
+        if len(early_key) != 32:
+            raise SiFT_MTP_Error('Early data key must be 32 bytes')
+        self.early_key = early_key
+
     # Set session encryption keys after login completes
     def set_session_keys(self, client_encrypt_key, server_encrypt_key, is_client):
         if len(client_encrypt_key) != 32 or len(server_encrypt_key) != 32:
@@ -166,19 +193,40 @@ class SiFT_MTP:
         
         return parsed_msg_hdr
 
+    # Set a deadline (time.monotonic()) for all following receives, a peer sending slowly cannot stretch it
+    # None removes the deadline and the socket timeout
+    def set_deadline(self, deadline):
+        self.deadline = deadline
+        if deadline is None:
+            self.peer_socket.settimeout(None)
+
+
     # Receive exact number of bytes from peer socket
+    # reads ahead, so messages the peer sent back-to-back are taken from the buffer without further recv calls
     def receive_bytes(self, n):
-        bytes_received = b''
-        bytes_count = 0
-        while bytes_count < n:
+        while len(self.rcv_buffer) - self.rcv_pos < n:
+            # nothing left to process without blocking, so queued messages must go out first
+            self.flush()
+            if self.deadline is not None:
+                remaining = self.deadline - time.monotonic()
+                if remaining <= 0:
+                    raise SiFT_MTP_Error('Deadline for receiving from peer socket exceeded')
+                self.peer_socket.settimeout(remaining)
             try:
-                chunk = self.peer_socket.recv(n-bytes_count)
+                chunk = self.peer_socket.recv(max(self.size_rcv_chunk, n))
             except:
                 raise SiFT_MTP_Error('Unable to receive via peer socket')
             if not chunk: 
                 raise SiFT_MTP_Error('Connection with peer is broken')
-            bytes_received += chunk
-            bytes_count += len(chunk)
+            if self.rcv_pos:
+                del self.rcv_buffer[:self.rcv_pos]
+                self.rcv_pos = 0
+            self.rcv_buffer += chunk
+        bytes_received = bytes(self.rcv_buffer[self.rcv_pos:self.rcv_pos+n])
+        self.rcv_pos += n
+        if self.rcv_pos == len(self.rcv_buffer):
+            self.rcv_buffer.clear()
+            self.rcv_pos = 0
         return bytes_received
 
 
@@ -243,11 +291,14 @@ class SiFT_MTP:
             raise SiFT_MTP_Error(f'Sequence number mismatch - expected {self.sqn_receive}, got {sqn_received}')
 
         # Determine which key to use (temp_key for login_req, session keys for everything else)
-        if parsed_msg_hdr['typ'] == self.type_login_req or parsed_msg_hdr['typ'] == self.type_login_res:
+        if parsed_msg_hdr['typ'] in self.login_types:
             # Login messages use temporary key
             if self.temp_key is None:
                 raise SiFT_MTP_Error('Temporary key not set for login message')
             key = self.temp_key
+        elif parsed_msg_hdr['typ'] == self.type_command_req and self.early_key is not None:
+            # Early command request uses the early data key, only once
+            key, self.early_key = self.early_key, None
         else:
             # Other messages use session keys
             key = self._get_encryption_key(sending=False)
@@ -268,16 +319,47 @@ class SiFT_MTP:
 
         return parsed_msg_hdr['typ'], msg_payload
 
-    # Send raw bytes via peer socket
+    # Send raw bytes via peer socket, or queue them until the next flush while sends are coalesced
     def send_bytes(self, bytes_to_send):
+        if self.coalesce_sends:
+            self.snd_buffer += bytes_to_send
+            if len(self.snd_buffer) >= self.size_snd_buffer:
+                self.flush()
+            return
         try:
             self.peer_socket.sendall(bytes_to_send)
         except:
             raise SiFT_MTP_Error('Unable to send via peer socket')
 
 
-    # Send and encrypt a message
+    # Send the queued messages at once
+    def flush(self):
+        with self.send_lock:
+            if not self.snd_buffer:
+                return
+            bytes_to_send = bytes(self.snd_buffer)
+            self.snd_buffer.clear()
+            try:
+                self.peer_socket.sendall(bytes_to_send)
+            except:
+                raise SiFT_MTP_Error('Unable to send via peer socket')
+
+
+    # Queue outgoing messages until the next receive has to wait for the peer (or the queue is full)
+    def set_send_coalescing(self, enabled):
+        self.coalesce_sends = enabled
+        if not enabled:
+            self.flush()
+
+
+    # Send and encrypt a message, messages of different threads are sent one after the other
     def send_msg(self, msg_type, msg_payload, etk=None):
+        with self.send_lock:
+            self._send_msg(msg_type, msg_payload, etk)
+
+
+    # Send and encrypt a message (with the send lock held)
+    def _send_msg(self, msg_type, msg_payload, etk=None):
         # Generate random field
         rnd = get_random_bytes(self.size_msg_hdr_rnd)
         
@@ -288,7 +370,7 @@ class SiFT_MTP:
         sqn = self.sqn_send.to_bytes(self.size_msg_hdr_sqn, byteorder='big')
         
         # Determine which key to use
-        if msg_type == self.type_login_req or msg_type == self.type_login_res:
+        if msg_type in self.login_types:
             # Login request and response use temporary key
             if self.temp_key is None:
                 raise SiFT_MTP_Error('Temporary key not set for login message')
@@ -296,6 +378,18 @@ class SiFT_MTP:
             if msg_type == self.type_login_req:
                 if etk is None or len(etk) != self.size_etk:
                     raise SiFT_MTP_Error('Encrypted temporary key required for login request')
+            if msg_type == self.type_login_req_resume:
+                # the resumption ticket is carried in place of the etk, followed by its length
+                if not etk or len(etk) >= 2**(8*self.size_ticket_len):
+                    raise SiFT_MTP_Error('Resumption ticket required for resumed login request')
+                etk = etk + len(etk).to_bytes(self.size_ticket_len, byteorder='big')
+            if msg_type == self.type_login_req_x25519:
+                # the client ephemeral public key is carried in place of the etk
+                if etk is None or len(etk) != self.size_epk:
+                    raise SiFT_MTP_Error('Ephemeral public key required for X25519 login request')
+        elif msg_type == self.type_command_req and self.early_key is not None:
+            # Early command request uses the early data key, only once
+            key, self.early_key = self.early_key, None
         else:
             # Other messages use session keys
             key = self._get_encryption_key(sending=True)
@@ -306,8 +400,8 @@ class SiFT_MTP:
         msg_hdr_without_len = self.msg_hdr_ver + msg_type
         
         # Calculate message length
-        if msg_type == self.type_login_req:
-            msg_len = self.size_msg_hdr + len(msg_payload) + self.size_msg_mac + self.size_etk
+        if msg_type in self.login_req_types:
+            msg_len = self.size_msg_hdr + len(msg_payload) + self.size_msg_mac + len(etk)
         else:
             msg_len = self.size_msg_hdr + len(msg_payload) + self.size_msg_mac
         
@@ -325,7 +419,7 @@ class SiFT_MTP:
             raise SiFT_MTP_Error('Encryption failed --> ' + str(e))
 
         # build complete message
-        if msg_type == self.type_login_req:
+        if msg_type in self.login_req_types:
             msg = msg_hdr + encrypted_payload + mac + etk
         else:
             msg = msg_hdr + encrypted_payload + mac
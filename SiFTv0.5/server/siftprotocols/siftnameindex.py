@@ -0,0 +1,169 @@
+#python3
+
+import os, stat, time, threading, sqlite3
+
+# index of the names of the entries below the user root directories, stored in a sqlite3 database so that it survives
+# server restarts, names are matched with GLOB patterns through a trigram full text index of the names
+# the tree of a user root is indexed on its first lookup and then kept up to date with the changes made by the sessions,
+# an index older than rebuild_interval seconds is built again on the next lookup (changes made outside of the server)
+class SiFT_NAME_INDEX:
+    def __init__(self, dbfile=':memory:', rebuild_interval=86400):
+
+        # --------- CONSTANTS ------------
+        self.rebuild_interval = rebuild_interval
+        self.size_batch = 256 # rows of a lookup fetched at once, all matching entries are returned batch by batch
+        # --------- STATE ------------
+        self.dbfile = dbfile
+        self.lock = threading.Lock()
+        self.counters = {'lookups': 0, 'builds': 0, 'updates': 0, 'stale': 0}
+        self.building = {} # root --> changes reported while its tree is scanned, applied after the scan
+        self.db = sqlite3.connect(dbfile, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL') # a lost change is corrected by the next build, no sync on every update
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS roots (root TEXT PRIMARY KEY, built_at REAL NOT NULL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, root TEXT NOT NULL, path TEXT NOT NULL, '
+                            'name TEXT NOT NULL, is_dir INTEGER NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, '
+                            'UNIQUE (root, path))')
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS names USING fts5(name, tokenize='trigram case_sensitive 1')")
+            self.db.execute('CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN '
+                            'INSERT INTO names (rowid, name) VALUES (new.id, new.name); END')
+            self.db.execute('CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN '
+                            'DELETE FROM names WHERE rowid = old.id; END')
+            self.built = dict(self.db.execute('SELECT root, built_at FROM roots')) # root --> time of the last build
+
+
+    # yields (path, name, is directory, size, mtime (ns)) of the entries below a directory, paths are relative to root
+    # and start with prefix, entries starting with . are left out with their content, symbolic links are not followed
+    def scan(self, root, prefix=''):
+        with os.scandir(os.path.join(root, prefix)) as entries:
+            subdirs = []
+            for f in entries:
+                if f.name.startswith('.'): continue
+                try:
+                    is_dir = f.is_dir()
+                    st = f.stat()
+                except OSError: # removed since it was listed
+                    continue
+                yield prefix + f.name, f.name, is_dir, 0 if is_dir else st.st_size, st.st_mtime_ns
+                if is_dir and not f.is_symlink():
+                    subdirs.append(prefix + f.name + '/')
+        for subdir in subdirs:
+            try:
+                yield from self.scan(root, subdir)
+            except (FileNotFoundError, NotADirectoryError): # removed or replaced since it was listed
+                continue
+
+
+    # indexes the tree of a user root, replacing its earlier index, changes reported during the scan are applied after it
+    def build(self, root):
+        with self.lock:
+            self.building[root] = []
+        try:
+            rows = [(root,) + row for row in self.scan(root)]
+        except OSError:
+            with self.lock:
+                self.building.pop(root, None)
+            raise
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM entries WHERE root = ?', (root,))
+                self.db.executemany('INSERT INTO entries (root, path, name, is_dir, size, mtime_ns) VALUES (?, ?, ?, ?, ?, ?)', rows)
+                self.built[root] = time.time()
+                self.db.execute('INSERT OR REPLACE INTO roots (root, built_at) VALUES (?, ?)', (root, self.built[root]))
+            self.counters['builds'] += 1
+            changes = self.building.pop(root)
+        for dir_path, name in changes:
+            self.update(root, dir_path, name)
+
+
+    # updates the entry with the given name in a directory (path relative to root, '' for root itself) after a change,
+    # a removed entry is dropped with everything below it, a new directory is indexed with its content (e.g., moved)
+    def update(self, root, dir_path, name):
+        with self.lock:
+            if root in self.building:
+                self.building[root].append((dir_path, name))
+                return
+            if root not in self.built: # indexed on its first lookup
+                return
+        path = dir_path + '/' + name if dir_path else name
+        full_path = os.path.join(root, path)
+        try:
+            st = os.stat(full_path)
+        except OSError: # removed
+            st = None
+        is_dir = st is not None and stat.S_ISDIR(st.st_mode)
+        with self.lock:
+            known = self.db.execute('SELECT is_dir FROM entries WHERE root = ? AND path = ?', (root, path)).fetchone()
+        rows = []
+        if is_dir and not (known and known[0]) and not os.path.islink(full_path): # a directory new to the index
+            try:
+                rows = [(root,) + row for row in self.scan(root, path + '/')]
+            except OSError:
+                pass
+        with self.lock, self.db:
+            self.counters['updates'] += 1
+            if st is None or (known and bool(known[0]) != is_dir): # removed or replaced by an entry of the other kind
+                self.db.execute('DELETE FROM entries WHERE root = ? AND (path = ? OR (path >= ? AND path < ?))',
+                                (root, path, path + '/', path + '0')) # '0' follows '/'
+            if st is not None:
+                self.db.execute('INSERT INTO entries (root, path, name, is_dir, size, mtime_ns) VALUES (?, ?, ?, ?, ?, ?) '
+                                'ON CONFLICT (root, path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns',
+                                (root, path, name, is_dir, 0 if is_dir else st.st_size, st.st_mtime_ns))
+                self.db.executemany('INSERT OR IGNORE INTO entries (root, path, name, is_dir, size, mtime_ns) VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+
+    # yields (path, is directory, size, mtime (ns)) of the entries below prefix (a directory path relative to root ending with /,
+    # '' for all) whose names match the GLOB pattern and whose size and mtime are within the given bounds (None for no bound)
+    # the index of root is built first if there is none yet or it is too old, entries that no longer exist are dropped
+    def find(self, root, prefix, pattern, min_size=None, max_size=None, min_mtime_ns=None, max_mtime_ns=None):
+
+        with self.lock:
+            built_at = self.built.get(root)
+        if built_at is None or time.time() - built_at > self.rebuild_interval:
+            self.build(root)
+
+        query = ('SELECT entries.path, entries.is_dir, entries.size, entries.mtime_ns FROM names '
+                 'JOIN entries ON entries.id = names.rowid WHERE names.name GLOB ? AND entries.root = ?')
+        args = [pattern, root]
+        if prefix:
+            query += ' AND entries.path >= ? AND entries.path < ?'
+            args += [prefix, prefix[:-1] + '0']
+        for condition, value in (('entries.size >= ?', min_size), ('entries.size <= ?', max_size),
+                                 ('entries.mtime_ns >= ?', min_mtime_ns), ('entries.mtime_ns <= ?', max_mtime_ns)):
+            if value is not None:
+                query += ' AND ' + condition
+                args.append(value)
+        query += ' ORDER BY entries.path'
+        with self.lock:
+            cursor = self.db.execute(query, args)
+            self.counters['lookups'] += 1
+
+        # the rows are fetched batch by batch while they are consumed, other lookups and updates run in between
+        try:
+            while True:
+                with self.lock:
+                    rows = cursor.fetchmany(self.size_batch)
+                if not rows:
+                    return
+                stale = []
+                for path, is_dir, size, mtime_ns in rows:
+                    if not os.path.lexists(os.path.join(root, path)): # removed outside of the server
+                        stale.append((root, path, path + '/', path + '0'))
+                        continue
+                    yield path, bool(is_dir), size, mtime_ns
+                if stale:
+                    with self.lock, self.db:
+                        self.db.executemany('DELETE FROM entries WHERE root = ? AND (path = ? OR (path >= ? AND path < ?))', stale)
+                        self.counters['stale'] += len(stale)
+        finally:
+            with self.lock:
+                cursor.close()
+
+
+    # returns a snapshot of the index counters
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['entries'] = self.db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+            return stats
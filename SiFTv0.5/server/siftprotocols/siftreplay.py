@@ -0,0 +1,41 @@
+#python3
+
+import time, threading
+from collections import OrderedDict
+
+class SiFT_REPLAY:
+    def __init__(self, max_entries=100000):
+
+        # --------- CONSTANTS ------------
+        self.max_entries = max_entries # request hashes remembered before the oldest ones are dropped
+        # --------- STATE ------------
+        self.lock = threading.Lock()
+        self.seen = OrderedDict() # request hash --> expiry time (ns), in order of arrival
+        self.counters = {'accepted': 0, 'replayed': 0}
+
+
+    # drops the expired entries from the oldest ones, arrival order is close to expiry order (lock must be held)
+    def purge(self, now):
+        while self.seen:
+            request_hash, expires = next(iter(self.seen.items()))
+            if expires > now and len(self.seen) < self.max_entries:
+                break
+            del self.seen[request_hash]
+
+
+    # records a request hash until the given expiry time (ns), returns False if it was already seen
+    def check_and_add(self, request_hash, expires):
+        with self.lock:
+            self.purge(time.time_ns())
+            if request_hash in self.seen:
+                self.counters['replayed'] += 1
+                return False
+            self.seen[request_hash] = expires
+            self.counters['accepted'] += 1
+            return True
+
+
+    # returns a snapshot of the replay counters
+    def get_stats(self):
+        with self.lock:
+            return dict(self.counters)
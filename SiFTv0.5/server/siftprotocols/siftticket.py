@@ -0,0 +1,140 @@
+#python3
+
+import time, threading
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Random import get_random_bytes
+
+class SiFT_TICKET_Error(Exception):
+
+    def __init__(self, err_msg):
+        self.err_msg = err_msg
+
+class SiFT_TICKET:
+    def __init__(self, lifetime=3600, rotation_interval=900):
+
+        self.DEBUG = False  # Set to True only for development debugging
+        # --------- CONSTANTS ------------
+        self.coding = 'utf-8'
+        self.size_key = 32 # AES-256 ticket key
+        self.size_key_id = 4
+        self.size_nonce = 12
+        self.size_mac = 16
+        self.size_timestamp = 8 # issue time in nanoseconds
+        self.size_binding = 16 # digest of the credentials and the ticket epoch of the user at issue time
+        self.size_secret = 32 # resumption secret carried in the ticket
+        self.lifetime = lifetime # seconds a ticket stays valid after issue
+        self.rotation_interval = rotation_interval # seconds between ticket key rotations
+        # --------- STATE ------------
+        self.lock = threading.Lock()
+        self.keys = {} # key_id --> (key, created)
+        self.current_key_id = None
+        self.rotate_keys()
+
+
+    # generates a new current ticket key and drops keys that can no longer open a valid ticket
+    def rotate_keys(self):
+        now = int(time.time())
+        with self.lock:
+            key_id = get_random_bytes(self.size_key_id)
+            while key_id in self.keys:
+                key_id = get_random_bytes(self.size_key_id)
+            self.keys[key_id] = (get_random_bytes(self.size_key), now)
+            self.current_key_id = key_id
+            # a key is still needed while tickets issued under it may be unexpired
+            expired = [k for k, (_, created) in self.keys.items()
+                       if k != key_id and created + self.rotation_interval + self.lifetime < now]
+            for k in expired:
+                del self.keys[k]
+        # DEBUG
+        if self.DEBUG:
+            print('Ticket key rotated, ' + str(len(self.keys)) + ' key(s) active')
+        # DEBUG
+
+
+    # returns the digest of the credentials and the ticket epoch of a user a ticket is bound to, a ticket issued before
+    # the password of the user changed or its tickets were revoked (the epoch was bumped) no longer matches it
+    # (the user store is changed by other processes, e.g. useradmin.py)
+    def user_binding(self, usr_struct):
+        hash_fn = SHA256.new()
+        hash_fn.update(usr_struct['salt'])
+        hash_fn.update(usr_struct['pwdhash'])
+        hash_fn.update(usr_struct.get('epoch', 0).to_bytes(8, byteorder='big'))
+        return hash_fn.digest()[:self.size_binding]
+
+
+    # issues an encrypted and authenticated ticket for the user carrying the resumption secret
+    # and the binding of the user's credentials made by user_binding()
+    def issue_ticket(self, username, secret, binding):
+        if len(secret) != self.size_secret:
+            raise SiFT_TICKET_Error('Resumption secret has incorrect size')
+        if len(binding) != self.size_binding:
+            raise SiFT_TICKET_Error('Credential binding has incorrect size')
+
+        now = int(time.time())
+        with self.lock:
+            key, created = self.keys[self.current_key_id]
+            rotate = created + self.rotation_interval <= now
+        if rotate:
+            self.rotate_keys()
+
+        with self.lock:
+            key_id = self.current_key_id
+            key, _ = self.keys[key_id]
+
+        ticket_plain = time.time_ns().to_bytes(self.size_timestamp, byteorder='big')
+        ticket_plain += binding
+        ticket_plain += secret
+        ticket_plain += username.encode(self.coding)
+
+        nonce = get_random_bytes(self.size_nonce)
+        cipher = AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=self.size_mac)
+        cipher.update(key_id)
+        encrypted_ticket, mac = cipher.encrypt_and_digest(ticket_plain)
+
+        return key_id + nonce + encrypted_ticket + mac
+
+
+    # verifies and opens a ticket, returns the username, resumption secret and credential binding in it
+    def open_ticket(self, ticket):
+        min_len = self.size_key_id + self.size_nonce + self.size_timestamp + self.size_binding + self.size_secret + self.size_mac
+        if len(ticket) <= min_len:
+            raise SiFT_TICKET_Error('Ticket has incorrect size')
+
+        i = 0
+        key_id = ticket[i:i+self.size_key_id]
+        i += self.size_key_id
+        nonce = ticket[i:i+self.size_nonce]
+        i += self.size_nonce
+        encrypted_ticket = ticket[i:-self.size_mac]
+        mac = ticket[-self.size_mac:]
+
+        with self.lock:
+            if key_id not in self.keys:
+                raise SiFT_TICKET_Error('Ticket key is unknown or has been rotated out')
+            key, _ = self.keys[key_id]
+
+        cipher = AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=self.size_mac)
+        cipher.update(key_id)
+        try:
+            ticket_plain = cipher.decrypt_and_verify(encrypted_ticket, mac)
+        except ValueError:
+            raise SiFT_TICKET_Error('Ticket authentication failed')
+
+        i = 0
+        issued = int.from_bytes(ticket_plain[i:i+self.size_timestamp], byteorder='big')
+        i += self.size_timestamp
+        binding = ticket_plain[i:i+self.size_binding]
+        i += self.size_binding
+        secret = ticket_plain[i:i+self.size_secret]
+        i += self.size_secret
+        try:
+            username = ticket_plain[i:].decode(self.coding)
+        except UnicodeDecodeError:
+            raise SiFT_TICKET_Error('Ticket contains malformed username')
+
+        now = int(time.time())
+        if issued // 10**9 + self.lifetime < now:
+            raise SiFT_TICKET_Error('Ticket has expired')
+
+        return username, secret, binding
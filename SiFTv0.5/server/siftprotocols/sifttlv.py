@@ -0,0 +1,125 @@
+#python3
+
+class SiFT_TLV_Error(Exception):
+
+    def __init__(self, err_msg):
+        self.err_msg = err_msg
+
+# compact binary encoding of payload dictionaries, used in place of the delimited text encoding
+# payload: magic byte | field* , field: tag (1 byte) | length (varint) | value
+# a list value is a sequence of length (varint) | bytes items
+# the tag holds the value type in its upper 2 bits and the field number (index in fields + 1) in the lower 6 bits
+class SiFT_TLV:
+    def __init__(self, fields):
+
+        # --------- CONSTANTS ------------
+        self.magic = b'\x00' # first byte of a binary payload, text payloads never start with it
+        self.coding = 'utf-8'
+        self.type_bytes = 0x00
+        self.type_str = 0x40
+        self.type_uint = 0x80
+        self.type_list = 0xc0
+        self.mask_type = 0xc0
+        self.mask_field = 0x3f
+        # --------- STATE ------------
+        if len(fields) > self.mask_field:
+            raise SiFT_TLV_Error('Too many fields for the tag format')
+        self.fields = tuple(fields)
+        self.field_nums = {name: i + 1 for i, name in enumerate(self.fields)}
+
+
+    # tells if a payload uses the binary encoding
+    def is_binary(self, payload):
+        return payload[:1] == self.magic
+
+
+    # encodes a length as a varint (7 bits per byte, least significant first)
+    def encode_length(self, length):
+        out = bytearray()
+        while length >= 0x80:
+            out.append((length & 0x7f) | 0x80)
+            length >>= 7
+        out.append(length)
+        return out
+
+
+    # decodes a varint length at pos, returns the length and the position after it
+    def decode_length(self, view, pos, end):
+        length, shift = 0, 0
+        while True:
+            if pos >= end or shift > 21:
+                raise SiFT_TLV_Error('Truncated field length')
+            b = view[pos]
+            pos += 1
+            length |= (b & 0x7f) << shift
+            shift += 7
+            if not b & 0x80:
+                return length, pos
+
+
+    # encodes the fields of a dictionary that are set (values None and False are left out)
+    def encode(self, struct):
+        out = [self.magic]
+        for name, value in struct.items():
+            if value is None or value is False:
+                continue
+            num = self.field_nums.get(name)
+            if num is None:
+                raise SiFT_TLV_Error('Unknown field ' + name)
+            if type(value) is str:
+                num |= self.type_str
+                value = value.encode(self.coding)
+            elif isinstance(value, int):
+                if value < 0:
+                    raise SiFT_TLV_Error('Negative value of field ' + name)
+                num |= self.type_uint
+                value = value.to_bytes((value.bit_length() + 7) // 8, byteorder='big')
+            elif isinstance(value, (list, tuple)):
+                num |= self.type_list
+                value = b''.join(self.encode_length(len(item)) + item for item in value)
+            length = len(value)
+            if length < 0x80: # single byte length, the common case
+                out.append(bytes((num, length)))
+            else:
+                out.append(bytes((num,)) + self.encode_length(length))
+            out.append(value)
+        return b''.join(out)
+
+
+    # decodes a binary payload into a dictionary, values are sliced from a memoryview and copied only once
+    def decode(self, payload):
+        view = memoryview(payload)
+        if view[:1] != self.magic:
+            raise SiFT_TLV_Error('Payload is not binary encoded')
+        fields, coding = self.fields, self.coding
+        struct = {}
+        pos, end = 1, len(view)
+        while pos < end:
+            if pos + 2 > end:
+                raise SiFT_TLV_Error('Truncated field')
+            tag, length = view[pos], view[pos+1]
+            if length & 0x80: # multi-byte length
+                length, pos = self.decode_length(view, pos + 1, end)
+            else:
+                pos += 2
+            num = tag & self.mask_field
+            if num == 0 or num > len(fields) or pos + length > end:
+                raise SiFT_TLV_Error('Unknown field number or truncated field value')
+            typ = tag & self.mask_type
+            if typ == self.type_str:
+                struct[fields[num - 1]] = str(view[pos:pos+length], coding)
+            elif typ == self.type_uint:
+                struct[fields[num - 1]] = int.from_bytes(view[pos:pos+length], byteorder='big')
+            elif typ == self.type_bytes:
+                struct[fields[num - 1]] = view[pos:pos+length].tobytes()
+            else: # list
+                items, item_pos, item_end = [], pos, pos + length
+                while item_pos < item_end:
+                    item_len, item_pos = self.decode_length(view, item_pos, item_end)
+                    if item_pos + item_len > item_end:
+                        raise SiFT_TLV_Error('Truncated list item')
+                    items.append(view[item_pos:item_pos+item_len].tobytes())
+                    item_pos += item_len
+                struct[fields[num - 1]] = items
+            pos += length
+        return struct
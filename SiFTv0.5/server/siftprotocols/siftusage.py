@@ -0,0 +1,185 @@
+#python3
+
+import os, stat, threading
+
+# recursive byte and file counts of the directories below the user root directories, kept in memory
+# the tree of a user root is scanned on its first query and then kept up to date with the changes made by the sessions,
+# each change adds its difference to the directories above it, so a query only reads the counts of one directory
+# a reconciliation thread scans the trees again every rescan_interval seconds (changes made outside of the server)
+class SiFT_USAGE:
+    def __init__(self, rescan_interval=300.0):
+
+        # --------- CONSTANTS ------------
+        self.rescan_interval = rescan_interval # seconds between reconciliation scans of the trees (0 disables them)
+        # --------- STATE ------------
+        self.lock = threading.Lock()
+        self.trees = {} # root --> {directory path relative to root ('' for root): directory node}
+        self.building = {} # root --> changes reported while its tree is scanned, applied after the scan
+        self.counters = {'queries': 0, 'builds': 0, 'updates': 0, 'corrections': 0}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+
+    # starts the reconciliation thread
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    # stops the reconciliation thread
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+    # scans the known trees again every rescan_interval seconds
+    def run(self):
+        if not self.rescan_interval: return
+        while not self.stop_event.wait(self.rescan_interval):
+            with self.lock:
+                roots = list(self.trees)
+            for root in roots:
+                try:
+                    self.build(root)
+                except OSError: # the user root is gone, it is scanned again on its next query
+                    with self.lock:
+                        self.trees.pop(root, None)
+
+
+    # returns the directory nodes of the tree below a directory (path relative to root, '' for root itself),
+    # a node holds the sizes of its files by name, the names of its subdirectories and the counts of everything below it
+    # entries starting with . and symbolic links are left out
+    def scan(self, root, path):
+        nodes = {}
+        node = {'files': {}, 'dirs': set(), 'bytes': 0, 'count': 0}
+        subdirs = []
+        with os.scandir(os.path.join(root, path)) as entries:
+            for f in entries:
+                if f.name.startswith('.'): continue
+                try:
+                    st = f.stat(follow_symlinks=False)
+                except OSError: # removed since it was listed
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    subdirs.append(f.name)
+                elif stat.S_ISREG(st.st_mode):
+                    node['files'][f.name] = st.st_size
+                    node['bytes'] += st.st_size
+                    node['count'] += 1
+        for name in subdirs:
+            subdir_path = path + '/' + name if path else name
+            try:
+                nodes.update(self.scan(root, subdir_path))
+            except (FileNotFoundError, NotADirectoryError): # removed or replaced since it was listed
+                continue
+            node['dirs'].add(name)
+            node['bytes'] += nodes[subdir_path]['bytes']
+            node['count'] += nodes[subdir_path]['count']
+        nodes[path] = node
+        return nodes
+
+
+    # scans the tree of a user root, replacing its earlier counts, changes reported during the scan are applied after it
+    def build(self, root):
+        with self.lock:
+            self.building[root] = []
+        try:
+            nodes = self.scan(root, '')
+        except OSError:
+            with self.lock:
+                self.building.pop(root, None)
+            raise
+        with self.lock:
+            old = self.trees.get(root)
+            if old is not None and (old['']['bytes'], old['']['count']) != (nodes['']['bytes'], nodes['']['count']):
+                self.counters['corrections'] += 1 # changed outside of the server
+            self.trees[root] = nodes
+            self.counters['builds'] += 1
+            changes = self.building.pop(root)
+        for dir_path, name in changes:
+            self.update(root, dir_path, name)
+
+
+    # updates the counts after a change of the entry with the given name in a directory (path relative to root, '' for root),
+    # a directory is scanned again with everything below it (e.g., created, moved or partly removed)
+    def update(self, root, dir_path, name):
+        with self.lock:
+            if root in self.building:
+                self.building[root].append((dir_path, name))
+                return
+            if root not in self.trees: # scanned on its first query
+                return
+        if name.startswith('.'): return
+        path = dir_path + '/' + name if dir_path else name
+        try:
+            st = os.lstat(os.path.join(root, path))
+        except OSError: # removed
+            st = None
+        nodes = {}
+        if st is not None and stat.S_ISDIR(st.st_mode):
+            try:
+                nodes = self.scan(root, path)
+            except OSError: # removed since the stat
+                st = None
+        with self.lock:
+            tree = self.trees.get(root)
+            parent = tree.get(dir_path) if tree is not None else None
+            if parent is None: # not known, the next reconciliation finds it
+                return
+            self.counters['updates'] += 1
+            # counts of the entry before and after the change
+            old_bytes, old_count = 0, 0
+            if name in parent['files']:
+                old_bytes, old_count = parent['files'].pop(name), 1
+            elif name in parent['dirs']:
+                parent['dirs'].discard(name)
+                old_bytes, old_count = tree[path]['bytes'], tree[path]['count']
+                self.drop(tree, path)
+            new_bytes, new_count = 0, 0
+            if nodes:
+                parent['dirs'].add(name)
+                tree.update(nodes)
+                new_bytes, new_count = nodes[path]['bytes'], nodes[path]['count']
+            elif st is not None and stat.S_ISREG(st.st_mode):
+                parent['files'][name] = st.st_size
+                new_bytes, new_count = st.st_size, 1
+            # the difference goes to the directory and all directories above it
+            names = dir_path.split('/') if dir_path else []
+            for i in range(len(names), -1, -1):
+                node = tree['/'.join(names[:i])]
+                node['bytes'] += new_bytes - old_bytes
+                node['count'] += new_count - old_count
+
+
+    # removes the node of a directory and the nodes below it from a tree (with the lock held)
+    def drop(self, tree, path):
+        for name in tree.pop(path)['dirs']:
+            self.drop(tree, path + '/' + name if path else name)
+
+
+    # returns (bytes, files, list of (name, bytes, files) of the subdirectories) below a directory (path relative to root,
+    # '' for root itself), None if it does not exist, the tree of root is scanned first if it was not yet
+    def usage(self, root, path):
+        with self.lock:
+            known = root in self.trees
+        if not known:
+            self.build(root)
+        with self.lock:
+            self.counters['queries'] += 1
+            node = self.trees.get(root, {}).get(path)
+            if node is None:
+                return None
+            subdirs = []
+            for name in sorted(node['dirs']):
+                subdir = self.trees[root][path + '/' + name if path else name]
+                subdirs.append((name, subdir['bytes'], subdir['count']))
+            return node['bytes'], node['count'], subdirs
+
+
+    # returns a snapshot of the counters
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['directories'] = sum(len(tree) for tree in self.trees.values())
+            return stats
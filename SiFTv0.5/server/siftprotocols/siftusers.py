@@ -0,0 +1,205 @@
+#python3
+
+import os, threading, sqlite3
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import PBKDF2
+from Crypto.Random import get_random_bytes
+
+class SiFT_USERS_Error(Exception):
+
+    def __init__(self, err_msg):
+        self.err_msg = err_msg
+
+
+# computes the password hash and builds a user record (module level, so it can run in worker processes)
+def make_user_record(password, icount, rootdir, size_salt=16, size_pwdhash=32):
+    salt = get_random_bytes(size_salt)
+    usr_struct = {}
+    usr_struct['pwdhash'] = PBKDF2(password, salt, size_pwdhash, count=icount, hmac_hash_module=SHA256)
+    usr_struct['icount'] = icount
+    usr_struct['salt'] = salt
+    usr_struct['rootdir'] = rootdir
+    usr_struct['epoch'] = 0 # bumped to revoke the resumption tickets of the user
+    return usr_struct
+
+
+# user store backed by the colon-delimited users file, parsed once and reloaded when the file changes
+# the ticket epoch is an optional last field, written only once it is not 0
+class SiFT_USERS_FILE:
+    def __init__(self, usersfile):
+
+        # --------- CONSTANTS ------------
+        self.coding = 'utf-8'
+        self.rec_delimiter = '\n'
+        self.fld_delimiter = ':'
+        # --------- STATE ------------
+        self.usersfile = usersfile
+        self.lock = threading.Lock()
+        self.users = {}
+        self.mtime_ns = None
+
+
+    # parses the users file into a dictionary
+    def parse_users(self, allrecords):
+        users = {}
+        for r in allrecords.split(self.rec_delimiter):
+            if not r.strip(): # skip empty lines
+                continue
+            fields = r.split(self.fld_delimiter)
+            username = fields[0]
+            usr_struct = {}
+            usr_struct['pwdhash'] = bytes.fromhex(fields[1])
+            usr_struct['icount'] = int(fields[2])
+            usr_struct['salt'] = bytes.fromhex(fields[3])
+            usr_struct['rootdir'] = fields[4]
+            usr_struct['epoch'] = int(fields[5]) if len(fields) > 5 else 0
+            users[username] = usr_struct
+        return users
+
+
+    # reloads the users file if it changed since it was last parsed
+    def refresh(self):
+        try:
+            mtime_ns = os.stat(self.usersfile).st_mtime_ns
+        except FileNotFoundError:
+            mtime_ns = None
+        with self.lock:
+            if mtime_ns == self.mtime_ns:
+                return
+            if mtime_ns is None:
+                self.users = {}
+            else:
+                with open(self.usersfile, 'rb') as f:
+                    self.users = self.parse_users(f.read().decode(self.coding))
+            self.mtime_ns = mtime_ns
+
+
+    # writes all records to the users file atomically (lock must be held)
+    def write_users(self, users):
+        records = []
+        for username, usr_struct in users.items():
+            fields = [username, usr_struct['pwdhash'].hex(), str(usr_struct['icount']), usr_struct['salt'].hex(), usr_struct['rootdir']]
+            if usr_struct.get('epoch', 0):
+                fields.append(str(usr_struct['epoch']))
+            records.append(self.fld_delimiter.join(fields))
+        tmpfile = self.usersfile + '.tmp'
+        with open(tmpfile, 'wb') as f:
+            f.write(self.rec_delimiter.join(records).encode(self.coding))
+        os.replace(tmpfile, self.usersfile)
+        self.users = users
+        self.mtime_ns = os.stat(self.usersfile).st_mtime_ns
+
+
+    def get_user(self, username):
+        self.refresh()
+        return self.users.get(username)
+
+
+    def list_users(self):
+        self.refresh()
+        return list(self.users)
+
+
+    # adds or replaces user records given as a dictionary of username --> user record
+    def put_users(self, records):
+        for username in records:
+            if not username or self.fld_delimiter in username or self.rec_delimiter in username:
+                raise SiFT_USERS_Error('Username is empty or contains a delimiter character')
+        self.refresh()
+        with self.lock:
+            users = dict(self.users)
+            users.update(records)
+            self.write_users(users)
+
+
+    def remove_user(self, username):
+        self.refresh()
+        with self.lock:
+            if username not in self.users:
+                raise SiFT_USERS_Error('Unknown user ' + username)
+            users = dict(self.users)
+            del users[username]
+            self.write_users(users)
+
+
+    # the store can be used wherever the users dictionary was used
+    def __contains__(self, username):
+        return self.get_user(username) is not None
+
+    def __getitem__(self, username):
+        usr_struct = self.get_user(username)
+        if usr_struct is None:
+            raise KeyError(username)
+        return usr_struct
+
+    def __len__(self):
+        self.refresh()
+        return len(self.users)
+
+
+# user store backed by an indexed sqlite3 database, lookups do not load the other records
+class SiFT_USERS_DB:
+    def __init__(self, dbfile):
+
+        # --------- STATE ------------
+        self.dbfile = dbfile
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(dbfile, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, pwdhash BLOB NOT NULL, '
+                            'icount INTEGER NOT NULL, salt BLOB NOT NULL, rootdir TEXT NOT NULL, epoch INTEGER NOT NULL DEFAULT 0)')
+            # databases made before the ticket epoch was added
+            if 'epoch' not in [row[1] for row in self.db.execute('PRAGMA table_info(users)')]:
+                self.db.execute('ALTER TABLE users ADD COLUMN epoch INTEGER NOT NULL DEFAULT 0')
+
+
+    def get_user(self, username):
+        with self.lock:
+            row = self.db.execute('SELECT pwdhash, icount, salt, rootdir, epoch FROM users WHERE username = ?',
+                                  (username,)).fetchone()
+        if row is None:
+            return None
+        usr_struct = {}
+        usr_struct['pwdhash'] = bytes(row[0])
+        usr_struct['icount'] = row[1]
+        usr_struct['salt'] = bytes(row[2])
+        usr_struct['rootdir'] = row[3]
+        usr_struct['epoch'] = row[4]
+        return usr_struct
+
+
+    def list_users(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT username FROM users ORDER BY username')]
+
+
+    # adds or replaces user records given as a dictionary of username --> user record
+    def put_users(self, records):
+        for username in records:
+            if not username:
+                raise SiFT_USERS_Error('Username is empty')
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO users (username, pwdhash, icount, salt, rootdir, epoch) VALUES (?, ?, ?, ?, ?, ?)',
+                                [(username, r['pwdhash'], r['icount'], r['salt'], r['rootdir'], r.get('epoch', 0))
+                                 for username, r in records.items()])
+
+
+    def remove_user(self, username):
+        with self.lock, self.db:
+            if self.db.execute('DELETE FROM users WHERE username = ?', (username,)).rowcount == 0:
+                raise SiFT_USERS_Error('Unknown user ' + username)
+
+
+    # the store can be used wherever the users dictionary was used
+    def __contains__(self, username):
+        return self.get_user(username) is not None
+
+    def __getitem__(self, username):
+        usr_struct = self.get_user(username)
+        if usr_struct is None:
+            raise KeyError(username)
+        return usr_struct
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
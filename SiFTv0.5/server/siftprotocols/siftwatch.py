@@ -0,0 +1,222 @@
+#python3
+
+import os, stat, time, threading
+from collections import OrderedDict
+
+# change events of the watched directories of all sessions
+# a subscriber (a session) is notified by subscriber.send_events(list of (event, path)) from a sender thread of its own,
+# the events of a path are coalesced until they are sent every interval seconds, a subscriber that does not read
+# its notifications only blocks its own sender, its events are held back meanwhile (up to max_pending)
+class SiFT_WATCH:
+    def __init__(self, interval=0.5, rescan_interval=5.0, max_pending=1000):
+
+        # --------- CONSTANTS ------------
+        self.interval = interval # seconds between notifications of a subscriber
+        self.rescan_interval = rescan_interval # seconds between scans of the watched directories for changes made outside of the server (0 disables them)
+        self.max_pending = max_pending # events held back for a subscriber before they are replaced by rescan events of its directories
+        self.ev_create = 'create'
+        self.ev_delete = 'delete'
+        self.ev_modify = 'modify'
+        self.ev_rescan = 'rescan' # too many changes, the directory has to be listed again
+        # --------- STATE ------------
+        self.lock = threading.Lock()
+        self.watchers = {} # absolute directory path --> {subscriber: path prefix of the directory for the subscriber}
+        self.snapshots = {} # absolute directory path --> {name: (is directory, size, mtime (ns))} of the entries
+        self.pending = {} # subscriber --> OrderedDict of path --> coalesced event
+        self.overflowed = {} # subscriber --> prefixes of its directories to be rescanned, their events are dropped
+        self.sending = set() # subscribers whose sender thread is still sending their previous events
+        self.counters = {'events': 0, 'coalesced': 0, 'notifications': 0, 'overflows': 0, 'rescans': 0}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+
+    # starts the notifier thread
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    # stops the notifier thread
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+    # sends the pending events every interval seconds and rescans the watched directories every rescan_interval seconds
+    def run(self):
+        rescan_at = time.monotonic() + self.rescan_interval
+        while not self.stop_event.wait(self.interval):
+            if self.rescan_interval and time.monotonic() >= rescan_at:
+                self.rescan()
+                rescan_at = time.monotonic() + self.rescan_interval
+            self.flush()
+
+
+    # returns the entries of a directory with their state: (True, 0, 0) for a directory (changes below it are not its own)
+    # or (False, size, mtime (ns)) for a file, entries starting with . are left out
+    def scan(self, path):
+        snapshot = {}
+        try:
+            with os.scandir(path) as entries:
+                for f in entries:
+                    if f.name.startswith('.'): continue
+                    try:
+                        if f.is_dir():
+                            snapshot[f.name] = (True, 0, 0)
+                        else:
+                            st = f.stat()
+                            snapshot[f.name] = (False, st.st_size, st.st_mtime_ns)
+                    except OSError: # removed since it was listed
+                        continue
+        except OSError: # the directory was removed
+            pass
+        return snapshot
+
+
+    # returns the state of an entry of a directory as made by scan(), None if it does not exist
+    def stat_entry(self, path, name):
+        try:
+            st = os.stat(os.path.join(path, name))
+        except OSError:
+            return None
+        if stat.S_ISDIR(st.st_mode):
+            return (True, 0, 0)
+        return (False, st.st_size, st.st_mtime_ns)
+
+
+    # subscribes to the changes of a directory, prefix is put before the names in the events of the subscriber
+    def subscribe(self, subscriber, path, prefix):
+        snapshot = self.scan(path)
+        with self.lock:
+            if path not in self.watchers:
+                self.watchers[path] = {}
+                self.snapshots[path] = snapshot
+            self.watchers[path][subscriber] = prefix
+
+
+    # ends the subscription to the changes of a directory, returns False if there was none
+    def unsubscribe(self, subscriber, path):
+        with self.lock:
+            subscribers = self.watchers.get(path)
+            if subscribers is None or subscribers.pop(subscriber, None) is None:
+                return False
+            if not subscribers:
+                del self.watchers[path]
+                del self.snapshots[path]
+            return True
+
+
+    # ends all subscriptions of a subscriber and drops its pending events
+    def remove(self, subscriber):
+        with self.lock:
+            for path in [path for path, subscribers in self.watchers.items() if subscriber in subscribers]:
+                del self.watchers[path][subscriber]
+                if not self.watchers[path]:
+                    del self.watchers[path]
+                    del self.snapshots[path]
+            self.pending.pop(subscriber, None)
+            self.overflowed.pop(subscriber, None)
+
+
+    # reports that an entry of a directory may have changed, the event is found by comparing it with the snapshot
+    def publish(self, path, name):
+        if path not in self.watchers: # not watched, no need to look at the entry
+            return
+        state = self.stat_entry(path, name)
+        with self.lock:
+            snapshot = self.snapshots.get(path)
+            if snapshot is not None:
+                self.update_entry(path, snapshot, name, state)
+
+
+    # compares the watched directories with their snapshots to find changes made outside of the server
+    def rescan(self):
+        with self.lock:
+            paths = list(self.watchers)
+        for path in paths:
+            current = self.scan(path)
+            with self.lock:
+                snapshot = self.snapshots.get(path)
+                if snapshot is None: # no longer watched
+                    continue
+                for name in set(snapshot) | set(current):
+                    self.update_entry(path, snapshot, name, current.get(name))
+                self.counters['rescans'] += 1
+
+
+    # updates an entry of a snapshot and queues the event of the change for the subscribers of the directory (with the lock held)
+    def update_entry(self, path, snapshot, name, state):
+        old = snapshot.get(name)
+        if old == state:
+            return
+        if state is None:
+            del snapshot[name]
+            event = self.ev_delete
+        else:
+            snapshot[name] = state
+            event = self.ev_create if old is None else self.ev_modify
+        is_dir = (state or old)[0]
+        self.counters['events'] += 1
+        for subscriber, prefix in self.watchers[path].items():
+            self.add_event(subscriber, prefix, prefix + name + ('/' if is_dir else ''), event)
+
+
+    # adds an event to the pending events of a subscriber, coalescing it with a pending event of the same path
+    # (with the lock held)
+    def add_event(self, subscriber, prefix, entry_path, event):
+        if prefix in self.overflowed.get(subscriber, ()): # the whole directory is listed again anyway
+            self.counters['coalesced'] += 1
+            return
+        pending = self.pending.setdefault(subscriber, OrderedDict())
+        old = pending.pop(entry_path, None)
+        if old is not None:
+            self.counters['coalesced'] += 1
+            if old == self.ev_create and event == self.ev_delete: # came and went
+                return
+            if old == self.ev_create:
+                event = self.ev_create
+            elif old == self.ev_delete and event == self.ev_create:
+                event = self.ev_modify
+        pending[entry_path] = event
+        if len(pending) > self.max_pending:
+            self.counters['overflows'] += 1
+            self.overflowed[subscriber] = {subscribers[subscriber] for subscribers in self.watchers.values() if subscriber in subscribers}
+            del self.pending[subscriber]
+
+
+    # hands the pending events to sender threads of their subscribers, the events of a subscriber still sending
+    # its previous events stay pending
+    def flush(self):
+        batches = []
+        with self.lock:
+            for subscriber in (set(self.pending) | set(self.overflowed)) - self.sending:
+                events = [(self.ev_rescan, prefix or '/') for prefix in sorted(self.overflowed.pop(subscriber, ()))]
+                events += [(event, entry_path) for entry_path, event in self.pending.pop(subscriber, {}).items()]
+                if not events: continue
+                self.sending.add(subscriber)
+                batches.append((subscriber, events))
+        for subscriber, events in batches:
+            threading.Thread(target=self.notify, args=(subscriber, events), daemon=True).start()
+
+
+    # sends events to a subscriber (called by its sender thread), a subscriber that cannot be notified any more is removed
+    def notify(self, subscriber, events):
+        try:
+            subscriber.send_events(events)
+        except Exception: # the connection of the session is broken
+            self.remove(subscriber)
+        else:
+            with self.lock:
+                self.counters['notifications'] += 1
+        finally:
+            with self.lock:
+                self.sending.discard(subscriber)
+
+
+    # returns a snapshot of the counters
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['directories'] = len(self.watchers)
+            return stats
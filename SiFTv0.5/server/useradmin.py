@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+User Administration Utility for SiFT v1.0
+Manages the users of the server in the users file or the sqlite3 user database.
+- add, remove and change the password of single users
+- revoke the resumption tickets of a user (bumps the ticket epoch of the user)
+- import users in bulk, hashing the passwords in parallel worker processes
+- migrate the records of the users file to the user database
+"""
+
+import os, sys, argparse, getpass
+from concurrent.futures import ProcessPoolExecutor
+from siftprotocols.siftusers import SiFT_USERS_FILE, SiFT_USERS_DB, SiFT_USERS_Error, make_user_record
+
+# Open the user store selected on the command line
+def open_store(args):
+    if args.db:
+        return SiFT_USERS_DB(args.db)
+    return SiFT_USERS_FILE(args.file)
+
+# Ask for a new password twice
+def read_password(username):
+    password = getpass.getpass(f'New password for {username}: ')
+    if password != getpass.getpass('Repeat password: '):
+        raise SiFT_USERS_Error('Passwords do not match')
+    return password
+
+# Create the root directory of a user on the server
+def create_rootdir(args, rootdir):
+    path = os.path.join(args.server_rootdir, rootdir)
+    if not os.path.exists(path):
+        os.makedirs(path)
+        print(f"Created root directory {path}")
+
+def cmd_list(args, store):
+    for username in store.list_users():
+        usr_struct = store.get_user(username)
+        print(f"{username:<20} icount={usr_struct['icount']:<8} rootdir={usr_struct['rootdir']}")
+
+def cmd_add(args, store):
+    if args.username in store:
+        raise SiFT_USERS_Error('User ' + args.username + ' already exists')
+    rootdir = args.rootdir or args.username + '/'
+    store.put_users({args.username: make_user_record(read_password(args.username), args.icount, rootdir)})
+    create_rootdir(args, rootdir)
+    print(f"User {args.username} added")
+
+def cmd_remove(args, store):
+    store.remove_user(args.username)
+    print(f"User {args.username} removed (root directory is kept)")
+
+def cmd_passwd(args, store):
+    usr_struct = store.get_user(args.username)
+    if usr_struct is None:
+        raise SiFT_USERS_Error('Unknown user ' + args.username)
+    icount = args.icount or usr_struct['icount']
+    store.put_users({args.username: make_user_record(read_password(args.username), icount, usr_struct['rootdir'])})
+    print(f"Password of {args.username} changed")
+
+def cmd_revoke(args, store):
+    usr_struct = store.get_user(args.username)
+    if usr_struct is None:
+        raise SiFT_USERS_Error('Unknown user ' + args.username)
+    usr_struct = dict(usr_struct)
+    usr_struct['epoch'] = usr_struct.get('epoch', 0) + 1
+    store.put_users({args.username: usr_struct})
+    print(f"Resumption tickets of {args.username} revoked")
+
+# Import users from lines of username:rootdir:password (empty rootdir for <username>/), hashing in parallel
+# the password comes last, so it may contain ':'
+def cmd_import(args, store):
+    entries = []
+    with open(args.importfile, 'r', encoding='utf-8') as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            fields = line.rstrip('\n').split(':', 2)
+            if len(fields) != 3 or not fields[0] or not fields[2]:
+                raise SiFT_USERS_Error(f'Malformed import line {lineno}, expected username:rootdir:password')
+            rootdir = fields[1] or fields[0] + '/'
+            entries.append((fields[0], fields[2], rootdir))
+
+    print(f"Hashing {len(entries)} password(s) with {args.workers} worker(s)...")
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        records = executor.map(make_user_record, [e[1] for e in entries],
+                               [args.icount] * len(entries), [e[2] for e in entries])
+        records = dict(zip([e[0] for e in entries], records))
+
+    store.put_users(records)
+    for username, password, rootdir in entries:
+        create_rootdir(args, rootdir)
+    print(f"{len(records)} user(s) imported")
+
+# Copy the records of the users file to the user database (passwords are not rehashed)
+def cmd_migrate(args, store):
+    if not args.db:
+        raise SiFT_USERS_Error('Target user database must be given with --db')
+    source = SiFT_USERS_FILE(args.file)
+    records = {username: source.get_user(username) for username in source.list_users()}
+    store.put_users(records)
+    print(f"{len(records)} user(s) migrated from {args.file} to {args.db}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the users of the SiFT server')
+    parser.add_argument('--file', default='users.txt', help='users file (default: users.txt)')
+    parser.add_argument('--db', help='sqlite3 user database to use instead of the users file')
+    parser.add_argument('--server-rootdir', default='./users/', help='root directory of the server (default: ./users/)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('list', help='list users').set_defaults(func=cmd_list)
+
+    p = subparsers.add_parser('add', help='add a user')
+    p.add_argument('username')
+    p.add_argument('--rootdir', help='root directory of the user (default: <username>/)')
+    p.add_argument('--icount', type=int, default=100000, help='PBKDF2 iteration count (default: 100000)')
+    p.set_defaults(func=cmd_add)
+
+    p = subparsers.add_parser('remove', help='remove a user')
+    p.add_argument('username')
+    p.set_defaults(func=cmd_remove)
+
+    p = subparsers.add_parser('passwd', help='change the password of a user')
+    p.add_argument('username')
+    p.add_argument('--icount', type=int, help='new PBKDF2 iteration count (default: keep the current one)')
+    p.set_defaults(func=cmd_passwd)
+
+    p = subparsers.add_parser('revoke', help='revoke the resumption tickets of a user')
+    p.add_argument('username')
+    p.set_defaults(func=cmd_revoke)
+
+    p = subparsers.add_parser('import', help='import users from lines of username:rootdir:password (empty rootdir for <username>/)')
+    p.add_argument('importfile')
+    p.add_argument('--icount', type=int, default=100000, help='PBKDF2 iteration count (default: 100000)')
+    p.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='parallel hashing processes')
+    p.set_defaults(func=cmd_import)
+
+    subparsers.add_parser('migrate', help='copy the users file into the database given with --db').set_defaults(func=cmd_migrate)
+
+    args = parser.parse_args()
+    try:
+        args.func(args, open_store(args))
+    except SiFT_USERS_Error as e:
+        print('SiFT_USERS_Error: ' + e.err_msg, file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()